@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+""" Admission control, for the land rushes: one registrar sending a
+flood of requests must not starve the others. Each authenticated
+registrar has a token bucket per class of operation (reads and
+writes), and the writes running at the same time are shared fairly
+between the registrars. A request over the limits is rejected at
+once (429, with Retry-After) instead of waiting for the database.
+
+The limits are a dictionary (JSON, for server.py --rate-limits):
+
+{"read": [100, 200], "write": [10, 20], "write_slots": 16,
+ "registrars": {"3": {"write": [50, 100]}}}
+
+[rate, burst] is in requests per second and requests. An operation
+without a limit is not limited. "registrars" overrides the limits of
+some of them. Without "write_slots", the writes are not scheduled.
+Everything is per process. """
+
+import math
+import threading
+import time
+
+OPERATIONS = {"GET": "read", "HEAD": "read",
+              "PUT": "write", "PATCH": "write", "POST": "write", "DELETE": "write"}
+
+class InvalidLimits(Exception):
+    pass
+
+class Bucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self, now):
+        """ 0 if there was a token, otherwise the seconds to wait for
+        the next one """
+        self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens)/self.rate
+
+def check(limits):
+    """ Raises InvalidLimits if limits does not have the syntax above """
+    if not isinstance(limits, dict):
+        raise InvalidLimits("The limits must be an object")
+    for (name, value) in limits.items():
+        if name in ("read", "write"):
+            if not isinstance(value, (list, tuple)) or len(value) != 2 or \
+               not all(isinstance(v, (int, float)) and v > 0 for v in value) or value[1] < 1:
+                raise InvalidLimits("%s must be [rate, burst], with burst >= 1" % name)
+        elif name == "write_slots":
+            if not isinstance(value, int) or value < 1:
+                raise InvalidLimits("write_slots must be a positive integer")
+        elif name == "registrars":
+            if not isinstance(value, dict):
+                raise InvalidLimits("registrars must be an object")
+            for (registrar, overrides) in value.items():
+                try:
+                    int(registrar)
+                except ValueError:
+                    raise InvalidLimits("Invalid registrar %s" % registrar)
+                if not isinstance(overrides, dict) or set(overrides) - {"read", "write"}:
+                    raise InvalidLimits("The limits of registrar %s must have only read and write" % registrar)
+                check(overrides)
+        else:
+            raise InvalidLimits("Unknown member %s" % name)
+
+class Controller:
+
+    def __init__(self, limits):
+        self.lock = threading.Lock()
+        self.writing = {} # registrar -> writes running
+        self.configure(limits)
+
+    def configure(self, limits):
+        """ Can be called at any time. The buckets start full again,
+        the writes running are still counted. """
+        check(limits)
+        registrars = {int(registrar): overrides
+                      for (registrar, overrides) in limits.get("registrars", {}).items()}
+        with self.lock:
+            self.limits = limits
+            self.registrars = registrars
+            self.buckets = {} # (registrar, operation) -> Bucket
+            self.write_slots = limits.get("write_slots")
+
+    def limit(self, registrar, operation):
+        overrides = self.registrars.get(registrar)
+        if overrides is not None and operation in overrides:
+            return overrides[operation]
+        return self.limits.get(operation)
+
+    def fair(self, registrar):
+        """ A registrar may always run its share of the slots, even if
+        the others took more when it was idle (they are then refused
+        until they are under their own share). So, for a while, there
+        may be up to twice as many writes as slots. """
+        running = self.writing.get(registrar, 0)
+        if sum(self.writing.values()) < self.write_slots:
+            return True
+        active = len(self.writing) + (0 if registrar in self.writing else 1)
+        return running < max(1, self.write_slots // active)
+
+    def admit(self, registrar, method):
+        """ None if the request can run (then, for a write, call done
+        when it is over), otherwise (operation, reason, seconds before
+        retrying). """
+        operation = OPERATIONS.get(method)
+        if operation is None:
+            return None
+        scheduled = operation == "write" and self.write_slots is not None
+        with self.lock:
+            # Before the bucket, so a refused write does not use a token
+            if scheduled and not self.fair(registrar):
+                return operation, "fair_share", 1
+            limit = self.limit(registrar, operation)
+            if limit is not None:
+                bucket = self.buckets.get((registrar, operation))
+                if bucket is None:
+                    bucket = self.buckets[(registrar, operation)] = Bucket(*limit)
+                wait = bucket.take(time.monotonic())
+                if wait > 0:
+                    return operation, "rate", max(1, math.ceil(wait))
+            if scheduled:
+                self.writing[registrar] = self.writing.get(registrar, 0) + 1
+        return None
+
+    def done(self, registrar, method):
+        if OPERATIONS.get(method) != "write":
+            return
+        with self.lock:
+            running = self.writing.get(registrar, 0) - 1
+            if running > 0:
+                self.writing[registrar] = running
+            else:
+                self.writing.pop(registrar, None)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+""" Approves the transfers which are pending for too long (the
+registrar of the domain did not answer). Run it regularly, for
+instance from cron. Each batch is one statement and one transaction,
+so a large backlog does not keep locks for long. The transfers to a
+registrar which reached its quota stay pending. """
+
+import argparse
+
+# https://pypi.org/project/psycopg2/
+import psycopg2
+
+import queries
+import registry
+
+parser = argparse.ArgumentParser(description="Approves the expired transfers")
+parser.add_argument("--database", default=registry.DATABASE)
+parser.add_argument("--delay", type=int, default=registry.TRANSFER_DELAY,
+                    help="Seconds after which a pending transfer is approved")
+parser.add_argument("--batch", type=int, default=1000)
+args = parser.parse_args()
+connection = psycopg2.connect(args.database)
+cursor = connection.cursor()
+total = 0
+while True:
+    try:
+        cursor.execute(queries.STATEMENTS["approve_expired_transfers"].sql,
+                       {"delay": args.delay, "batch": args.batch})
+    except psycopg2.errors.CheckViolation:
+        # Creations took the room of a registrar since the batch was
+        # chosen (see create.sql), choose it again
+        connection.rollback()
+        continue
+    count = cursor.rowcount
+    connection.commit()
+    total += count
+    # Fewer than the batch does not mean it is over, the transfers
+    # beyond the quota of a registrar were left out.
+    if count == 0:
+        break
+print("%i transfers approved" % total)
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+""" The ASGI front end of the registry, for instance with 'uvicorn
+asgi:application'. It runs the same business logic as the WSGI
+front end (registry.handle_request) but with an asynchronous
+PostgreSQL driver, so a request waiting for the database does not tie
+up a thread. It also runs with the memory storage (see memory.py). """
+
+import asyncio
+import io
+import time
+
+# https://pypi.org/project/psycopg/ https://pypi.org/project/psycopg-pool/
+import psycopg
+import psycopg_pool
+
+import registry
+import queries
+import memory
+import tracing
+
+MAX_BODY = 1024*1024
+
+TOO_LARGE = registry.Encoded(413, "Too large", {"result": "Request body too large"})
+
+# The errors of the SQLSTATE class 40 (psycopg2 has a common class for
+# them, psycopg does not), see registry.CONFLICT
+TRANSACTION_FAILED = (psycopg.errors.TransactionRollback, psycopg.errors.SerializationFailure,
+                      psycopg.errors.DeadlockDetected, psycopg.errors.StatementCompletionUnknown,
+                      psycopg.errors.TransactionIntegrityConstraintViolation)
+
+class TooLarge(Exception):
+    pass
+
+class AsyncDatabase:
+    """ The database of one request, same interface as
+    registry.Database. """
+    errors = psycopg.errors
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.round_trips = 0
+        self.db_time = 0.0
+
+    async def timed(self, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.round_trips += 1
+            self.db_time += time.perf_counter() - start
+
+    async def run(self, name, args):
+        """ psycopg prepares the statement at its first use on this
+        connection and keeps it. """
+        return await self.timed(self.connection.execute(queries.STATEMENTS[name].sql, args,
+                                                        prepare=True))
+
+    async def execute(self, name, args=None):
+        cursor = await self.run(name, args)
+        return cursor.rowcount
+
+    async def fetchone(self, name, args=None):
+        cursor = await self.run(name, args)
+        return await cursor.fetchone()
+
+    async def fetchall(self, name, args=None):
+        cursor = await self.run(name, args)
+        return await cursor.fetchall()
+
+    async def commit(self):
+        await self.timed(self.connection.commit())
+
+    async def rollback(self):
+        await self.timed(self.connection.rollback())
+
+    async def run_blocking(self, function, *args):
+        return await asyncio.to_thread(function, *args)
+
+    async def explain(self, name, args=None):
+        """ See registry.Database.explain """
+        for options in tracing.EXPLAIN:
+            await self.connection.execute("SAVEPOINT explain")
+            try:
+                cursor = await self.connection.execute("EXPLAIN (%s) %s" % (options, queries.STATEMENTS[name].sql),
+                                                       args)
+                return (await cursor.fetchone())[0]
+            except psycopg.Error:
+                if options == tracing.EXPLAIN[-1]:
+                    raise
+            finally:
+                await self.connection.execute("ROLLBACK TO SAVEPOINT explain")
+
+    async def copy(self, name):
+        """ See registry.Database.copy. psycopg sends each row
+        separately, they are grouped. """
+        async with database.connection() as connection:
+            async with connection.cursor() as cursor:
+                async with cursor.copy(queries.COPIES[name]) as copy:
+                    buffer = bytearray()
+                    async for data in copy:
+                        buffer += data
+                        if len(buffer) >= registry.COPY_CHUNK:
+                            yield bytes(buffer)
+                            buffer = bytearray()
+                    if buffer:
+                        yield bytes(buffer)
+
+    async def stream(self, name, args=None, size=1000):
+        """ See registry.Database.stream """
+        async with database.connection() as connection:
+            async with connection.cursor(name="stream") as cursor:
+                await cursor.execute(queries.STATEMENTS[name].sql, args)
+                while True:
+                    rows = await cursor.fetchmany(size)
+                    if not rows:
+                        break
+                    yield rows
+
+database = None
+startup_lock = asyncio.Lock()
+
+async def startup():
+    global database
+    async with startup_lock:
+        if database is not None:
+            return
+        registry.setup(with_pool=False)
+        if registry.store is not None:
+            database = registry.store # Nothing to open
+            return
+        pool = psycopg_pool.AsyncConnectionPool(registry.config["database"],
+                                                min_size=registry.config["min_connections"],
+                                                max_size=registry.config["max_connections"],
+                                                timeout=registry.config["connection_timeout"],
+                                                check=psycopg_pool.AsyncConnectionPool.check_connection,
+                                                open=False)
+        await pool.open()
+        database = pool
+        registry.instrumentation.gauge("rpp_pool_connections", "Database connections of the pool",
+                                       pool_gauge)
+
+def pool_gauge():
+    if database is None:
+        return []
+    stats = database.get_stats()
+    return [({"state": "in_use"}, stats["pool_size"] - stats["pool_available"]),
+            ({"state": "max"}, stats["pool_max"])]
+
+async def shutdown():
+    global database
+    if database is not None and registry.store is None:
+        await database.close()
+        database = None
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def read_body(receive):
+    """ Returns None if the client went away """
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY:
+            raise TooLarge
+        if not message.get("more_body", False):
+            return body
+
+def environ(scope, body):
+    """ Builds the WSGI environment expected by registry.handle_request """
+    environ = {"REQUEST_METHOD": scope["method"],
+               "PATH_INFO": scope["path"],
+               "QUERY_STRING": scope["query_string"].decode("latin-1"),
+               "CONTENT_LENGTH": str(len(body)),
+               "wsgi.input": io.BytesIO(body)}
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for (name, value) in scope["headers"]:
+        key = "HTTP_" + name.decode("latin-1").upper().replace("-", "_")
+        if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+            continue
+        if key in environ:
+            environ[key] += "," + value.decode("latin-1")
+        else:
+            environ[key] = value.decode("latin-1")
+    return environ
+
+async def respond(send, status, output):
+    (sstatus, headers, body) = registry.encode(status, output)
+    await send({"type": "http.response.start",
+                "status": status["code"],
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                            for (name, value) in headers]})
+    if isinstance(output, registry.Stream):
+        async for chunk in body:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    else:
+        await send({"type": "http.response.body", "body": body})
+
+async def process(request_database, request):
+    token = registry.current_database.set(request_database if registry.tracer is None else \
+                                          registry.tracer.wrap(request_database, request))
+    address = registry.current_address.set(request.get("REMOTE_ADDR"))
+    try:
+        return await registry.handle_request(request)
+    finally:
+        registry.current_address.reset(address)
+        registry.current_database.reset(token)
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if database is None: # The server does not support lifespan
+        await startup()
+    if scope["path"] == "/metrics":
+        body = registry.instrumentation.render().encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; version=0.0.4"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+        return
+    try:
+        body = await read_body(receive)
+    except TooLarge:
+        await respond(send, *TOO_LARGE.response())
+        return
+    if body is None:
+        return
+    start = time.monotonic()
+    request = environ(scope, body)
+    request_database = None
+    try:
+        if registry.store is not None:
+            request_database = memory.Database(registry.store)
+            try:
+                (status, output) = await process(request_database, request)
+            finally:
+                request_database.close()
+        else:
+            async with database.connection() as connection:
+                request_database = AsyncDatabase(connection)
+                try:
+                    (status, output) = await process(request_database, request)
+                finally:
+                    # Same behaviour as the synchronous pool: what was
+                    # not committed is abandoned.
+                    await connection.rollback()
+    except psycopg_pool.PoolTimeout:
+        registry.logger.error("No database connection available")
+        (status, output) = registry.SERVER_BUSY.response()
+    except TRANSACTION_FAILED as e:
+        # Rolled back above, the pool keeps the connection
+        registry.logger.error("Transaction failed: %s" % e)
+        (status, output) = registry.CONFLICT.response()
+    except psycopg.errors.QueryCanceled as e:
+        registry.logger.error("Query canceled: %s" % e)
+        (status, output) = registry.QUERY_CANCELED.response()
+    except psycopg.OperationalError as e:
+        registry.logger.error("Database error: %s" % e)
+        (status, output) = registry.DATABASE_UNAVAILABLE.response()
+    registry.record_transaction(request, status, time.monotonic() - start, request_database)
+    await respond(send, status, output)
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+""" An in-process filter of the registered domain names, to answer
+"this name is available" without asking PostgreSQL. A Bloom filter
+never says that a registered name is absent, but may say that an
+absent name is present (false positive), in which case we ask the
+database. A small exact cache remembers the last answers of the
+database.
+
+The filter is filled by a scan of the Domains table and kept up to
+date by the notifications of the trigger notify_domain (see
+create.sql). Until the scan is done, or when notifications may have
+been lost, it does not answer. """
+
+import collections
+import hashlib
+import logging
+import math
+import threading
+
+# https://pypi.org/project/psycopg2/
+import psycopg2
+
+logger = logging.getLogger("RPP")
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity*math.log(error_rate)/(math.log(2)**2)))
+        self.hashes = max(1, round(self.size/capacity*math.log(2)))
+        self.bits = bytearray((self.size + 7)//8)
+        self.count = 0
+
+    def positions(self, name):
+        digest = hashlib.blake2b(name.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i*h2) % self.size for i in range(self.hashes)]
+
+    def add(self, name, counted=True):
+        for position in self.positions(name):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        if counted:
+            self.count += 1
+
+    def __contains__(self, name):
+        for position in self.positions(name):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+class Filter:
+
+    def __init__(self, dsn, error_rate=0.01, cache_size=10000, batch=10000):
+        self.dsn = dsn
+        self.error_rate = error_rate
+        self.cache_size = cache_size
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.bloom = None # None until the first scan is done
+        self.building = None # Filled during a rebuild
+        self.rebuilding = False
+        # Incremented when notifications may have been lost: a rebuild
+        # started before may have missed names, its filter is thrown
+        # away
+        self.epoch = 0
+        self.deleted = 0
+        # name -> registered or not, as seen in the database
+        self.cache = collections.OrderedDict()
+        # Incremented at each change, see learn()
+        self.generation = 0
+        self.counters = {"lookups": 0, "filtered": 0, "cached": 0,
+                         "database": 0, "false_positives": 0, "rebuilds": 0}
+
+    def lookup(self, name):
+        """ Returns False if the name is certainly not registered, True
+        if it certainly is, None if the database must be asked. """
+        with self.lock:
+            self.counters["lookups"] += 1
+            if self.bloom is None:
+                self.counters["database"] += 1
+                return None
+            if name not in self.bloom:
+                self.counters["filtered"] += 1
+                return False
+            registered = self.cache.get(name)
+            if registered is not None:
+                self.cache.move_to_end(name)
+                self.counters["cached"] += 1
+                return registered
+            self.counters["database"] += 1
+            return None
+
+    def learn(self, name, registered, generation):
+        """ What the database said. generation is the value of
+        self.generation before asking it. """
+        with self.lock:
+            if self.bloom is not None and not registered:
+                self.counters["false_positives"] += 1
+            if generation != self.generation:
+                return
+            self.remember(name, registered)
+
+    def remember(self, name, registered):
+        self.cache[name] = registered
+        self.cache.move_to_end(name)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def added(self, name, notified=False):
+        """ Called by this process as soon as it registered name, so
+        its next requests see it, then by the notification of the
+        change, like for the other processes: only the notification
+        counts it. Same for removed. """
+        with self.lock:
+            self.generation += 1
+            for bloom in (self.bloom, self.building):
+                if bloom is not None:
+                    bloom.add(name, notified)
+            self.remember(name, True)
+            full = self.bloom is not None and self.bloom.count > self.bloom.capacity
+        if full:
+            self.rebuild_later()
+
+    def removed(self, name, notified=False):
+        with self.lock:
+            self.generation += 1
+            # We cannot remove from a Bloom filter, it will just give
+            # one more false positive, until the next rebuild.
+            self.remember(name, False)
+            if notified:
+                self.deleted += 1
+            stale = self.bloom is not None and self.deleted > self.bloom.capacity/4
+        if stale:
+            self.rebuild_later()
+
+    def notified(self, payload):
+        """ Callback for the notifications of the channel 'domains'. The
+        payload is the operation and the name, None if we may have
+        missed some. """
+        if payload is None:
+            with self.lock:
+                self.generation += 1
+                self.epoch += 1
+                self.bloom = None
+                self.cache.clear()
+            self.rebuild_later()
+            return
+        (operation, name) = payload.split(" ", maxsplit=1)
+        if operation == "INSERT":
+            self.added(name, notified=True)
+        elif operation == "DELETE":
+            self.removed(name, notified=True)
+
+    def rebuild_later(self):
+        """ A rebuild already running is not started again: if
+        notifications were lost meanwhile, it will see it is stale and
+        start another one. """
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.rebuild, name="availability", daemon=True).start()
+
+    def rebuild(self):
+        bloom = None
+        with self.lock:
+            epoch = self.epoch
+        try:
+            connection = psycopg2.connect(self.dsn)
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT value FROM Counters WHERE name = 'domains'")
+                count = cursor.fetchone()[0]
+                # Room for growth, so we do not rebuild too often
+                new = BloomFilter(max(100000, 2*count), self.error_rate)
+                # From now on, notifications also go to the new
+                # filter. Since the scan starts after, no name can
+                # be missed.
+                with self.lock:
+                    self.building = new
+                scan = connection.cursor(name="availability")
+                scan.itersize = self.batch
+                scan.execute("SELECT name FROM Domains")
+                for data in scan:
+                    with self.lock:
+                        new.add(data[0])
+                connection.rollback()
+                bloom = new
+            finally:
+                connection.close()
+        except psycopg2.Error as e:
+            logger.error("Cannot rebuild the availability filter: %s" % e)
+        finally:
+            with self.lock:
+                stale = epoch != self.epoch
+                if bloom is not None and not stale:
+                    self.bloom = bloom
+                    self.deleted = 0
+                    self.counters["rebuilds"] += 1
+                self.building = None
+                self.rebuilding = False
+        if stale:
+            logger.info("Notifications lost during the rebuild of the availability filter, rebuilding again")
+            self.rebuild_later()
+        elif bloom is not None:
+            logger.info("Availability filter rebuilt with %i names" % bloom.count)
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result["cache_size"] = len(self.cache)
+            result["names"] = 0 if self.bloom is None else self.bloom.count
+        lookups = result["lookups"]
+        asked = result["database"]
+        result["hit_rate"] = (lookups - asked)/lookups if lookups else 0.0
+        result["false_positive_rate"] = result["false_positives"]/asked if asked else 0.0
+        return result
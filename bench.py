@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+""" Benchmarks of the registry, run in-process (no HTTP) unless
+noted. They require a database created with create.sql, unless noted.
+
+frontends: the WSGI front end (registry.dispatch, one thread per
+concurrent request) against the ASGI one (asgi.application, one task
+per concurrent request), on the same read-only mix of requests.
+
+validation: validations per second of the JSON bodies, with
+jsonschema.validate (what we did before), with the compiled validators
+and with the generated fast path. Does not need the database.
+
+encoding: responses encoded per second, as before (json.dumps,
+then encode), with json and with orjson (if installed), and paths
+routed per second, before and with the route table. Does not need the
+database.
+
+metrics: cost of the instrumentation (metrics.py), the WSGI front end
+with and without it, and the cost of one observation alone.
+
+load: a mix of reads and writes (availability, info, create, patch,
+transfer, list, weights set by --mix), in-process or, with --url,
+over HTTP to a running server. Reports the throughput and the
+p50/p95/p99 latencies per operation, and writes them in JSON with
+--output. The domains it created are deleted at the end (with
+--database), unless --keep.
+
+compare: compares two JSON results of load (for instance of two
+commits) and exits with 1 if there is a regression larger than
+--threshold. Does not need the database. """
+
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import datetime
+import http.client
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+# https://pypi.org/project/psycopg2/
+import psycopg2
+
+# https://pypi.org/project/jsonschema/
+import jsonschema
+
+import metrics
+import registry
+import validation
+
+# (method, path) The availability checks are for names which are
+# probably not registered.
+def request_mix():
+    choice = random.random()
+    if choice < 0.5:
+        return ("GET", "/domains/bench%i.example/availability" % random.randint(0, 1000000))
+    elif choice < 0.8:
+        return ("GET", "/domains/nic.example")
+    else:
+        return ("HEAD", "/domains/foobar.example")
+
+# A different cltrid for each request, or the writes would be replayed
+# (see idempotency.py)
+cltrids = itertools.count()
+
+def cltrid():
+    return "bench-%i" % next(cltrids)
+
+def make_environ(method, path, body=b"", user=None):
+    (path, query) = (path.split("?", maxsplit=1) + [""])[:2]
+    environ = {"REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query,
+               "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body),
+               "HTTP_RPP_CLTRID": cltrid()}
+    if user is not None:
+        environ["HTTP_AUTHORIZATION"] = "Basic " + base64.b64encode(user.encode()).decode()
+    return environ
+
+def report(name, latencies, elapsed):
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print("%s: %i requests in %.2f s, %.0f requests/s, p50 %.2f ms, p99 %.2f ms" % \
+          (name, len(latencies), elapsed, len(latencies)/elapsed,
+           quantiles[49]*1000, quantiles[98]*1000))
+
+def bench_wsgi(requests, concurrency, name="WSGI"):
+    def one(request):
+        start = time.perf_counter()
+        b"".join(registry.dispatch(make_environ(*request), lambda status, headers: None))
+        return time.perf_counter() - start
+    mix = [request_mix() for i in range(requests)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        latencies = list(executor.map(one, mix))
+        elapsed = time.perf_counter() - start
+    report(name, latencies, elapsed)
+
+async def bench_asgi(requests, concurrency):
+    import asgi
+    await asgi.startup()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(method, path):
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            pass
+        scope = {"type": "http", "method": method, "path": path,
+                 "query_string": b"", "headers": [(b"rpp-cltrid", b"bench")]}
+        async with semaphore:
+            start = time.perf_counter()
+            await asgi.application(scope, receive, send)
+            return time.perf_counter() - start
+    mix = [request_mix() for i in range(requests)]
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[one(*request) for request in mix])
+    elapsed = time.perf_counter() - start
+    report("ASGI", list(latencies), elapsed)
+    await asgi.shutdown()
+
+VALID = {("domain", "put"): {"holder": 2, "tech": 2, "admin": 2},
+         ("domain", "patch"): {"change": {"admin": 1}},
+         ("domain", "check"): ["foo%i.example" % i for i in range(100)],
+         ("contact", "put"): {"@type": "Card",
+                              "name": {"components": [{"kind": "given", "value": "Jean"},
+                                                      {"kind": "surname", "value": "Bon"}]}}}
+
+def rate(function, count):
+    start = time.perf_counter()
+    for i in range(count):
+        function()
+    return count/(time.perf_counter() - start)
+
+def bench_validation(count):
+    compiled = validation.Registry(registry.config["schemas"], fast=False)
+    fast = validation.Registry(registry.config["schemas"], fast=True)
+    for ((klass, method), instance) in VALID.items():
+        with open(os.path.join(registry.config["schemas"],
+                               validation.SCHEMAS[(klass, method)])) as INPUT:
+            schema = json.load(INPUT)
+        before = rate(lambda: jsonschema.validate(instance=instance, schema=schema), count)
+        after = rate(lambda: compiled.validate(instance, klass, method), count)
+        fastest = rate(lambda: fast.validate(instance, klass, method), count)
+        print("%s %s: jsonschema.validate %.0f/s, compiled %.0f/s, fast path %.0f/s" % \
+              (klass, method, before, after, fastest))
+
+# (name, function returning a new status and output) Typical responses
+RESPONSES = [("availability", lambda: ({"code": 404, "message": "Not found"},
+                                       {"result": "Domain foo.example NOT found. It can be registered"})),
+             ("info", lambda: ({"code": 200, "message": "OK", "cltrid": "bench", "svtrid": 1234},
+                               {"result": "Domain nic.example exists", "holder": 1,
+                                "tech_contact": 1, "admin_contact": 1, "registrar": 1,
+                                "created": datetime.datetime.now()})),
+             ("check", lambda: ({"code": 200, "message": "OK"},
+                                {"results": [{"name": "name%i.example" % i, "available": True}
+                                             for i in range(100)]})),
+             ("bad path", lambda: registry.BAD_PATH.response())]
+PATHS = ["/domains/foo.example", "/domains/foo.example/availability",
+         "/domains/foo.example/transfer/approval", "/entities/2", "/list-domains"]
+
+def old_encode(status, output):
+    """ registry.encode before the byte-level encoder """
+    if isinstance(output, registry.Encoded):
+        output = dict(output.output)
+    output["status_code"] = status["code"]
+    output["status_message"] = status["message"]
+    joutput = json.dumps(output, default=registry.serialize_others) + "\r\n"
+    return joutput.encode(), str(len(joutput))
+
+def old_route(path):
+    """ The parsing of the path before the route table """
+    if not path.startswith("/domains/") and  not path.startswith("/entities/") and not path.startswith("/list-domains") and path != "/check-domains":
+        return None
+    if path == "/list-domains":
+        return ("list-domains", ())
+    elif path == "/check-domains":
+        return ("check-domains", ())
+    elif path.startswith("/domains/"):
+        domain = path.removeprefix("/domains/")
+        operation = None
+        extra = None
+        if "/" in domain:
+            array = domain.split("/")
+            if len(array) > 3:
+                return None
+            if len(array) > 2:
+                extra = array[2]
+            if len(array) > 1:
+                operation = array[1]
+            domain = array[0]
+        return ("domains", (domain, operation, extra))
+    elif path.startswith("/entities/"):
+        return ("entities", (path.removeprefix("/entities/"),))
+
+def bench_encoding(count):
+    for (name, response) in RESPONSES:
+        before = rate(lambda: old_encode(*response()), count)
+        registry.config["fast_json"] = False
+        plain = rate(lambda: registry.encode(*response()), count)
+        registry.config["fast_json"] = True
+        fast = rate(lambda: registry.encode(*response()), count)
+        print("%s: before %.0f responses/s, json %.0f/s, %s %.0f/s" % \
+              (name, before, plain, "orjson" if registry.orjson else "orjson (not installed)", fast))
+    before = rate(lambda: [old_route(path) for path in PATHS], count)*len(PATHS)
+    after = rate(lambda: [registry.route(path) for path in PATHS], count)*len(PATHS)
+    print("Routing: before %.0f paths/s, route table %.0f/s" % (before, after))
+
+def bench_metrics(requests, concurrency):
+    instrumentation = metrics.Metrics()
+    count = requests*10
+    start = time.perf_counter()
+    for i in range(count):
+        instrumentation.observe("/domains/foo.example/availability", "GET", 404, 0.0003, 1, 0.0002)
+    print("One observation: %.2f µs" % ((time.perf_counter() - start)/count*1000000))
+    start = time.perf_counter()
+    for i in range(100):
+        instrumentation.render()
+    print("One scrape: %.2f ms" % ((time.perf_counter() - start)/100*1000))
+    # Alternate, so both runs see the same state of the database
+    for i in range(2):
+        registry.config["metrics"] = False
+        bench_wsgi(requests, concurrency, "Without metrics")
+        registry.config["metrics"] = True
+        bench_wsgi(requests, concurrency, "With metrics")
+
+# Default weights of the operations of the load benchmark
+MIX = {"availability": 50, "info": 20, "create": 10, "patch": 10,
+       "transfer": 5, "list": 5}
+# Names of the domains created by the load benchmark start with it
+LOAD_PREFIX = "load-"
+# Registrar which creates the domains, registrar which transfers them
+OWNER = "2:qwerty"
+GAINER = "3:bazinga"
+CREATE = json.dumps({"holder": 2, "tech": 2, "admin": 2}).encode()
+PATCH = json.dumps({"change": {"admin": 1}}).encode()
+
+class Load:
+    """ The requests of the load benchmark. The patch and transfer
+    operations use the domains created by the create operation (and
+    each domain is transferred only once). """
+
+    def __init__(self, mix):
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.run = "%x" % random.getrandbits(32)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.created = []
+        self.transferable = collections.deque()
+
+    def next(self):
+        """ Returns (operation, method, path, body, user) """
+        operation = random.choices(self.operations, self.weights)[0]
+        if operation == "availability":
+            return (operation, "GET", "/domains/bench%i.example/availability" % random.randint(0, 1000000),
+                    b"", None)
+        elif operation == "info":
+            return (operation, "GET", random.choice(("/domains/nic.example", "/domains/foobar.example")),
+                    b"", None)
+        elif operation == "list":
+            return (operation, "GET", "/list-domains?limit=100", b"", None)
+        with self.lock:
+            if operation == "patch" and self.created:
+                return (operation, "PATCH", "/domains/%s" % random.choice(self.created), PATCH, OWNER)
+            if operation == "transfer" and self.transferable:
+                return (operation, "POST", "/domains/%s/transfer" % self.transferable.popleft(),
+                        b"", GAINER)
+        # Nothing created yet, create
+        name = "%s%s-%i.example" % (LOAD_PREFIX, self.run, next(self.counter))
+        return ("create", "PUT", "/domains/%s" % name, CREATE, OWNER)
+
+    def done(self, operation, path, code):
+        if operation == "create" and code == 201:
+            name = path.removeprefix("/domains/")
+            with self.lock:
+                self.created.append(name)
+                self.transferable.append(name)
+
+def inprocess_client():
+    def send(method, path, body, user):
+        result = []
+        b"".join(registry.dispatch(make_environ(method, path, body, user),
+                                   lambda status, headers: result.append(status)))
+        return int(result[0].split()[0])
+    return send
+
+def http_client(url):
+    """ One persistent connection per thread """
+    url = urllib.parse.urlsplit(url)
+    local = threading.local()
+    def send(method, path, body, user):
+        headers = {"RPP-cltrid": cltrid()}
+        if user is not None:
+            headers["Authorization"] = "Basic " + base64.b64encode(user.encode()).decode()
+        for attempt in (1, 2):
+            if getattr(local, "connection", None) is None:
+                local.connection = http.client.HTTPConnection(url.hostname, url.port or 80,
+                                                              timeout=30)
+            try:
+                local.connection.request(method, path, body=body, headers=headers)
+                response = local.connection.getresponse()
+                response.read()
+                return response.status
+            except (OSError, http.client.HTTPException):
+                # The server may have closed the connection, retry once
+                local.connection.close()
+                local.connection = None
+        return 0
+    return send
+
+def summarize(latencies, elapsed, codes):
+    """ Latencies in ms. Errors are the 5xx and the failures of the
+    connection (code 0). """
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100)
+    else:
+        quantiles = latencies*99
+    return {"requests": len(latencies),
+            "throughput": len(latencies)/elapsed,
+            "p50": quantiles[49]*1000, "p95": quantiles[94]*1000, "p99": quantiles[98]*1000,
+            "errors": sum(count for (code, count) in codes.items() if code == 0 or code >= 500),
+            "codes": {str(code): count for (code, count) in sorted(codes.items())}}
+
+def bench_load(send, mix, requests, concurrency, warmup):
+    load = Load(mix)
+    latencies = collections.defaultdict(list)
+    codes = collections.defaultdict(collections.Counter)
+    def worker(count, record):
+        for i in count:
+            (operation, method, path, body, user) = load.next()
+            start = time.perf_counter()
+            code = send(method, path, body, user)
+            latency = time.perf_counter() - start
+            load.done(operation, path, code)
+            if record:
+                # list.append and Counter update are atomic enough
+                # with the GIL
+                latencies[operation].append(latency)
+                codes[operation][code] += 1
+    def run(total, record):
+        # Each thread takes the next request number until there are
+        # no more.
+        count = iter(range(total))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker, count, record) for i in range(concurrency)]:
+                future.result()
+    run(warmup, False)
+    start = time.perf_counter()
+    run(requests, True)
+    elapsed = time.perf_counter() - start
+    result = {"operations": {}}
+    for operation in sorted(latencies):
+        result["operations"][operation] = summarize(latencies[operation], elapsed,
+                                                    codes[operation])
+    result["total"] = summarize([l for operation in latencies for l in latencies[operation]],
+                                elapsed, sum(codes.values(), collections.Counter()))
+    for (name, summary) in list(result["operations"].items()) + [("total", result["total"])]:
+        print("%-12s %6i requests %8.0f requests/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  %i errors" % \
+              (name, summary["requests"], summary["throughput"], summary["p50"],
+               summary["p95"], summary["p99"], summary["errors"]))
+    return result
+
+def cleanup(dsn):
+    """ Deletes the domains created by the load benchmark """
+    connection = psycopg2.connect(dsn)
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM Transfers WHERE domain LIKE %(prefix)s", {"prefix": LOAD_PREFIX + "%"})
+    cursor.execute("DELETE FROM Domains WHERE name LIKE %(prefix)s", {"prefix": LOAD_PREFIX + "%"})
+    connection.commit()
+    connection.close()
+
+def parse_mix(text):
+    """ 'availability=50,info=20' """
+    mix = {}
+    for item in text.split(","):
+        (operation, weight) = item.split("=")
+        if operation not in MIX:
+            raise argparse.ArgumentTypeError("Unknown operation %s" % operation)
+        mix[operation] = float(weight)
+    return mix
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(old, new, threshold):
+    """ Returns True if new is not worse than old (more than threshold,
+    a fraction) """
+    ok = True
+    names = sorted(set(old["operations"]) & set(new["operations"])) + ["total"]
+    print("Comparing %s (%s) with %s (%s)" % (old.get("commit"), old.get("date"),
+                                              new.get("commit"), new.get("date")))
+    for name in names:
+        before = old["total"] if name == "total" else old["operations"][name]
+        after = new["total"] if name == "total" else new["operations"][name]
+        throughput = after["throughput"]/before["throughput"] - 1
+        p99 = after["p99"]/before["p99"] - 1 if before["p99"] else 0.0
+        regression = throughput < -threshold or p99 > threshold
+        ok = ok and not regression
+        print("%-12s throughput %+6.1f %%  p99 %+6.1f %%%s" % \
+              (name, throughput*100, p99*100, "  REGRESSION" if regression else ""))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="RPP benchmarks")
+    parser.add_argument("benchmark", choices=["frontends", "validation", "encoding", "metrics", "load", "compare"])
+    parser.add_argument("results", nargs="*", help="For compare, the two JSON files")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--database", default=registry.DATABASE)
+    parser.add_argument("--storage", choices=["postgresql", "memory"], default=registry.STORAGE,
+                        help="For the in-process benchmarks")
+    parser.add_argument("--logfile", default="/dev/null")
+    parser.add_argument("--url", help="For load, the server to test, instead of in-process")
+    parser.add_argument("--mix", type=parse_mix, default=MIX,
+                        help="For load, weights of the operations, for instance availability=90,info=10")
+    parser.add_argument("--warmup", type=int, default=200,
+                        help="For load, requests which are not measured")
+    parser.add_argument("--output", help="For load, JSON file of the results")
+    parser.add_argument("--keep", action="store_true",
+                        help="For load, do not delete the domains created")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="For compare, the largest acceptable degradation")
+    args = parser.parse_args()
+    if args.benchmark == "compare":
+        if len(args.results) != 2:
+            parser.error("compare needs two JSON files")
+        (old, new) = [json.load(open(filename)) for filename in args.results]
+        sys.exit(0 if compare(old, new, args.threshold) else 1)
+    registry.create_app(storage=args.storage, database=args.database, logfile=args.logfile,
+                        max_connections=args.concurrency)
+    if args.benchmark == "frontends":
+        bench_wsgi(args.requests, args.concurrency)
+        asyncio.run(bench_asgi(args.requests, args.concurrency))
+    elif args.benchmark == "validation":
+        bench_validation(args.requests)
+    elif args.benchmark == "encoding":
+        bench_encoding(args.requests)
+    elif args.benchmark == "metrics":
+        bench_metrics(args.requests, args.concurrency)
+    elif args.benchmark == "load":
+        send = inprocess_client() if args.url is None else http_client(args.url)
+        try:
+            result = bench_load(send, args.mix, args.requests, args.concurrency, args.warmup)
+        finally:
+            if not args.keep and args.storage == "postgresql":
+                cleanup(args.database)
+        result.update({"benchmark": "load", "commit": commit(),
+                       "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                       "url": args.url, "storage": args.storage, "requests": args.requests,
+                       "concurrency": args.concurrency, "mix": args.mix})
+        if args.output is not None:
+            with open(args.output, "w") as OUTPUT:
+                json.dump(result, OUTPUT, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+""" Loads many contacts or domains at once, for instance to seed a
+staging registry or to migrate from another system, much faster than
+a PUT per object. The input (NDJSON or CSV) is read in batches; each
+batch is validated with the schemas and the rules of the server,
+copied (COPY) into a temporary table, then merged into Contacts or
+Domains with a few statements, in one transaction. The rejected
+records are reported and do not stop the load.
+
+NDJSON: one object per line, like the body of a PUT, with a member
+handle for the contacts (their handle in the system they come from,
+optional) and name and registrar (optional, default --registrar) for
+the domains. CSV, with a header: handle,given,surname for the
+contacts, name,holder,tech,admin[,registrar] for the domains.
+
+The contacts of the domains are the handles of the contacts file,
+when they were loaded by this program (table ImportedContacts),
+otherwise the handles of the registry. So load the contacts first.
+
+The batches are processed by --jobs processes in parallel. The
+merges themselves wait for each other, since every insertion updates
+the counters (see create.sql). The limits of the server (MAX_DOMAINS,
+MAX_CONTACTS, quotas) are not checked. """
+
+import argparse
+import concurrent.futures
+import csv
+import io
+import json
+import sys
+
+# https://pypi.org/project/psycopg2/
+import psycopg2
+
+# https://python-jsonschema.readthedocs.io https://pypi.org/project/jsonschema/
+import jsonschema
+
+import registry
+import validation
+
+BATCH = 10000
+# Times a batch of contacts is tried again when another process
+# imported the same handle at the same time. Then, its records are
+# rejected.
+RETRIES = 3
+
+STAGING = {"contacts": "CREATE TEMPORARY TABLE Staging (line INTEGER NOT NULL, source BIGINT, name TEXT NOT NULL, handle INTEGER)",
+           "domains": "CREATE TEMPORARY TABLE Staging (line INTEGER NOT NULL, name TEXT NOT NULL, holder BIGINT NOT NULL, tech BIGINT NOT NULL, admin BIGINT NOT NULL, registrar INTEGER NOT NULL)"}
+COLUMNS = {"contacts": "line, source, name",
+           "domains": "line, name, holder, tech, admin, registrar"}
+
+# The first record of each handle gets a handle in the registry, the
+# others are rejected.
+MERGE_CONTACTS = ["""UPDATE Staging SET handle = nextval(pg_get_serial_sequence('contacts', 'handle'))
+                        WHERE source IS NULL OR
+                           (NOT EXISTS (SELECT 1 FROM ImportedContacts WHERE ImportedContacts.source = Staging.source) AND
+                            line IN (SELECT min(line) FROM Staging GROUP BY source))""",
+                  "INSERT INTO Contacts (handle, name) SELECT handle, name FROM Staging WHERE handle IS NOT NULL",
+                  """INSERT INTO ImportedContacts (source, handle)
+                        SELECT source, handle FROM Staging WHERE handle IS NOT NULL AND source IS NOT NULL"""]
+REJECTED_CONTACTS = "SELECT line, source FROM Staging WHERE handle IS NULL"
+
+# Returns the records which were not inserted, with what is missing
+MERGE_DOMAINS = """WITH Resolved AS
+  (SELECT line, Staging.name, Staging.holder AS holder_given, Staging.tech AS tech_given,
+          Staging.admin AS admin_given, Staging.registrar AS registrar_given,
+          COALESCE(IH.handle, CH.handle) AS holder, COALESCE(IT.handle, CT.handle) AS tech,
+          COALESCE(IA.handle, CA.handle) AS admin, Registrars.handle AS registrar
+     FROM Staging
+     LEFT JOIN ImportedContacts IH ON IH.source = Staging.holder LEFT JOIN Contacts CH ON CH.handle = Staging.holder
+     LEFT JOIN ImportedContacts IT ON IT.source = Staging.tech LEFT JOIN Contacts CT ON CT.handle = Staging.tech
+     LEFT JOIN ImportedContacts IA ON IA.source = Staging.admin LEFT JOIN Contacts CA ON CA.handle = Staging.admin
+     LEFT JOIN Registrars ON Registrars.handle = Staging.registrar),
+ Inserted AS
+  (INSERT INTO Domains (name, holder, tech, admin, registrar)
+     SELECT name, holder, tech, admin, registrar FROM Resolved
+       WHERE holder IS NOT NULL AND tech IS NOT NULL AND admin IS NOT NULL AND registrar IS NOT NULL
+       ORDER BY name -- Same order in all the processes, against deadlocks
+     ON CONFLICT (name) DO NOTHING
+     RETURNING name)
+SELECT line, name, holder IS NULL, holder_given, tech IS NULL, tech_given,
+       admin IS NULL, admin_given, registrar IS NULL, registrar_given
+  FROM Resolved WHERE name NOT IN (SELECT name FROM Inserted)"""
+
+class Rejected(Exception):
+    pass
+
+def parse_contact(record):
+    """ Returns the handle (or None) and the name """
+    if isinstance(record, str):
+        try:
+            data = json.loads(record)
+        except json.decoder.JSONDecodeError:
+            raise Rejected("Invalid JSON")
+    else:
+        components = []
+        if record.get("given"):
+            components.append({"kind": "given", "value": record["given"]})
+        if record.get("surname"):
+            components.append({"kind": "surname", "value": record["surname"]})
+        data = {"@type": "Card", "name": {"components": components}}
+        if record.get("handle"):
+            data["handle"] = record["handle"]
+    try:
+        registry.validators.validate(data, "contact", "put")
+    except jsonschema.exceptions.ValidationError as e:
+        raise Rejected("Invalid contact (%s)" % e.message)
+    name = registry.contact_name(data)
+    if name is None:
+        raise Rejected("No surname")
+    source = data.get("handle")
+    if source is not None:
+        try:
+            source = int(source)
+        except (TypeError, ValueError):
+            raise Rejected("Invalid handle %s" % source)
+    return source, name
+
+def parse_domain(record, registrar):
+    """ Returns the name, the contacts and the registrar """
+    if isinstance(record, str):
+        try:
+            data = json.loads(record)
+        except json.decoder.JSONDecodeError:
+            raise Rejected("Invalid JSON")
+    else:
+        data = dict(record)
+        for member in ("holder", "tech", "admin", "registrar"):
+            if data.get(member):
+                try:
+                    data[member] = int(data[member])
+                except ValueError:
+                    pass # The validation will say it
+    if not isinstance(data, dict) or not isinstance(data.get("name"), str):
+        raise Rejected("No name")
+    try:
+        registry.validators.validate(data, "domain", "put")
+    except jsonschema.exceptions.ValidationError as e:
+        raise Rejected("Invalid domain (%s)" % e.message)
+    domain = data["name"].lower()
+    if not domain.endswith(".%s" % registry.TLD) or "/" in domain:
+        raise Rejected("Domain name must be under .%s" % registry.TLD)
+    result = registry.registerable(domain)
+    if not result[0]:
+        raise Rejected(result[1])
+    registrar = data.get("registrar") or registrar
+    if not isinstance(registrar, int):
+        raise Rejected("No registrar")
+    return domain, data["holder"], data["tech"], data["admin"], registrar
+
+def start(database, kind, registrar):
+    """ In each process of the pool """
+    global connection, settings
+    registry.validators = validation.Registry(registry.config["schemas"])
+    connection = psycopg2.connect(database)
+    with connection.cursor() as cursor:
+        cursor.execute(STAGING[kind])
+    connection.commit()
+    settings = (kind, registrar)
+
+def load(batch):
+    """ batch is a list of (line number, record). Returns the number of
+    objects created and the list of (line number, reason) of the
+    rejected records. """
+    (kind, registrar) = settings
+    rejected = []
+    rows = []
+    names = set()
+    for (line, record) in batch:
+        try:
+            if kind == "contacts":
+                rows.append((line,) + parse_contact(record))
+            else:
+                row = parse_domain(record, registrar)
+                if row[0] in names:
+                    raise Rejected("%s is already earlier in the batch" % row[0])
+                names.add(row[0])
+                rows.append((line,) + row)
+        except Rejected as e:
+            rejected.append((line, str(e)))
+    data = io.StringIO()
+    csv.writer(data).writerows(rows)
+    for attempt in range(RETRIES):
+        data.seek(0)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("TRUNCATE Staging")
+                cursor.copy_expert("COPY Staging (%s) FROM STDIN WITH (FORMAT csv)" % COLUMNS[kind], data)
+                if kind == "contacts":
+                    for statement in MERGE_CONTACTS:
+                        cursor.execute(statement)
+                    cursor.execute(REJECTED_CONTACTS)
+                    merged = [(line, "Contact %i already imported" % source)
+                              for (line, source) in cursor.fetchall()]
+                else:
+                    cursor.execute(MERGE_DOMAINS)
+                    merged = [(row[0], reason(row)) for row in cursor.fetchall()]
+            connection.commit()
+            break
+        except psycopg2.IntegrityError as e:
+            connection.rollback()
+            if attempt == RETRIES - 1:
+                # Still conflicting: the whole batch is rejected, the
+                # load goes on with the next ones
+                error = "Batch not loaded (%s)" % str(e).strip().splitlines()[0]
+                return 0, sorted(rejected + [(row[0], error) for row in rows])
+    return len(rows) - len(merged), sorted(rejected + merged)
+
+def reason(row):
+    (line, name, no_holder, holder, no_tech, tech, no_admin, admin, no_registrar, registrar) = row
+    missing = ["%s %i" % (role, handle) for (role, absent, handle) in
+               (("holder", no_holder, holder), ("tech", no_tech, tech), ("admin", no_admin, admin))
+               if absent]
+    if no_registrar:
+        missing.append("registrar %i" % registrar)
+    if missing:
+        return "Unknown %s" % ", ".join(missing)
+    return "%s already exists" % name
+
+def records(input, format):
+    """ (line number, record) of the input """
+    if format == "csv":
+        reader = csv.DictReader(input)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for (number, line) in enumerate(input, start=1):
+            if line.strip():
+                yield number, line
+
+def batches(iterator, size):
+    batch = []
+    for record in iterator:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def finished(future, report):
+    """ Reports the rejected records of a batch, returns the numbers
+    of loaded and rejected records """
+    (count, rejects) = future.result()
+    for (line, why) in rejects:
+        print(json.dumps({"line": line, "reason": why}), file=report)
+    return count, len(rejects)
+
+def main():
+    parser = argparse.ArgumentParser(description="Loads contacts or domains in bulk")
+    parser.add_argument("kind", choices=["contacts", "domains"])
+    parser.add_argument("filename", help="NDJSON or CSV file, - for the standard input")
+    parser.add_argument("--format", choices=["ndjson", "csv"],
+                        help="Default: csv if the file name ends with .csv, ndjson otherwise")
+    parser.add_argument("--database", default=registry.DATABASE)
+    parser.add_argument("--registrar", type=int,
+                        help="Registrar of the domains which do not have one")
+    parser.add_argument("--batch", type=int, default=BATCH, help="Records per transaction")
+    parser.add_argument("--jobs", type=int, default=4, help="Processes loading batches in parallel")
+    parser.add_argument("--rejected", help="File of the rejected records (one JSON object per line), default the standard error")
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = "csv" if args.filename.endswith(".csv") else "ndjson"
+    input = sys.stdin if args.filename == "-" else open(args.filename, newline="")
+    report = sys.stderr if args.rejected is None else open(args.rejected, "w")
+    (loaded, rejected) = (0, 0)
+    with concurrent.futures.ProcessPoolExecutor(args.jobs, initializer=start,
+                                                initargs=(args.database, args.kind, args.registrar)) as executor:
+        pending = set()
+        for batch in batches(records(input, args.format), args.batch):
+            # Do not read the whole input in advance
+            while len(pending) >= 2*args.jobs:
+                (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (count, rejects) = finished(future, report)
+                    (loaded, rejected) = (loaded + count, rejected + rejects)
+            pending.add(executor.submit(load, batch))
+        for future in concurrent.futures.as_completed(pending):
+            (count, rejects) = finished(future, report)
+            (loaded, rejected) = (loaded + count, rejected + rejects)
+    print("%i %s loaded, %i rejected" % (loaded, args.kind, rejected))
+
+if __name__ == "__main__":
+    main()
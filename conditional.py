@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+""" Conditional requests (RFC 9110, section 13) on the domains and the
+contacts. Their validators come from the column updated (see
+create.sql): the strong ETag is its value in microseconds since the
+epoch, Last-Modified is the same date, in seconds.
+
+The validators already seen are kept in a cache, so a client polling
+an object which did not change gets its 304 without the database. The
+cache is invalidated by the notifications of the triggers. """
+
+import collections
+import datetime
+import email.utils
+import threading
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def version(updated):
+    """ Same as floor(extract(epoch FROM updated)*1000000) in SQL """
+    return (updated - EPOCH) // datetime.timedelta(microseconds=1)
+
+def etag(updated):
+    return '"%i"' % version(updated)
+
+def last_modified(updated):
+    return email.utils.format_datetime(updated.astimezone(datetime.timezone.utc), usegmt=True)
+
+def tags(header):
+    """ The entity tags of an If-Match or If-None-Match header, with
+    their W/ if they are weak. "*" is returned as is. """
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+def not_modified(conditions, updated):
+    """ conditions is the dictionary built by registry.handle_request.
+    If-None-Match, when present, takes precedence over
+    If-Modified-Since. """
+    if conditions.get("if_none_match") is not None:
+        current = etag(updated)
+        for tag in tags(conditions["if_none_match"]):
+            # Weak comparison
+            if tag == "*" or tag.removeprefix("W/") == current:
+                return True
+        return False
+    if conditions.get("if_modified_since") is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(conditions["if_modified_since"])
+        except (TypeError, ValueError):
+            return False # An invalid date is ignored
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return updated.replace(microsecond=0) <= since
+    return False
+
+def versions(header):
+    """ For If-Match: the versions to compare with, or None for "*".
+    Weak tags never match (strong comparison), so they are left out
+    and an If-Match with only weak tags fails. """
+    result = []
+    for tag in tags(header):
+        if tag == "*":
+            return None
+        if tag.startswith('"') and tag.endswith('"') and tag[1:-1].isdigit():
+            result.append(int(tag[1:-1]))
+    return result
+
+class Cache:
+    """ (kind, key) -> value, kind is "domain" or "contact". The keys
+    are strings, as in the notifications. A LRU, invalidated by this
+    process when it changes an object and by the notifications of the
+    triggers. Here, the values are the dates of the column updated,
+    objects.Cache keeps the rows. """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Incremented at each invalidation, to detect a change while
+        # we were reading the database
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kind, key):
+        with self.lock:
+            value = self.entries.get((kind, key))
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((kind, key))
+            self.hits += 1
+            return value
+
+    def add(self, kind, key, value, generation):
+        """ generation is the value of self.generation before value
+        was read from the database. """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[(kind, key)] = value
+            self.entries.move_to_end((kind, key))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, kind, key):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop((kind, key), None)
+
+    def notified(self, payload):
+        """ payload is "domain name" or "contact handle", None means
+        that notifications may have been lost. """
+        with self.lock:
+            self.generation += 1
+            if payload is None:
+                self.entries.clear()
+                return
+            (kind, key) = payload.split(" ", maxsplit=1)
+            self.entries.pop((kind, key), None)
@@ -1,34 +1,358 @@
 DROP TABLE Transfers;
+DROP TABLE Replays;
+DROP SEQUENCE transaction_ids;
+DROP TABLE ImportedContacts;
+DROP TABLE Changes;
+DROP TABLE PendingChanges;
+DROP TABLE ChangesToNumber;
+DROP TABLE Quotas;
+DROP TABLE Counters;
 DROP TABLE Domains;
 DROP TABLE Contacts;
 DROP TABLE Registrars;
+DROP FUNCTION notify_registrar;
+DROP FUNCTION notify_domain;
+DROP FUNCTION count_transferred_domains;
+DROP FUNCTION count_inserted_domains;
+DROP FUNCTION count_deleted_domains;
+DROP FUNCTION count_contacts;
+DROP FUNCTION log_changes;
+DROP FUNCTION number_changes;
+DROP FUNCTION touch;
+DROP FUNCTION notify_change;
+DROP FUNCTION search_contacts_fuzzy;
 
 CREATE TABLE Contacts (handle SERIAL UNIQUE NOT NULL, name TEXT NOT NULL,
-                       created TIMESTAMP NOT NULL DEFAULT current_timestamp);
+                       created TIMESTAMP NOT NULL DEFAULT current_timestamp,
+                       -- The validators of the conditional requests,
+                       -- see conditional.py
+                       updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp());
+
+-- clock_timestamp() and not current_timestamp, so two updates in the
+-- same transaction give two different ETags.
+CREATE FUNCTION touch() RETURNS trigger AS $$
+BEGIN
+    NEW.updated = clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER contact_touched BEFORE UPDATE ON Contacts
+    FOR EACH ROW EXECUTE FUNCTION touch();
+
+-- The search by name (see queries.py). The "C" collation, so a
+-- prefix is a range of the index, whatever the locale of the database.
+CREATE INDEX contacts_names ON Contacts ((lower(name) COLLATE "C"), handle);
+
+-- The fuzzy search needs the trigrams of the extension pg_trgm
+-- (package postgresql-contrib). Without it, the rest works.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX contacts_trigrams ON Contacts USING GIST (lower(name) gist_trgm_ops);
+
+-- The closest names first (<-> is 1 - similarity), those under
+-- pg_trgm.similarity_threshold (0.3 by default) are not returned.
+-- PL/pgSQL checks the query at the first call only.
+CREATE FUNCTION search_contacts_fuzzy(pattern TEXT, after REAL, after_handle INTEGER, size INTEGER)
+    RETURNS TABLE (handle INTEGER, name TEXT, created TIMESTAMP, distance REAL) AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY SELECT Contacts.handle, Contacts.name, Contacts.created, lower(Contacts.name) <-> pattern
+        FROM Contacts
+        WHERE lower(Contacts.name) % pattern AND
+              (lower(Contacts.name) <-> pattern, Contacts.handle) > (after, after_handle)
+        ORDER BY lower(Contacts.name) <-> pattern, Contacts.handle LIMIT size;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- The servers cache the validators, tell them when an object changes.
+CREATE FUNCTION notify_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'domains' THEN
+        PERFORM pg_notify('changes', 'domain ' || OLD.name);
+    ELSE
+        PERFORM pg_notify('changes', 'contact ' || OLD.handle::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER contact_changed AFTER UPDATE OR DELETE ON Contacts
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
 
 CREATE TABLE Registrars (name TEXT UNIQUE NOT NULL, handle SERIAL UNIQUE NOT NULL,
-                      password TEXT NOT NULL, -- TODO do not store in clear
+                      password TEXT NOT NULL, -- PBKDF2, see credentials.py
                       created TIMESTAMP NOT NULL DEFAULT current_timestamp);
 
+-- The servers cache the verified passwords, tell them when a
+-- registrar changes.
+CREATE FUNCTION notify_registrar() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('registrars', OLD.handle::text);
+    ELSE
+        PERFORM pg_notify('registrars', NEW.handle::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER registrar_changed AFTER UPDATE OF password OR DELETE ON Registrars
+    FOR EACH ROW EXECUTE FUNCTION notify_registrar();
+
 CREATE TABLE Domains (name TEXT UNIQUE NOT NULL,
                       holder INTEGER NOT NULL REFERENCES Contacts(handle),
 		      tech INTEGER NOT NULL REFERENCES Contacts(handle),
 		      admin INTEGER NOT NULL REFERENCES Contacts(handle),
 		      registrar INTEGER NOT NULL REFERENCES Registrars(handle),
-                      created TIMESTAMP NOT NULL DEFAULT current_timestamp);
+                      created TIMESTAMP NOT NULL DEFAULT current_timestamp,
+                      updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp());
+CREATE TRIGGER domain_touched BEFORE UPDATE ON Domains
+    FOR EACH ROW EXECUTE FUNCTION touch();
+CREATE TRIGGER domain_updated AFTER UPDATE OR DELETE ON Domains
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
+
+-- The servers keep a filter of the registered names (see
+-- availability.py), tell them when one is created or deleted.
+CREATE FUNCTION notify_domain() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('domains', 'DELETE ' || OLD.name);
+    ELSE
+        PERFORM pg_notify('domains', 'INSERT ' || NEW.name);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER domain_changed AFTER INSERT OR DELETE ON Domains
+    FOR EACH ROW EXECUTE FUNCTION notify_domain();
+
+-- Number of objects, so the limits (MAX_DOMAINS, MAX_CONTACTS) can be
+-- checked without count(*). Maintained by triggers.
+CREATE TABLE Counters (name TEXT UNIQUE NOT NULL,
+                       value INTEGER NOT NULL DEFAULT 0);
+INSERT INTO Counters (name) VALUES ('domains');
+INSERT INTO Counters (name) VALUES ('contacts');
+
+-- Per-registrar limits. domains is maintained by a trigger. To set a
+-- quota: INSERT INTO Quotas (registrar, max_domains) VALUES (3, 100)
+-- ON CONFLICT (registrar) DO UPDATE SET max_domains = 100;
+CREATE TABLE Quotas (registrar INTEGER UNIQUE NOT NULL REFERENCES Registrars(handle),
+                     domains INTEGER NOT NULL DEFAULT 0,
+                     max_domains INTEGER); -- NULL means no limit
+
+-- The insertions and the deletions are counted once per statement
+-- (updating the same row for each row of a large INSERT, like the
+-- ones of bulk-import.py, is very slow). The registrars are locked in
+-- the same order by everyone.
+CREATE FUNCTION count_inserted_domains() RETURNS trigger AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM Inserted) THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO Quotas (registrar, domains)
+        SELECT registrar, count(*) FROM Inserted GROUP BY registrar ORDER BY registrar
+        ON CONFLICT (registrar) DO UPDATE SET domains = Quotas.domains + EXCLUDED.domains;
+    UPDATE Counters SET value = value + (SELECT count(*) FROM Inserted) WHERE name = 'domains';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER domains_inserted AFTER INSERT ON Domains
+    REFERENCING NEW TABLE AS Inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION count_inserted_domains();
+
+CREATE FUNCTION count_deleted_domains() RETURNS trigger AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM Deleted) THEN
+        RETURN NULL;
+    END IF;
+    UPDATE Quotas SET domains = domains - Number.value
+        FROM (SELECT registrar, count(*) AS value FROM Deleted GROUP BY registrar) AS Number
+        WHERE Quotas.registrar = Number.registrar;
+    UPDATE Counters SET value = value - (SELECT count(*) FROM Deleted) WHERE name = 'domains';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER domains_deleted AFTER DELETE ON Domains
+    REFERENCING OLD TABLE AS Deleted
+    FOR EACH STATEMENT EXECUTE FUNCTION count_deleted_domains();
+
+-- The transfers, also once per statement, so a batch of them (see
+-- approve-transfers.py) changes each registrar once, in the same
+-- order as above: the losing and the gaining ones together. A
+-- transition table cannot go with UPDATE OF registrar, the other
+-- updates find no transfer. A registrar cannot gain domains beyond
+-- its quota: the creations check it themselves (see
+-- registry.store_domain), the transfers are checked here.
+CREATE FUNCTION count_transferred_domains() RETURNS trigger AS $$
+DECLARE
+    exceeded INTEGER;
+BEGIN
+    WITH Transferred AS
+        (SELECT registrar, sum(change) AS change FROM
+             (SELECT Before.registrar, -1 AS change FROM Before JOIN After ON After.name = Before.name
+                  WHERE After.registrar <> Before.registrar
+              UNION ALL
+              SELECT After.registrar, 1 FROM Before JOIN After ON After.name = Before.name
+                  WHERE After.registrar <> Before.registrar) AS Changes
+         GROUP BY registrar HAVING sum(change) <> 0),
+    Counted AS
+        (INSERT INTO Quotas (registrar, domains)
+             SELECT registrar, change FROM Transferred ORDER BY registrar
+             ON CONFLICT (registrar) DO UPDATE SET domains = Quotas.domains + EXCLUDED.domains
+             RETURNING registrar, domains, max_domains)
+    SELECT Counted.registrar INTO exceeded FROM Counted JOIN Transferred USING (registrar)
+        WHERE Transferred.change > 0 AND Counted.domains > Counted.max_domains LIMIT 1;
+    IF exceeded IS NOT NULL THEN
+        RAISE EXCEPTION 'Registrar % has too many domains already', exceeded
+            USING ERRCODE = 'check_violation';
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER domains_transferred AFTER UPDATE ON Domains
+    REFERENCING OLD TABLE AS Before NEW TABLE AS After
+    FOR EACH STATEMENT EXECUTE FUNCTION count_transferred_domains();
+
+-- The changes of the domains, for the consumers which follow them
+-- (GET /changes), with the new values. Written once per statement,
+-- in PendingChanges, and moved to Changes at commit (number_changes),
+-- the transactions one after the other, so the sequence numbers
+-- become visible in order and a consumer never skips a change
+-- committed late. Only the commits wait for each other, not the
+-- whole transactions.
+CREATE TABLE Changes (sequence BIGSERIAL PRIMARY KEY,
+                      operation TEXT NOT NULL, -- create, update, transfer, delete
+                      name TEXT NOT NULL,
+                      holder INTEGER, tech INTEGER, admin INTEGER, registrar INTEGER, -- NULL for delete
+                      at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp());
+-- The changes of the transactions not committed yet: each one only
+-- sees its own. Nothing there survives a crash, so they are not
+-- written to the WAL.
+CREATE UNLOGGED TABLE PendingChanges (operation TEXT NOT NULL, name TEXT NOT NULL,
+                                      holder INTEGER, tech INTEGER, admin INTEGER, registrar INTEGER,
+                                      at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp());
+-- The transactions which logged changes, for the trigger at commit,
+-- so it runs once per transaction
+CREATE UNLOGGED TABLE ChangesToNumber (transaction XID8 PRIMARY KEY);
+
+CREATE FUNCTION log_changes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        IF NOT EXISTS (SELECT 1 FROM Inserted) THEN
+            RETURN NULL;
+        END IF;
+        INSERT INTO PendingChanges (operation, name, holder, tech, admin, registrar)
+            SELECT 'create', name, holder, tech, admin, registrar FROM Inserted ORDER BY name;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NOT EXISTS (SELECT 1 FROM After) THEN
+            RETURN NULL;
+        END IF;
+        INSERT INTO PendingChanges (operation, name, holder, tech, admin, registrar)
+            SELECT CASE WHEN Before.registrar = After.registrar THEN 'update' ELSE 'transfer' END,
+                   After.name, After.holder, After.tech, After.admin, After.registrar
+              FROM After JOIN Before ON Before.name = After.name ORDER BY After.name;
+    ELSE
+        IF NOT EXISTS (SELECT 1 FROM Deleted) THEN
+            RETURN NULL;
+        END IF;
+        INSERT INTO PendingChanges (operation, name)
+            SELECT 'delete', name FROM Deleted ORDER BY name;
+    END IF;
+    INSERT INTO ChangesToNumber VALUES (pg_current_xact_id()) ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER domains_log_inserted AFTER INSERT ON Domains
+    REFERENCING NEW TABLE AS Inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION log_changes();
+CREATE TRIGGER domains_log_updated AFTER UPDATE ON Domains
+    REFERENCING OLD TABLE AS Before NEW TABLE AS After
+    FOR EACH STATEMENT EXECUTE FUNCTION log_changes();
+CREATE TRIGGER domains_log_deleted AFTER DELETE ON Domains
+    REFERENCING OLD TABLE AS Deleted
+    FOR EACH STATEMENT EXECUTE FUNCTION log_changes();
+
+-- Moves the changes of the transaction to Changes, just before its
+-- commit. The lock (an advisory one: LOCK TABLE Changes would wait
+-- for the writers which did not commit yet, and they for us) is
+-- released once the commit is visible, so the next transaction gets
+-- greater numbers and is seen after.
+CREATE FUNCTION number_changes() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('Changes'));
+    WITH Pending AS (DELETE FROM PendingChanges RETURNING *)
+    INSERT INTO Changes (operation, name, holder, tech, admin, registrar, at)
+        SELECT operation, name, holder, tech, admin, registrar, at FROM Pending ORDER BY at, name;
+    DELETE FROM ChangesToNumber WHERE transaction = NEW.transaction;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE CONSTRAINT TRIGGER changes_number AFTER INSERT ON ChangesToNumber
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION number_changes();
+
+CREATE FUNCTION count_contacts() RETURNS trigger AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM Changed) THEN
+        RETURN NULL;
+    ELSIF TG_OP = 'INSERT' THEN
+        UPDATE Counters SET value = value + (SELECT count(*) FROM Changed) WHERE name = 'contacts';
+    ELSE
+        UPDATE Counters SET value = value - (SELECT count(*) FROM Changed) WHERE name = 'contacts';
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER contacts_inserted AFTER INSERT ON Contacts
+    REFERENCING NEW TABLE AS Changed
+    FOR EACH STATEMENT EXECUTE FUNCTION count_contacts();
+CREATE TRIGGER contacts_deleted AFTER DELETE ON Contacts
+    REFERENCING OLD TABLE AS Changed
+    FOR EACH STATEMENT EXECUTE FUNCTION count_contacts();
 
 CREATE TABLE Transfers(id SERIAL UNIQUE NOT NULL,
                        domain TEXT NOT NULL REFERENCES Domains(name),
 		       winner INTEGER NOT NULL REFERENCES Registrars(handle),
 		       completed BOOLEAN DEFAULT false,
                        created TIMESTAMP NOT NULL DEFAULT current_timestamp);
+-- At most one pending transfer per domain. Also the index of the
+-- lookups of the pending transfer.
+CREATE UNIQUE INDEX transfers_pending ON Transfers(domain) WHERE NOT completed;
+-- For approve-transfers.py
+CREATE INDEX transfers_pending_created ON Transfers(created) WHERE NOT completed;
+-- For the foreign key, when a domain is deleted
+CREATE INDEX transfers_domain ON Transfers(domain);
+
+-- The responses to the writes, replayed when a client retries with the
+-- same cltrid (see idempotency.py). Only with replay_shared.
+CREATE TABLE Replays (registrar INTEGER NOT NULL,
+                      cltrid TEXT NOT NULL,
+                      method TEXT NOT NULL,
+                      path TEXT NOT NULL,
+                      code INTEGER NOT NULL,
+                      message TEXT NOT NULL,
+                      svtrid BIGINT NOT NULL,
+                      output TEXT NOT NULL, -- JSON
+                      -- The headers ETag and Last-Modified, if any
+                      etag TEXT,
+                      last_modified TEXT,
+                      created TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT current_timestamp,
+                      PRIMARY KEY (registrar, cltrid, method, path));
+CREATE INDEX replays_created ON Replays(created);
+
+-- The server transaction ids. Each process takes a block of
+-- TRANSACTION_IDS_BLOCK (registry.py) ids at a time.
+CREATE SEQUENCE transaction_ids INCREMENT BY 1000;
+
+-- The handles of the contacts loaded by bulk-import.py, in the system
+-- they come from, so the domains loaded afterwards can use them.
+CREATE TABLE ImportedContacts (source BIGINT PRIMARY KEY,
+                               handle INTEGER NOT NULL REFERENCES Contacts(handle) ON DELETE CASCADE);
 		       
 INSERT INTO Contacts (name) VALUES ('NIC');
 INSERT INTO Contacts (name) VALUES ('Jean Durand');
 
-INSERT INTO Registrars (name, password) VALUES ('NIC', '1234');
-INSERT INTO Registrars (name, password) VALUES ('Foo Bar', 'qwerty');
-INSERT INTO Registrars (name, password) VALUES ('Bazinga', 'bazinga');
+-- Passwords are 1234, qwerty and bazinga. Use set-password.py to change them.
+INSERT INTO Registrars (name, password) VALUES ('NIC', 'pbkdf2_sha256$600000$n3v7VcRUWn2i9+doLoMVsw==$vOXjqgy8HnAGaSNz6HhmvRs2cuK9La42KidY9XMEJao=');
+INSERT INTO Registrars (name, password) VALUES ('Foo Bar', 'pbkdf2_sha256$600000$893yqBfYZc8Jah7E+7AFzA==$4jwqoXpxPMmP95mvAzC5L60SN0YyRej8+olbSL8ncEY=');
+INSERT INTO Registrars (name, password) VALUES ('Bazinga', 'pbkdf2_sha256$600000$pBapV9ARMhFSIlcsvry6qQ==$Zc1sANF11qElhYMILwm9GGNxGslBAPZgbdrtxjCOJlw=');
 
 INSERT INTO Domains (name, holder, tech, admin, registrar)
     VALUES ('nic.example', (SELECT handle FROM Contacts WHERE name = 'NIC'),
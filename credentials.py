@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+""" Passwords of the registrars. They are stored hashed with PBKDF2,
+which is deliberately slow, so the credentials already verified are
+kept in a cache for a while. The wrong ones are kept too, for a
+shorter time, and each registrar has, from each client address, a
+budget of verifications which may fail (a token bucket, given back
+when the password is right), so a client sending bad passwords cannot
+make us run PBKDF2 for nothing again and again. The budget is not
+only per registrar, or anyone could use it up and lock the registrar
+out. The passwords of a registrar are verified one at a time: its
+other requests wait, then find the result in the cache. """
+
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 600000
+# Verifications of a registrar, from one address, which may fail:
+# [rate (per second), burst]
+FAILURES = (0.2, 5)
+# Seconds during which a wrong password is answered without PBKDF2
+FAILURE_TTL = 60
+
+def hash_password(password, iterations=ITERATIONS, salt=None):
+    if salt is None:
+        salt = os.urandom(16)
+    key = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return "%s$%i$%s$%s" % (ALGORITHM, iterations,
+                            base64.b64encode(salt).decode(),
+                            base64.b64encode(key).decode())
+
+def verify_password(password, stored):
+    if password is None or stored is None:
+        return False
+    if not stored.startswith(ALGORITHM + "$"):
+        # Old database, with passwords in clear
+        return hmac.compare_digest(password.encode(), stored.encode())
+    (algorithm, iterations, salt, key) = stored.split("$")
+    computed = hashlib.pbkdf2_hmac("sha256", password.encode(),
+                                   base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(computed, base64.b64decode(key))
+
+class Cache:
+    """ handle -> digest of the last password verified for this
+    registrar. The digest uses a random key of this process, the
+    passwords themselves are not kept. """
+
+    def __init__(self, size=10000, ttl=300, failures=FAILURES, failure_ttl=FAILURE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        # (handle, digest) -> expiry, the wrong passwords
+        self.rejected = collections.OrderedDict()
+        (self.rate, self.burst) = failures
+        self.failure_ttl = failure_ttl
+        # (handle, client address) -> [tokens, time of the last update]
+        self.budgets = collections.OrderedDict()
+        # handle -> [lock, number of threads using it], the
+        # verifications running
+        self.verifying = {}
+        self.lock = threading.Lock()
+        self.secret = os.urandom(32)
+        # Incremented at each invalidation, to detect a password
+        # change while we were verifying the old one.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def digest(self, password):
+        return hmac.new(self.secret, password.encode(), "sha256").digest()
+
+    def check(self, handle, password):
+        if password is None:
+            return False
+        digest = self.digest(password)
+        with self.lock:
+            entry = self.entries.get(handle)
+            if entry is not None and entry[1] > time.monotonic() and \
+               hmac.compare_digest(entry[0], digest):
+                self.entries.move_to_end(handle)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def budget(self, key, now):
+        """ To call with the lock, key is (handle, address) """
+        budget = self.budgets.get(key)
+        if budget is None:
+            budget = self.budgets[key] = [self.burst, now]
+        budget[0] = min(self.burst, budget[0] + (now - budget[1])*self.rate)
+        budget[1] = now
+        self.budgets.move_to_end(key)
+        while len(self.budgets) > self.size:
+            self.budgets.popitem(last=False)
+        return budget
+
+    def throttled(self, handle, password, address=None):
+        """ 0 if the password may be verified now (or is already known
+        to be right), otherwise the seconds to wait. address is the one
+        of the client. """
+        digest = None if password is None else self.digest(password)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(handle)
+            if digest is not None and entry is not None and entry[1] > now and \
+               hmac.compare_digest(entry[0], digest):
+                return 0
+            budget = self.budget((handle, address), now)
+            if budget[0] >= 1:
+                return 0
+            return (1 - budget[0])/self.rate
+
+    def attempt(self, handle, password, address=None):
+        """ To call before verifying a password which is not in the
+        cache. Takes a token of the registrar and the address, False if
+        there was none or if the password was recently found wrong:
+        then, it is wrong, without verifying it. """
+        digest = self.digest(password)
+        now = time.monotonic()
+        with self.lock:
+            budget = self.budget((handle, address), now)
+            if budget[0] < 1:
+                self.failures += 1
+                return False
+            budget[0] -= 1
+            expiry = self.rejected.get((handle, digest))
+            if expiry is not None and expiry > now:
+                self.failures += 1
+                return False
+            return True
+
+    def verify(self, handle, password, stored, generation, address=None):
+        """ verify_password, with the cache and the budget of handle
+        and address, for the passwords which were not found by
+        check. generation is the value of self.generation before stored
+        was read from the database. Blocks while another password of
+        handle is being verified. """
+        with self.lock:
+            entry = self.verifying.setdefault(handle, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if self.check(handle, password):
+                    return True
+                if not self.attempt(handle, password, address):
+                    return False
+                if verify_password(password, stored):
+                    self.add(handle, password, generation, address)
+                    return True
+                self.reject(handle, password, generation)
+                return False
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.verifying[handle]
+
+    def reject(self, handle, password, generation):
+        """ The password was verified and is wrong """
+        digest = self.digest(password)
+        with self.lock:
+            self.failures += 1
+            if generation != self.generation:
+                return
+            self.rejected[(handle, digest)] = time.monotonic() + self.failure_ttl
+            self.rejected.move_to_end((handle, digest))
+            while len(self.rejected) > self.size:
+                self.rejected.popitem(last=False)
+
+    def add(self, handle, password, generation, address=None):
+        """ generation is the value of self.generation before the
+        password was read from the database. The token taken by
+        attempt is given back. """
+        digest = self.digest(password)
+        with self.lock:
+            budget = self.budgets.get((handle, address))
+            if budget is not None:
+                budget[0] = min(self.burst, budget[0] + 1)
+            if generation != self.generation:
+                return
+            self.entries[handle] = (digest, time.monotonic() + self.ttl)
+            self.entries.move_to_end(handle)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, handle=None):
+        """ Without a handle, forget everything """
+        with self.lock:
+            self.generation += 1
+            if handle is None:
+                self.entries.clear()
+                self.rejected.clear()
+            else:
+                self.entries.pop(handle, None)
+                for key in [key for key in self.rejected if key[0] == handle]:
+                    del self.rejected[key]
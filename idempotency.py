@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+""" Retries of the writes. A client which timed out and sends again
+the same request with the same RPP-Cltrid gets the response of the
+first one (same status, body and svtrid) instead of running it again
+(and getting, for instance, a 412 because the domain now exists).
+
+The responses are kept in memory, in each process, for a time
+window. With 'replay_shared', they are also stored in PostgreSQL
+(table Replays), so a retry handled by another worker is recognized,
+too. A retry which arrives while the first request is still running
+is not recognized.
+
+Also, the server transaction ids (svtrid): they increase and they are
+unique among all the processes, which take blocks of ids from a
+PostgreSQL sequence. """
+
+import collections
+import threading
+import time
+
+# Methods whose responses are replayed
+METHODS = ("PUT", "PATCH", "POST", "DELETE")
+
+class Cache:
+    """ (registrar, cltrid, method, path) -> (status, output) """
+
+    def __init__(self, size=10000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] <= time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def add(self, key, status, output):
+        with self.lock:
+            self.entries[key] = (status, output, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+def kept(status, output):
+    """ What is replayed: the first response, except if it asked the
+    client to try again (503, 500 "Conflict", 429) or to
+    authenticate. The status keeps the members which become headers
+    (the validators of a PATCH, too). The copies are not changed by the
+    front ends. """
+    if status["code"] >= 500 or status["code"] in (401, 429) or not isinstance(output, dict):
+        return None
+    return ({name: status[name] for name in ("code", "message", "svtrid", "cltrid",
+                                              "etag", "last_modified") if name in status},
+            dict(output))
+
+class TransactionIds:
+    """ Hands out the ids of a block, the caller gets a new block (see
+    refill) when they are exhausted. """
+
+    def __init__(self, block):
+        self.block = block
+        self.next = 0
+        self.limit = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ None if a new block is needed """
+        with self.lock:
+            if self.next >= self.limit:
+                return None
+            self.next += 1
+            return self.next - 1
+
+    def refill(self, start):
+        """ start is the first id of a new block. The blocks of the
+        sequence do not overlap, so an older one (another request
+        refilled meanwhile) is below limit and is ignored, so the ids
+        still increase. """
+        with self.lock:
+            if start >= self.limit:
+                (self.next, self.limit) = (start, start + self.block)
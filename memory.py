@@ -0,0 +1,587 @@
+#!/usr/bin/python3
+
+""" A storage backend which keeps the registry in memory, for test
+and staging instances and to benchmark the HTTP and validation layers
+without PostgreSQL. Nothing is persistent and each process has its
+own data, so use it with one worker.
+
+Database has the same interface as registry.Database: it runs the
+statements of the query catalog (queries.py) by name, with the same
+results as PostgreSQL, including the constraints and the triggers of
+create.sql. Each statement is atomic. A write locks the store until
+commit or rollback, and rollback undoes the writes of the
+transaction. The methods never suspend, so with the ASGI front end,
+a transaction does not let other requests run in the middle. """
+
+import bisect
+import csv
+import datetime
+import io
+import json
+import threading
+import time
+import types
+
+import conditional
+
+class Error(Exception):
+    pass
+class UniqueViolation(Error):
+    pass
+class ForeignKeyViolation(Error):
+    pass
+class SerializationFailure(Error):
+    pass
+class InvalidTextRepresentation(Error):
+    pass
+class UndefinedFunction(Error):
+    pass
+class CheckViolation(Error):
+    pass
+
+# Same data as create.sql
+SEED_CONTACTS = ["NIC", "Jean Durand"]
+SEED_REGISTRARS = [("NIC", "pbkdf2_sha256$600000$n3v7VcRUWn2i9+doLoMVsw==$vOXjqgy8HnAGaSNz6HhmvRs2cuK9La42KidY9XMEJao="),
+                   ("Foo Bar", "pbkdf2_sha256$600000$893yqBfYZc8Jah7E+7AFzA==$4jwqoXpxPMmP95mvAzC5L60SN0YyRej8+olbSL8ncEY="),
+                   ("Bazinga", "pbkdf2_sha256$600000$pBapV9ARMhFSIlcsvry6qQ==$Zc1sANF11qElhYMILwm9GGNxGslBAPZgbdrtxjCOJlw=")]
+SEED_DOMAINS = [("nic.example", 1, 1), ("foobar.example", 2, 2)] # name, contact, registrar
+
+# Size of the pieces of the exports, same as registry.COPY_CHUNK
+COPY_CHUNK = 65536
+
+# Same as pg_trgm.similarity_threshold
+SIMILARITY_THRESHOLD = 0.3
+
+# Same as the sequence transaction_ids
+TRANSACTION_IDS_INCREMENT = 1000
+
+# Indexes of the fields of a domain
+HOLDER, TECH, ADMIN, REGISTRAR, CREATED, UPDATED = range(6)
+
+class Store:
+    """ The data. Keys are the primary keys of the tables. """
+
+    def __init__(self, seed=True):
+        self.lock = threading.RLock()
+        self.domains = {} # name -> [holder, tech, admin, registrar, created, updated]
+        self.names = [] # The names of the domains, sorted, for the lists
+        self.contacts = {} # handle -> [name, created, updated]
+        self.registrars = {} # handle -> [name, password]
+        self.transfers = {} # id -> [domain, winner, completed, created]
+        self.pending = {} # domain -> id of its pending transfer
+        # Same as the tables Counters and Quotas
+        self.counters = {"domains": 0, "contacts": 0}
+        self.quotas = {} # registrar -> [domains, max_domains]
+        self.replays = {} # (registrar, cltrid, method, path) -> (code, message, svtrid, output, etag, last_modified, time)
+        # Same as the table Changes, in the order of the sequence
+        self.changes = [] # (sequence, operation, name, holder, tech, admin, registrar, at)
+        self.sequences = {"contacts": 0, "registrars": 0, "transfers": 0, "transaction_ids": 0,
+                          "changes": 0}
+        if seed:
+            self.seed()
+
+    def seed(self):
+        database = Database(self)
+        for name in SEED_CONTACTS:
+            database.statement("store_contact", {"name": name})
+        for (name, password) in SEED_REGISTRARS:
+            database.insert_registrar(name, password)
+        for (name, contact, registrar) in SEED_DOMAINS:
+            database.statement("store_domain", {"domain": name, "holder": contact, "tech": contact,
+                                                "admin": contact, "registrar": registrar})
+        database.finish()
+
+    def next(self, sequence):
+        self.sequences[sequence] += 1
+        return self.sequences[sequence]
+
+def clock():
+    """ For the column updated, like clock_timestamp() """
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def trigrams(text):
+    """ Like pg_trgm: the words are the alphanumeric characters, each
+    one with two spaces before and one after """
+    result = set()
+    word = []
+    for character in text + " ":
+        if character.isalnum():
+            word.append(character)
+        elif word:
+            padded = "  %s " % "".join(word)
+            result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+            word = []
+    return result
+
+def distance(text, pattern):
+    """ The <-> of pg_trgm, 1 - similarity """
+    (a, b) = (trigrams(text), trigrams(pattern))
+    if not a or not b:
+        return 1.0
+    return 1.0 - len(a & b)/len(a | b)
+
+def integer(value):
+    """ PostgreSQL converts the text of the parameters """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidTextRepresentation("invalid input syntax for type integer: %r" % value)
+
+class Database:
+    """ The database of one request, see registry.Database """
+    errors = types.SimpleNamespace(Error=Error, UniqueViolation=UniqueViolation,
+                                   ForeignKeyViolation=ForeignKeyViolation,
+                                   SerializationFailure=SerializationFailure,
+                                   InvalidTextRepresentation=InvalidTextRepresentation,
+                                   UndefinedFunction=UndefinedFunction,
+                                   CheckViolation=CheckViolation)
+
+    def __init__(self, store):
+        self.store = store
+        self.undo = None # None when there is no transaction
+        self.round_trips = 0
+        self.db_time = 0.0
+
+    async def execute(self, name, args=None):
+        return self.statement(name, args)[0]
+
+    async def fetchone(self, name, args=None):
+        rows = self.statement(name, args)[1]
+        return rows[0] if rows else None
+
+    async def fetchall(self, name, args=None):
+        return self.statement(name, args)[1]
+
+    async def commit(self):
+        self.finish()
+
+    async def rollback(self):
+        if self.undo is not None:
+            for function in reversed(self.undo):
+                function()
+        self.finish()
+
+    async def run_blocking(self, function, *args):
+        return function(*args)
+
+    async def explain(self, name, args=None):
+        """ No plans here, see tracing.py """
+        return None
+
+    async def stream(self, name, args=None, size=1000):
+        """ Only for list_domains. Each batch is read separately, like a
+        cursor in READ COMMITTED. """
+        if name != "list_domains":
+            raise NotImplementedError(name)
+        after = args["after"]
+        while True:
+            with self.store.lock:
+                start = bisect.bisect_right(self.store.names, after)
+                rows = [(name,) for name in self.store.names[start:start + size]]
+            if not rows:
+                break
+            yield rows
+            after = rows[-1][0]
+
+    async def copy(self, name):
+        """ The exports of queries.COPIES. The domains are read at once,
+        like in the snapshot of the COPY. """
+        with self.store.lock:
+            rows = [(domain,) + tuple(self.store.domains[domain]) for domain in self.store.names]
+        if name not in ("export_domains_csv", "export_domains_ndjson"):
+            raise NotImplementedError(name)
+        columns = ("name", "holder", "tech", "admin", "registrar", "created", "updated")
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        if name == "export_domains_csv":
+            writer.writerow(columns)
+        for row in rows:
+            if name == "export_domains_csv":
+                writer.writerow(row)
+            else:
+                output.write(json.dumps(dict(zip(columns, row[:CREATED + 1]),
+                                             created=row[CREATED + 1].isoformat(),
+                                             updated=row[UPDATED + 1].isoformat())) + "\n")
+            if output.tell() >= COPY_CHUNK:
+                yield output.getvalue().encode()
+                output.seek(0)
+                output.truncate()
+        if output.tell() > 0:
+            yield output.getvalue().encode()
+
+    def close(self):
+        """ What was not committed is abandoned """
+        if self.undo is not None:
+            for function in reversed(self.undo):
+                function()
+            self.finish()
+
+    def finish(self):
+        if self.undo is not None:
+            self.undo = None
+            self.store.lock.release()
+
+    def begin(self):
+        """ Called by the statements which write """
+        if self.undo is None:
+            self.store.lock.acquire()
+            self.undo = []
+
+    def statement(self, name, args):
+        """ Returns (rowcount, rows) """
+        self.round_trips += 1
+        with self.store.lock:
+            return getattr(self, name)(**(args or {}))
+
+    # The statements of queries.py
+
+    def head_domain(self, domain):
+        if domain in self.store.domains:
+            return (1, [(domain,)])
+        return (0, [])
+
+    def info_domain(self, domain):
+        data = self.store.domains.get(domain)
+        if data is None:
+            return (0, [])
+        return (1, [(domain,) + tuple(data)])
+
+    def check_domains(self, names):
+        rows = [(name,) for name in set(names) if name in self.store.domains]
+        return (len(rows), rows)
+
+    def list_domains_page(self, after, limit):
+        start = bisect.bisect_right(self.store.names, after)
+        rows = [(name,) for name in self.store.names[start:start + limit]]
+        return (len(rows), rows)
+
+    def store_domain(self, domain, holder, tech, admin, registrar):
+        store = self.store
+        if domain in store.domains:
+            raise UniqueViolation("duplicate key value violates unique constraint \"domains_name_key\"")
+        for contact in (holder, tech, admin):
+            if integer(contact) not in store.contacts:
+                raise ForeignKeyViolation("Contact %s does not exist" % contact)
+        if integer(registrar) not in store.registrars:
+            raise ForeignKeyViolation("Registrar %s does not exist" % registrar)
+        self.begin()
+        store.domains[domain] = [integer(holder), integer(tech), integer(admin), integer(registrar),
+                                 datetime.datetime.now(), clock()]
+        bisect.insort(store.names, domain)
+        def undo():
+            del store.domains[domain]
+            store.names.pop(bisect.bisect_left(store.names, domain))
+        self.undo.append(undo)
+        self.count("domains", 1)
+        self.count_quota(integer(registrar), 1)
+        self.log("create", domain)
+        return (1, [])
+
+    def domain_limits(self, registrar):
+        quota = self.store.quotas.get(integer(registrar))
+        if quota is None:
+            return (0, [])
+        return (1, [(self.store.counters["domains"], quota[0], quota[1])])
+
+    def domain_updated(self, domain):
+        data = self.store.domains.get(domain)
+        if data is None:
+            return (0, [])
+        return (1, [(data[UPDATED],)])
+
+    def patch_domain(self, domain, holder, tech, admin, registrar, versions):
+        data = self.store.domains.get(domain)
+        if data is None or data[REGISTRAR] != integer(registrar):
+            return (0, [])
+        if versions is not None and conditional.version(data[UPDATED]) not in versions:
+            return (0, [])
+        return self.patch_domains([domain], holder, tech, admin, registrar)
+
+    def patch_domains(self, names, holder, tech, admin, registrar):
+        for contact in (holder, tech, admin):
+            if contact is not None and integer(contact) not in self.store.contacts:
+                raise ForeignKeyViolation("Contact %s does not exist" % contact)
+        rows = []
+        for domain in sorted(set(names)):
+            data = self.store.domains.get(domain)
+            if data is None or data[REGISTRAR] != integer(registrar):
+                continue
+            self.begin()
+            old = list(data)
+            for (field, contact) in ((HOLDER, holder), (TECH, tech), (ADMIN, admin)):
+                if contact is not None:
+                    data[field] = integer(contact)
+            data[UPDATED] = clock()
+            self.undo.append(lambda data=data, old=old: data.__setitem__(slice(None), old))
+            self.log("update", domain)
+            rows.append((domain,) + tuple(data))
+        return (len(rows), rows)
+
+    def domains_registrars(self, names):
+        rows = [(name, self.store.domains[name][REGISTRAR]) for name in set(names)
+                if name in self.store.domains]
+        return (len(rows), rows)
+
+    def delete_domain(self, domain):
+        store = self.store
+        data = store.domains.get(domain)
+        if data is None:
+            return (0, [])
+        if any(transfer[0] == domain for transfer in store.transfers.values()):
+            raise ForeignKeyViolation("Domain %s is still referenced from table transfers" % domain)
+        self.begin()
+        del store.domains[domain]
+        store.names.pop(bisect.bisect_left(store.names, domain))
+        def undo():
+            store.domains[domain] = data
+            bisect.insort(store.names, domain)
+        self.undo.append(undo)
+        self.count("domains", -1)
+        self.count_quota(data[REGISTRAR], -1)
+        self.log("delete", domain)
+        return (1, [])
+
+    def head_contact(self, contact):
+        data = self.store.contacts.get(integer(contact))
+        if data is None:
+            return (0, [])
+        return (1, [(data[0],)])
+
+    def info_contact(self, contact):
+        data = self.store.contacts.get(integer(contact))
+        if data is None:
+            return (0, [])
+        return (1, [tuple(data)])
+
+    def contact_updated(self, contact):
+        data = self.store.contacts.get(integer(contact))
+        if data is None:
+            return (0, [])
+        return (1, [(data[2],)])
+
+    def search_contacts(self, keep, key, after, handle, limit):
+        """ The contacts for which keep(lower-case name) is true, with
+        the key of the cursor, after (after, handle) """
+        rows = []
+        for (contact, data) in self.store.contacts.items():
+            name = data[0].lower()
+            if keep(name) and (key(name), contact) > (after, integer(handle)):
+                rows.append((contact, data[0], data[1], key(name)))
+        rows.sort(key=lambda row: (row[3], row[0]))
+        rows = rows[:integer(limit)]
+        return (len(rows), rows)
+
+    def search_contacts_exact(self, name, after, handle, limit):
+        return self.search_contacts(lambda lower: lower == name, lambda lower: lower, after, handle, limit)
+
+    def search_contacts_prefix(self, name, after, handle, limit):
+        return self.search_contacts(lambda lower: lower.startswith(name), lambda lower: lower,
+                                    after, handle, limit)
+
+    def search_contacts_fuzzy(self, name, after, handle, limit):
+        return self.search_contacts(lambda lower: 1 - distance(lower, name) >= SIMILARITY_THRESHOLD,
+                                    lambda lower: distance(lower, name), float(after), handle, limit)
+
+    def store_contact(self, name):
+        store = self.store
+        self.begin()
+        handle = store.next("contacts")
+        store.contacts[handle] = [name, datetime.datetime.now(), clock()]
+        self.undo.append(lambda: store.contacts.pop(handle))
+        self.count("contacts", 1)
+        return (1, [])
+
+    def contact_limits(self):
+        return (1, [(self.store.counters["contacts"],)])
+
+    def delete_contact(self, contact):
+        store = self.store
+        handle = integer(contact)
+        data = store.contacts.get(handle)
+        if data is None:
+            return (0, [])
+        if any(handle in domain[:REGISTRAR] for domain in store.domains.values()):
+            raise ForeignKeyViolation("Contact %s is still referenced from table domains" % handle)
+        self.begin()
+        del store.contacts[handle]
+        self.undo.append(lambda: store.contacts.__setitem__(handle, data))
+        self.count("contacts", -1)
+        return (1, [])
+
+    def registrar_password(self, handle):
+        data = self.store.registrars.get(integer(handle))
+        if data is None:
+            return (0, [])
+        return (1, [(data[1],)])
+
+    def domain_and_password(self, domain, handle):
+        data = self.store.domains.get(domain)
+        registrar = self.store.registrars.get(integer(handle)) if handle is not None else None
+        return (1, [(None if data is None else data[REGISTRAR],
+                     None if registrar is None else registrar[1])])
+
+    def transfer_state(self, domain, handle):
+        (registrar, password) = self.domain_and_password(domain, handle)[1][0]
+        transfer = self.store.transfers.get(self.store.pending.get(domain))
+        if transfer is None:
+            return (1, [(registrar, password, None, None)])
+        return (1, [(registrar, password, transfer[3], transfer[1])])
+
+    def start_transfer(self, domain, client):
+        store = self.store
+        data = store.domains.get(domain)
+        if data is None or data[REGISTRAR] == client or domain in store.pending:
+            return (0, [])
+        self.begin()
+        identifier = store.next("transfers")
+        store.transfers[identifier] = [domain, client, False, datetime.datetime.now()]
+        store.pending[domain] = identifier
+        def undo():
+            del store.transfers[identifier]
+            del store.pending[domain]
+        self.undo.append(undo)
+        return (1, [])
+
+    def cancel_transfer(self, domain, client):
+        transfer = self.store.transfers.get(self.store.pending.get(domain))
+        if transfer is None or transfer[1] != client:
+            return (0, [])
+        return self.remove_pending(domain)
+
+    def reject_transfer(self, domain, client):
+        if domain not in self.store.pending or self.store.domains[domain][REGISTRAR] != client:
+            return (0, [])
+        return self.remove_pending(domain)
+
+    def remove_pending(self, domain):
+        store = self.store
+        self.begin()
+        identifier = store.pending.pop(domain)
+        transfer = store.transfers.pop(identifier)
+        def undo():
+            store.transfers[identifier] = transfer
+            store.pending[domain] = identifier
+        self.undo.append(undo)
+        return (1, [])
+
+    def approve_transfer(self, domain, client):
+        if domain not in self.store.pending or self.store.domains[domain][REGISTRAR] != client:
+            return (0, [])
+        winner = self.store.transfers[self.store.pending[domain]][1]
+        if not self.room(winner):
+            raise CheckViolation("Registrar %s has too many domains already" % winner)
+        self.complete(domain)
+        return (1, [])
+
+    def approve_expired_transfers(self, delay, batch):
+        limit = datetime.datetime.now() - datetime.timedelta(seconds=delay)
+        expired = sorted((transfer[3], identifier, transfer[0], transfer[1])
+                         for (identifier, transfer) in self.store.transfers.items()
+                         if not transfer[2] and transfer[3] < limit and self.room(transfer[1]))[:batch]
+        approved = 0
+        for (created, identifier, domain, winner) in expired:
+            if self.room(winner):
+                self.complete(domain)
+                approved += 1
+        return (approved, [])
+
+    def room(self, registrar):
+        """ False if the registrar cannot gain a domain, see the
+        trigger of the transfers """
+        quota = self.store.quotas.get(registrar)
+        return quota is None or quota[1] is None or quota[0] < quota[1]
+
+    def complete(self, domain):
+        """ Approves the pending transfer of domain """
+        store = self.store
+        self.begin()
+        identifier = store.pending.pop(domain)
+        transfer = store.transfers[identifier]
+        data = store.domains[domain]
+        old = list(data)
+        transfer[2] = True
+        data[REGISTRAR] = transfer[1]
+        data[UPDATED] = clock()
+        def undo():
+            transfer[2] = False
+            data[:] = old
+            store.pending[domain] = identifier
+        self.undo.append(undo)
+        self.count_quota(old[REGISTRAR], -1)
+        self.count_quota(transfer[1], 1)
+        self.log("transfer", domain)
+
+    def log(self, operation, domain):
+        """ Like the triggers of the table Changes. The store is locked
+        until the commit, so the sequence numbers are visible in
+        order. """
+        store = self.store
+        sequence = store.next("changes")
+        if operation == "delete":
+            contacts = (None, None, None, None)
+        else:
+            contacts = tuple(store.domains[domain][:CREATED])
+        store.changes.append((sequence, operation, domain) + contacts + (clock(),))
+        self.undo.append(store.changes.pop)
+
+    def changes(self, after, limit):
+        start = bisect.bisect_right(self.store.changes, integer(after), key=lambda change: change[0])
+        rows = self.store.changes[start:start + integer(limit)]
+        return (len(rows), rows)
+
+    def last_change(self):
+        return (1, [(self.store.changes[-1][0] if self.store.changes else 0,)])
+
+    def next_transaction_ids(self):
+        self.store.sequences["transaction_ids"] += TRANSACTION_IDS_INCREMENT
+        return (1, [(self.store.sequences["transaction_ids"] - TRANSACTION_IDS_INCREMENT + 1,)])
+
+    def find_replay(self, registrar, cltrid, method, path, window):
+        entry = self.store.replays.get((registrar, cltrid, method, path))
+        if entry is None or entry[6] <= time.time() - window:
+            return (0, [])
+        return (1, [entry[:6]])
+
+    def store_replay(self, registrar, cltrid, method, path, code, message, svtrid, output,
+                     etag, last_modified, window):
+        key = (registrar, cltrid, method, path)
+        old = self.store.replays.get(key)
+        if old is not None and old[6] > time.time() - window:
+            return (0, [])
+        self.begin()
+        self.store.replays[key] = (code, message, svtrid, output, etag, last_modified, time.time())
+        self.undo.append(lambda: self.store.replays.__setitem__(key, old) if old is not None \
+                         else self.store.replays.pop(key))
+        return (1, [])
+
+    def expire_replays(self, window):
+        limit = time.time() - window
+        expired = [key for (key, entry) in self.store.replays.items() if entry[6] <= limit]
+        if expired:
+            self.begin()
+            for key in expired:
+                entry = self.store.replays.pop(key)
+                self.undo.append(lambda key=key, entry=entry: self.store.replays.__setitem__(key, entry))
+        return (len(expired), [])
+
+    # What the triggers of create.sql do
+
+    def count(self, name, increment):
+        self.store.counters[name] += increment
+        self.undo.append(lambda: self.store.counters.__setitem__(name, self.store.counters[name] - increment))
+
+    def count_quota(self, registrar, increment):
+        quota = self.store.quotas.get(registrar)
+        if quota is None:
+            quota = self.store.quotas[registrar] = [0, None]
+        quota[0] += increment
+        self.undo.append(lambda: quota.__setitem__(0, quota[0] - increment))
+
+    def insert_registrar(self, name, password):
+        """ Not in the catalog, the registrars are created with psql """
+        store = self.store
+        self.begin()
+        handle = store.next("registrars")
+        store.registrars[handle] = [name, password]
+        self.undo.append(lambda: store.registrars.pop(handle))
+        return handle
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+""" Instrumentation of the registry, exported in the Prometheus text
+format on /metrics: latency histograms of the requests by route,
+method and status code, number of queries and time spent in the
+database, and gauges (pool, caches).
+
+Recording a request is a few dictionary operations under a lock, so
+it can stay on in production (see 'bench.py metrics').
+
+With several worker processes (server.py), a scrape reaches only one
+of them. So, when a directory is configured, each process writes its
+metrics there every second and /metrics adds up those of all the
+processes. The gauges are reported per process, with a label pid. """
+
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+# Seconds between two exports to the directory
+EXPORT_INTERVAL = 1
+
+HISTOGRAMS = {"rpp_request_duration_seconds": ("Time to process a request", ("route", "method", "code")),
+              "rpp_db_duration_seconds": ("Time spent in the database by a request", ("route", "method"))}
+METHODS = ("GET", "HEAD", "PUT", "PATCH", "POST", "DELETE")
+COUNTERS = {"rpp_db_queries_total": ("Queries sent to the database", ("route", "method")),
+            "rpp_throttled_total": ("Requests refused by the admission control",
+                                    ("registrar", "operation", "reason"))}
+
+def route_name(path):
+    """ A small set of names, so the number of time series is bounded
+    whatever the clients send. """
+    if path.startswith("/domains/"):
+        parts = path.split("/")
+        if len(parts) == 3:
+            return "domain"
+        if parts[3] in ("availability", "transfer"):
+            return parts[3]
+        return "domain_other"
+    if path in ("/entities", "/entities/"):
+        return "search" # Or a creation, PUT
+    if path.startswith("/entities/"):
+        return "entities"
+    if path == "/list-domains":
+        return "list"
+    if path == "/check-domains":
+        return "check"
+    if path == "/patch-domains":
+        return "patch_batch"
+    if path == "/export-domains":
+        return "export"
+    if path == "/changes":
+        return "changes"
+    return "other"
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> labels -> bucket counts (not cumulative), then the sum
+        self.histograms = {name: {} for name in HISTOGRAMS}
+        # name -> labels -> value
+        self.counters = {name: {} for name in COUNTERS}
+        # name -> (help, function returning a list of (labels, value))
+        self.gauges = {}
+        self.directory = None
+
+    def observe(self, path, method, code, latency, queries, db_time):
+        route = route_name(path)
+        if method not in METHODS:
+            method = "other"
+        with self.lock:
+            self.add("rpp_request_duration_seconds", (route, method, str(code)), latency)
+            if queries:
+                self.add("rpp_db_duration_seconds", (route, method), db_time)
+                counter = self.counters["rpp_db_queries_total"]
+                counter[(route, method)] = counter.get((route, method), 0) + queries
+
+    def count(self, name, labels, value=1):
+        with self.lock:
+            counter = self.counters[name]
+            counter[labels] = counter.get(labels, 0) + value
+
+    def add(self, name, labels, value):
+        histogram = self.histograms[name]
+        buckets = histogram.get(labels)
+        if buckets is None:
+            buckets = histogram[labels] = [0]*(len(BUCKETS) + 1) + [0.0]
+        buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        buckets[-1] += value
+
+    def gauge(self, name, help, function):
+        """ function returns a list of (labels dictionary, value), it
+        is called at each scrape. """
+        self.gauges[name] = (help, function)
+
+    def snapshot(self):
+        """ The metrics of this process, in a form which can be
+        written in JSON """
+        with self.lock:
+            result = {"histograms": {name: [[list(labels), list(values)] for (labels, values) in series.items()]
+                                     for (name, series) in self.histograms.items()},
+                      "counters": {name: [[list(labels), value] for (labels, value) in series.items()]
+                                   for (name, series) in self.counters.items()}}
+        gauges = {}
+        for (name, (help, function)) in self.gauges.items():
+            try:
+                gauges[name] = [[labels, value] for (labels, value) in function()]
+            except Exception:
+                # For instance, a pool not opened yet
+                continue
+        result["gauges"] = gauges
+        result["pid"] = os.getpid()
+        return result
+
+    def start_export(self, directory):
+        self.directory = directory
+        threading.Thread(target=self.export, name="metrics", daemon=True).start()
+
+    def export(self):
+        filename = os.path.join(self.directory, "%i.json" % os.getpid())
+        while True:
+            temporary = filename + ".tmp"
+            with open(temporary, "w") as OUTPUT:
+                json.dump(self.snapshot(), OUTPUT)
+            os.replace(temporary, filename)
+            time.sleep(EXPORT_INTERVAL)
+
+    def snapshots(self):
+        """ This process, live, and the others, from the directory """
+        result = [self.snapshot()]
+        if self.directory is None:
+            return result
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json") or filename == "%i.json" % os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as INPUT:
+                    snapshot = json.load(INPUT)
+            except (OSError, ValueError):
+                continue
+            if not alive(snapshot["pid"]):
+                # Its counters still count, not its gauges
+                snapshot["gauges"] = {}
+            result.append(snapshot)
+        return result
+
+    def render(self):
+        """ The Prometheus text format """
+        snapshots = self.snapshots()
+        lines = []
+        for (name, (help, labelnames)) in HISTOGRAMS.items():
+            series = {}
+            for snapshot in snapshots:
+                for (labels, values) in snapshot["histograms"].get(name, []):
+                    total = series.setdefault(tuple(labels), [0]*len(values))
+                    for (i, value) in enumerate(values):
+                        total[i] += value
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for (labels, values) in sorted(series.items()):
+                base = format_labels(dict(zip(labelnames, labels)))
+                cumulative = 0
+                for (bound, count) in zip(BUCKETS + ("+Inf",), values):
+                    cumulative += count
+                    lines.append("%s_bucket{%s,le=\"%s\"} %i" % (name, base, bound, cumulative))
+                lines.append("%s_sum{%s} %.6f" % (name, base, values[-1]))
+                lines.append("%s_count{%s} %i" % (name, base, cumulative))
+        for (name, (help, labelnames)) in COUNTERS.items():
+            series = {}
+            for snapshot in snapshots:
+                for (labels, value) in snapshot["counters"].get(name, []):
+                    series[tuple(labels)] = series.get(tuple(labels), 0) + value
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s counter" % name)
+            for (labels, value) in sorted(series.items()):
+                lines.append("%s{%s} %s" % (name, format_labels(dict(zip(labelnames, labels))), value))
+        for (name, (help, function)) in sorted(self.gauges.items()):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            for snapshot in snapshots:
+                for (labels, value) in snapshot["gauges"].get(name, []):
+                    labels = dict(labels, pid=str(snapshot["pid"]))
+                    lines.append("%s{%s} %s" % (name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    return ",".join("%s=\"%s\"" % (name, str(value).replace("\\", "\\\\").replace("\"", "\\\""))
+                    for (name, value) in labels.items())
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def server_timing(latency, queries, db_time):
+    """ Value of the Server-Timing header (durations in ms) """
+    return "db;dur=%.3f;desc=\"%i queries\", total;dur=%.3f" % \
+        (db_time*1000, queries, latency*1000)
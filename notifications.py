@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+""" Listens to PostgreSQL notifications (LISTEN/NOTIFY) and calls the
+callbacks subscribed to each channel with the payload. The triggers
+in create.sql send the notifications, so changes made by any process,
+including psql, are seen. """
+
+import logging
+import select
+import threading
+import time
+
+# https://pypi.org/project/psycopg2/
+import psycopg2
+
+# Seconds between two attempts to reconnect
+RETRY = 5
+
+logger = logging.getLogger("RPP")
+
+class Listener(threading.Thread):
+
+    def __init__(self, dsn):
+        threading.Thread.__init__(self, name="notifications", daemon=True)
+        self.dsn = dsn
+        self.callbacks = {}
+
+    def subscribe(self, channel, callback):
+        """ Must be called before start(). callback receives the
+        payload, or None when notifications may have been lost (so
+        everything must be forgotten). """
+        self.callbacks.setdefault(channel, []).append(callback)
+
+    def notify(self, channel, payload):
+        for callback in self.callbacks.get(channel, []):
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error("Notification callback for %s failed: %s" % (channel, e))
+
+    def run(self):
+        while True:
+            try:
+                connection = psycopg2.connect(self.dsn)
+                connection.autocommit = True
+                cursor = connection.cursor()
+                for channel in self.callbacks:
+                    cursor.execute("LISTEN %s" % channel)
+                # We did not listen until now, we may have missed
+                # something.
+                for channel in self.callbacks:
+                    self.notify(channel, None)
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        self.notify(notification.channel, notification.payload)
+            except psycopg2.Error as e:
+                logger.error("Lost the notifications connection: %s" % e)
+                for channel in self.callbacks:
+                    self.notify(channel, None)
+                time.sleep(RETRY)
@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+
+""" The domains and contacts recently read, so the GETs of the popular
+ones do not go to the database. Each process has its own cache, a
+LRU, invalidated by the notifications of the triggers (see
+create.sql), so a change made by any process, including psql or
+approve-transfers.py, is seen as soon as it is committed.
+
+The objects which do not exist are not kept: the creations are not
+notified on this channel (and the availability filter already
+handles the names which do not exist). """
+
+import conditional
+
+class Cache(conditional.Cache):
+    """ (kind, key) -> row of info_domain or info_contact, the same LRU
+    as the validators of conditional.py """
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": self.hits/lookups if lookups else 0.0}
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+""" A pool of PostgreSQL connections, safe to share between
+threads. Each request checks out its own connection and gives it back
+when done. Connections are checked before being handed out so a
+restart of PostgreSQL does not leave us with dead connections. """
+
+import threading
+import contextlib
+import time
+
+# https://pypi.org/project/psycopg2/
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+class PoolExhausted(Exception):
+    pass
+
+class Pool:
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5,
+                 check_interval=30, on_connect=None):
+        """ timeout is how long (in seconds) a request waits for a free
+        connection. A connection unused for more than check_interval
+        seconds is tested with a trivial query before being handed
+        out. on_connect is called with each new connection, for
+        instance to prepare statements. """
+        self.dsn = dsn
+        self.on_connect = on_connect
+        self.maxconn = maxconn
+        self.in_use = 0 # Connections checked out
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        # psycopg2 raises an exception when the pool is empty, we
+        # prefer to wait a bit.
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.last_used = {}
+        # Configure the connections opened by psycopg2 right now
+        connections = [self.getconn() for i in range(minconn)]
+        for connection in connections:
+            self.putconn(connection)
+
+    def configure(self, connection):
+        connection.set_session(autocommit=False,
+                               isolation_level=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        if self.on_connect is not None:
+            self.on_connect(connection)
+
+    def alive(self, connection):
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def getconn(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolExhausted
+        try:
+            connection = self.pool.getconn()
+            with self.lock:
+                last = self.last_used.get(id(connection))
+            if last is not None and \
+               (connection.closed or time.monotonic() - last >= self.check_interval) and \
+               not self.alive(connection):
+                # Typically, PostgreSQL was restarted. Throw away the
+                # connection and open a new one.
+                self.forget(connection)
+                self.pool.putconn(connection, close=True)
+                connection = self.pool.getconn()
+                last = None
+            if last is None: # A new connection
+                try:
+                    self.configure(connection)
+                except:
+                    self.pool.putconn(connection, close=True)
+                    raise
+            with self.lock:
+                self.in_use += 1
+            return connection
+        except:
+            self.slots.release()
+            raise
+
+    def putconn(self, connection, broken=False):
+        try:
+            if not broken and not connection.closed:
+                # Do not leave a transaction opened, for instance
+                # after an error path which did not roll back.
+                if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                with self.lock:
+                    self.last_used[id(connection)] = time.monotonic()
+            else:
+                self.forget(connection)
+                # If one connection is broken, the others probably
+                # are, too. Test them before their next use.
+                with self.lock:
+                    for c in self.last_used:
+                        self.last_used[c] = 0
+            self.pool.putconn(connection, close=broken or bool(connection.closed))
+            # psycopg2 closes the connections beyond minconn. A new
+            # connection could get the same id and would not be
+            # configured.
+            if connection.closed:
+                self.forget(connection)
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def forget(self, connection):
+        with self.lock:
+            self.last_used.pop(id(connection), None)
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.getconn()
+        broken = False
+        try:
+            yield connection
+        except psycopg2.InterfaceError:
+            broken = True
+            raise
+        finally:
+            # An OperationalError is also a deadlock, a serialization
+            # failure or a cancelled query, which leave the connection
+            # usable. When PostgreSQL went away, psycopg2 closed it.
+            self.putconn(connection, broken)
+
+    def closeall(self):
+        with self.lock:
+            self.last_used.clear()
+        self.pool.closeall()
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+""" All the SQL of the registry, by name. The business logic only
+gives the name and the arguments, the database classes execute them
+as prepared statements, so PostgreSQL parses and plans them once per
+connection and not at each request.
+
+The synchronous front end (psycopg2, which interpolates the arguments
+itself) runs PREPARE for every statement when a connection is opened,
+then EXECUTE. The ASGI one uses the prepared statements of psycopg
+3. """
+
+import re
+
+QUERIES = {
+    "head_domain": "SELECT name FROM Domains WHERE name = %(domain)s",
+    "info_domain": "SELECT name, holder, tech, admin, registrar, created, updated FROM Domains WHERE name = %(domain)s",
+    # For the conditional requests, see conditional.py
+    "domain_updated": "SELECT updated FROM Domains WHERE name = %(domain)s",
+    "check_domains": "SELECT name FROM Domains WHERE name = ANY(%(names)s)",
+    "list_domains": "SELECT name FROM Domains WHERE name > %(after)s ORDER BY name",
+    "list_domains_page": "SELECT name FROM Domains WHERE name > %(after)s ORDER BY name LIMIT %(limit)s",
+    "store_domain": "INSERT INTO Domains (name, holder, tech, admin, registrar) VALUES (%(domain)s, %(holder)s, %(tech)s, %(admin)s, %(registrar)s)",
+    # The counters were incremented by triggers (see create.sql),
+    # which keep them locked until the end of the transaction.
+    "domain_limits": "SELECT Counters.value, Quotas.domains, Quotas.max_domains FROM Counters, Quotas WHERE Counters.name = 'domains' AND Quotas.registrar = %(registrar)s",
+    # NULL means no change. Only the registrar of the domain can
+    # change it. versions are those of If-Match (NULL for no
+    # condition), see conditional.version.
+    "patch_domain": "UPDATE Domains SET holder = COALESCE(%(holder)s, holder), tech = COALESCE(%(tech)s, tech), admin = COALESCE(%(admin)s, admin) WHERE name = %(domain)s AND registrar = %(registrar)s AND (%(versions)s::bigint[] IS NULL OR floor(extract(epoch FROM updated)*1000000)::bigint = ANY(%(versions)s::bigint[])) RETURNING name, holder, tech, admin, registrar, created, updated",
+    # The same change on many domains. They are locked in the order of
+    # the names, so two batches do not deadlock.
+    "patch_domains": "WITH Locked AS (SELECT name FROM Domains WHERE name = ANY(%(names)s) AND registrar = %(registrar)s ORDER BY name FOR UPDATE) UPDATE Domains SET holder = COALESCE(%(holder)s, holder), tech = COALESCE(%(tech)s, tech), admin = COALESCE(%(admin)s, admin) FROM Locked WHERE Domains.name = Locked.name RETURNING Domains.name, holder, tech, admin, registrar, created, updated",
+    "domains_registrars": "SELECT name, registrar FROM Domains WHERE name = ANY(%(names)s)",
+    "delete_domain": "DELETE FROM Domains WHERE name = %(domain)s",
+    "head_contact": "SELECT name FROM Contacts WHERE handle = %(contact)s",
+    "info_contact": "SELECT name, created, updated FROM Contacts WHERE handle = %(contact)s",
+    "contact_updated": "SELECT updated FROM Contacts WHERE handle = %(contact)s",
+    "store_contact": "INSERT INTO Contacts (name) VALUES (%(name)s)",
+    "contact_limits": "SELECT value FROM Counters WHERE name = 'contacts'",
+    "delete_contact": "DELETE FROM Contacts WHERE handle = %(contact)s",
+    # The search of contacts by name (see create.sql for the
+    # indexes). The last column is the key of the cursor, with the
+    # handle. chr(1114111) is the last character: the prefix search is
+    # a range of the index.
+    "search_contacts_exact": "SELECT handle, name, created, lower(name) FROM Contacts WHERE lower(name) COLLATE \"C\" = %(name)s AND (lower(name) COLLATE \"C\", handle) > (%(after)s, %(handle)s) ORDER BY lower(name) COLLATE \"C\", handle LIMIT %(limit)s",
+    "search_contacts_prefix": "SELECT handle, name, created, lower(name) FROM Contacts WHERE lower(name) COLLATE \"C\" >= %(name)s AND lower(name) COLLATE \"C\" < %(name)s || chr(1114111) AND (lower(name) COLLATE \"C\", handle) > (%(after)s, %(handle)s) ORDER BY lower(name) COLLATE \"C\", handle LIMIT %(limit)s",
+    # A function, so this can be prepared even without pg_trgm. psycopg
+    # sends a float as double precision, which PostgreSQL does not
+    # convert to real by itself to find the function.
+    "search_contacts_fuzzy": "SELECT handle, name, created, distance FROM search_contacts_fuzzy(%(name)s, %(after)s::real, %(handle)s, %(limit)s)",
+    "registrar_password": "SELECT password FROM Registrars WHERE handle = %(handle)s",
+    # Authentication and ownership in one round trip. There is always
+    # one row, with NULL for what does not exist.
+    "domain_and_password": "SELECT Domains.registrar, Registrars.password FROM (SELECT 1) AS One LEFT JOIN Domains ON Domains.name = %(domain)s LEFT JOIN Registrars ON Registrars.handle = %(handle)s",
+    # Same, with the pending transfer, if any
+    "transfer_state": "SELECT Domains.registrar, Registrars.password, Transfers.created, Transfers.winner FROM (SELECT 1) AS One LEFT JOIN Domains ON Domains.name = %(domain)s LEFT JOIN Registrars ON Registrars.handle = %(handle)s LEFT JOIN Transfers ON Transfers.domain = Domains.name AND NOT Transfers.completed ORDER BY Transfers.created LIMIT 1",
+    # The transfer statements check the state themselves, so they are
+    # atomic even if it changed since transfer_state. They change no
+    # row when they do not apply. The partial unique index
+    # transfers_pending (see create.sql) ensures there is at most one
+    # pending transfer per domain.
+    "start_transfer": "INSERT INTO Transfers (domain, winner, completed) SELECT name, %(client)s, false FROM Domains WHERE name = %(domain)s AND registrar <> %(client)s ON CONFLICT (domain) WHERE NOT completed DO NOTHING",
+    "cancel_transfer": "DELETE FROM Transfers WHERE NOT completed AND domain = %(domain)s AND winner = %(client)s",
+    "reject_transfer": "DELETE FROM Transfers USING Domains WHERE NOT Transfers.completed AND Transfers.domain = %(domain)s AND Domains.name = Transfers.domain AND Domains.registrar = %(client)s",
+    # Completes the transfer and changes the registrar
+    "approve_transfer": "WITH Done AS (UPDATE Transfers SET completed = true FROM Domains WHERE NOT Transfers.completed AND Transfers.domain = %(domain)s AND Domains.name = Transfers.domain AND Domains.registrar = %(client)s RETURNING Transfers.winner) UPDATE Domains SET registrar = Done.winner FROM Done WHERE Domains.name = %(domain)s",
+    # Same, for a batch of the transfers pending for more than delay
+    # seconds. SKIP LOCKED lets several jobs run at the same time. The
+    # transfers to a registrar without room under its quota stay
+    # pending (the trigger would refuse the whole batch), in the
+    # order of their creation when it has room for some of them.
+    "approve_expired_transfers": "WITH Expired AS (SELECT id, domain, winner, created FROM Transfers WHERE NOT completed AND created < localtimestamp - make_interval(secs => %(delay)s) AND NOT EXISTS (SELECT 1 FROM Quotas WHERE Quotas.registrar = Transfers.winner AND Quotas.domains >= Quotas.max_domains) ORDER BY created LIMIT %(batch)s FOR UPDATE SKIP LOCKED), Allowed AS (SELECT Ranked.id, Ranked.domain, Ranked.winner FROM (SELECT id, domain, winner, row_number() OVER (PARTITION BY winner ORDER BY created, id) AS rank FROM Expired) AS Ranked LEFT JOIN Quotas ON Quotas.registrar = Ranked.winner WHERE Quotas.max_domains IS NULL OR Ranked.rank <= Quotas.max_domains - Quotas.domains), Done AS (UPDATE Transfers SET completed = true FROM Allowed WHERE Transfers.id = Allowed.id RETURNING Allowed.domain, Allowed.winner) UPDATE Domains SET registrar = Done.winner FROM Done WHERE Domains.name = Done.domain",
+    # Retries, see idempotency.py. An old response with the same key
+    # is replaced.
+    "find_replay": "SELECT code, message, svtrid, output, etag, last_modified FROM Replays WHERE registrar = %(registrar)s AND cltrid = %(cltrid)s AND method = %(method)s AND path = %(path)s AND created > now() - make_interval(secs => %(window)s)",
+    "store_replay": "INSERT INTO Replays (registrar, cltrid, method, path, code, message, svtrid, output, etag, last_modified) VALUES (%(registrar)s, %(cltrid)s, %(method)s, %(path)s, %(code)s, %(message)s, %(svtrid)s, %(output)s, %(etag)s, %(last_modified)s) ON CONFLICT (registrar, cltrid, method, path) DO UPDATE SET code = EXCLUDED.code, message = EXCLUDED.message, svtrid = EXCLUDED.svtrid, output = EXCLUDED.output, etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified, created = EXCLUDED.created WHERE Replays.created <= now() - make_interval(secs => %(window)s)",
+    "expire_replays": "DELETE FROM Replays WHERE created <= now() - make_interval(secs => %(window)s)",
+    "next_transaction_ids": "SELECT nextval('transaction_ids')",
+    # The change feed, see the table Changes
+    "changes": "SELECT sequence, operation, name, holder, tech, admin, registrar, at FROM Changes WHERE sequence > %(after)s ORDER BY sequence LIMIT %(limit)s",
+    "last_change": "SELECT COALESCE(max(sequence), 0) FROM Changes",
+}
+
+# The exports, run with COPY ... TO STDOUT, which cannot be prepared.
+# For NDJSON, the JSON made by PostgreSQL is written as is: CSV with
+# a quote and a delimiter which it never contains.
+COPIES = {"export_domains_csv": "COPY (SELECT name, holder, tech, admin, registrar, created, updated FROM Domains ORDER BY name) TO STDOUT WITH (FORMAT csv, HEADER)",
+          "export_domains_ndjson": "COPY (SELECT json_build_object('name', name, 'holder', holder, 'tech', tech, 'admin', admin, 'registrar', registrar, 'created', created, 'updated', updated) FROM Domains ORDER BY name) TO STDOUT WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')"}
+
+PARAMETER = re.compile(r"%\((\w+)\)s")
+
+class Statement:
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.parameters = []
+        def number(match):
+            if match.group(1) not in self.parameters:
+                self.parameters.append(match.group(1))
+            return "$%i" % (self.parameters.index(match.group(1)) + 1)
+        self.prepare = "PREPARE %s AS %s" % (name, PARAMETER.sub(number, sql))
+        if self.parameters:
+            self.execute = "EXECUTE %s(%s)" % \
+                (name, ", ".join("%%(%s)s" % p for p in self.parameters))
+        else:
+            self.execute = "EXECUTE %s" % name
+
+STATEMENTS = {name: Statement(name, sql) for (name, sql) in QUERIES.items()}
+
+def prepare(connection):
+    """ Prepares all the statements on a new psycopg2 connection """
+    with connection.cursor() as cursor:
+        for statement in STATEMENTS.values():
+            cursor.execute(statement.prepare)
+    connection.commit()
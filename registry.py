@@ -4,21 +4,118 @@ import os
 import json
 import datetime
 import base64
-import random
 import logging
 import time
+import threading
+import atexit
+import contextvars
+import itertools
+import math
+import queue
+import tempfile
+import urllib.parse
 
 # https://pypi.org/project/psycopg2/
 import psycopg2
 
+# https://pypi.org/project/orjson/ Optional, a faster JSON encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # https://python-jsonschema.readthedocs.io https://pypi.org/project/jsonschema/
 # See also https://json-schema.org/
 import jsonschema
 
+import pool
+import validation
+import credentials
+import notifications
+import queries
+import translog
+import metrics
+import availability
+import memory
+import conditional
+import idempotency
+import admission
+import objects
+import tracing
+
 TLD = "example"
 MAX_DOMAINS = 5000
 MAX_CONTACTS = 5000
 LOGFILENAME = "rpp.log"
+# Fraction of the successful read requests which are logged
+LOG_SAMPLE_RATE = 1.0
+DATABASE = "dbname=registry"
+MIN_CONNECTIONS = 2
+MAX_CONNECTIONS = 20
+# Seconds to wait for a free connection before replying 503
+CONNECTION_TIMEOUT = 5
+# Maximum size of a page of /list-domains
+MAX_LIST_LIMIT = 1000
+# Rows read at a time when streaming /list-domains
+LIST_BATCH = 1000
+# Pending transfers are approved automatically after this delay, by
+# approve-transfers.py
+TRANSFER_DELAY = 5*24*3600 # seconds
+# Maximum number of names in one /check-domains request
+MAX_CHECK = 500
+# Maximum number of names in one /patch-domains request
+MAX_PATCH = 500
+# Maximum number of changes in one /changes response
+MAX_CHANGES = 1000
+# Maximum size of a page of the contact search, and the default
+MAX_SEARCH_LIMIT = 100
+SEARCH_LIMIT = 20
+# Kinds of contact search (match=)
+SEARCHES = ("prefix", "exact", "fuzzy")
+# Size (bytes) of the pieces of the exports, and how many of them can
+# wait for a slow client
+COPY_CHUNK = 65536
+COPY_QUEUE = 16
+# Formats of /export-domains
+EXPORTS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Registrars whose password was recently verified
+CREDENTIALS_CACHE_SIZE = 10000
+CREDENTIALS_TTL = 300 # seconds
+# Verifications which may fail, per registrar: (rate per second,
+# burst), see credentials.py
+CREDENTIALS_FAILURES = credentials.FAILURES
+# False positives of the availability filter
+AVAILABILITY_ERROR_RATE = 0.01
+# Names whose existence was recently asked to the database
+AVAILABILITY_CACHE_SIZE = 10000
+# Validators (see conditional.py) of the objects recently read
+CONDITIONAL_CACHE_SIZE = 10000
+# Domains and contacts recently read (see objects.py), 0 for no cache
+OBJECT_CACHE_SIZE = 10000
+# Responses replayed to the retries (see idempotency.py)
+REPLAY_CACHE_SIZE = 10000
+REPLAY_WINDOW = 3600 # seconds
+# With replay_shared, the expired responses are deleted by one store
+# out of REPLAY_CLEANUP
+REPLAY_CLEANUP = 1000
+# Must be the INCREMENT of the sequence transaction_ids in create.sql
+TRANSACTION_IDS_BLOCK = 1000
+# "postgresql" or "memory" (see memory.py)
+STORAGE = "postgresql"
+# Per registrar, see admission.py. None means no admission control.
+RATE_LIMITS = None
+# With the tracing of the statements (see tracing.py), those slower
+# than this are explained
+TRACE_THRESHOLD = 0.1 # seconds
+# The resources, by the first component of the path, with the minimum
+# and maximum number of components after it
+ROUTES = {"domains": (1, 3), # name, operation, extra
+          "entities": (0, 1), # handle, nothing for the search
+          "list-domains": (0, 0),
+          "check-domains": (0, 0),
+          "patch-domains": (0, 0),
+          "export-domains": (0, 0),
+          "changes": (0, 0)}
 
 class AlreadyExists(Exception):
     pass
@@ -30,161 +127,495 @@ class TooManyDomains(Exception):
     pass
 class TooManyContacts(Exception):
     pass
+class QuotaExceeded(Exception):
+    pass
 class Conflict(Exception):
     pass
 class NoValidationForThisMethod(Exception):
     def __init__(self, method):
         self.method = method
+class NoValidationForThisClass(Exception):
+    def __init__(self, klass):
+        self.klass = klass
+class Abandoned(Exception):
+    """ The client of an export went away """
+    pass
     
 def serialize_others(obj): 
     if isinstance(obj, datetime.datetime): 
         return obj.isoformat() 
     raise TypeError("Type not serializable")
 
-def send(start_response, status, output):
-    """output must be a dictionary, status also, with members 'code'
-    and 'message'"""
-    output["status_code"] = status["code"]
-    output["status_message"] = status["message"]
-    joutput = json.dumps(output, default=serialize_others) + "\r\n"
-    response_headers = [("Content-Type", "application/rpp+json"),
-                        ("Content-Length", str(len(joutput)))]
-    svtrid = "(None)"
+# Given default, json.dumps builds a new encoder at each call
+json_encoder = json.JSONEncoder(default=serialize_others)
+
+def dumps(obj):
+    """ JSON, as bytes. orjson writes UTF-8 (and datetimes like
+    isoformat), json only ASCII. """
+    if orjson is not None and config["fast_json"]:
+        try:
+            return orjson.dumps(obj, default=serialize_others)
+        except TypeError: # Lone surrogates, integers too big…
+            pass
+    return json_encoder.encode(obj).encode()
+
+class Encoded:
+    """ An output which never changes, with its status, encoded only
+    once """
+
+    def __init__(self, code, message, output):
+        self.code = code
+        self.message = message
+        self.output = output
+        self.body = None
+
+    def response(self):
+        """ The front ends add headers to the status, it must be a
+        new one each time """
+        return {"code": self.code, "message": self.message}, self
+
+    def encode(self):
+        if self.body is None:
+            self.body = dumps(dict(self.output, status_code=self.code,
+                                   status_message=self.message)) + b"\r\n"
+        return self.body
+
+BAD_PATH = Encoded(400, "Path must start with /domains, /entities or be /list-domains, /check-domains, /patch-domains, /export-domains or /changes", {})
+SERVER_BUSY = Encoded(503, "Server busy", {"result": "No database connection available, try again later"})
+DATABASE_UNAVAILABLE = Encoded(503, "Database unavailable", {"result": "Database unavailable, try again later"})
+# The transaction failed but the database works: a deadlock or a
+# serialization failure, a statement cancelled (statement_timeout)
+CONFLICT = Encoded(500, "Conflict", {"result": "Internal conflict, try again"})
+QUERY_CANCELED = Encoded(500, "Query canceled", {"result": "The request took too long, try again later"})
+
+def route(path):
+    """ Returns the resource and the components of the path after it,
+    None if there are too many or too few. The path is split only
+    once. """
+    parts = path.split("/")
+    arity = ROUTES.get(parts[1]) if len(parts) > 1 and parts[0] == "" else None
+    if arity is None:
+        return None, None
+    parameters = parts[2:]
+    if len(parameters) < arity[0] or len(parameters) > arity[1]:
+        return parts[1], None
+    return parts[1], parameters
+
+class Stream:
+    """ An output too big to be built in memory: the members of
+    output plus a member name whose value is a JSON array made from
+    the first column of the rows, an asynchronous iterator of
+    batches of rows (see Database.stream). """
+
+    def __init__(self, output, name, rows):
+        self.output = output
+        self.name = name
+        self.rows = rows
+
+    async def chunks(self):
+        # Without spaces, like orjson
+        yield ('{"%s":[' % self.name).encode()
+        first = True
+        async for batch in self.rows:
+            if not batch:
+                continue
+            chunk = b",".join(dumps(row[0]) for row in batch)
+            if not first:
+                chunk = b"," + chunk
+            first = False
+            yield chunk
+        # The rest of the output, without its opening brace
+        yield b"]," + dumps(self.output)[1:] + b"\r\n"
+
+class Export(Stream):
+    """ An output which is not JSON: the pieces of a COPY (see
+    Database.copy), sent as they are """
+
+    def __init__(self, content_type, pieces):
+        self.content_type = content_type
+        self.pieces = pieces
+
+    def chunks(self):
+        return self.pieces
+
+def encode(status, output):
+    """output must be a dictionary (or a Stream or Encoded), status also, with
+    members 'code' and 'message'. Returns the HTTP status line, the
+    headers and the body. For a Stream, the body is an asynchronous
+    iterator of bytes."""
+    if isinstance(output, Export):
+        body = output.chunks()
+        response_headers = [("Content-Type", output.content_type)]
+    elif isinstance(output, Stream):
+        output.output["status_code"] = status["code"]
+        output.output["status_message"] = status["message"]
+        body = output.chunks()
+        response_headers = [("Content-Type", "application/rpp+json")]
+    elif status["code"] == 304: # No body, RFC 9110, section 15.4.5
+        body = b""
+        response_headers = []
+    else:
+        if isinstance(output, Encoded):
+            body = output.encode()
+        else:
+            output["status_code"] = status["code"]
+            output["status_message"] = status["message"]
+            body = dumps(output) + b"\r\n"
+        response_headers = [("Content-Type", "application/rpp+json"),
+                            ("Content-Length", str(len(body)))]
     if "svtrid" in status:
         response_headers.append(("RPP-Svtrid", str(status["svtrid"])))
-        svtrid = status["svtrid"]
-    # TODO log the client name
-    logger.info("Completing transaction %s" % (svtrid))
     if "cltrid" in status:
         response_headers.append(("RPP-Cltrid", status["cltrid"]))
+    if "server_timing" in status:
+        response_headers.append(("Server-Timing", status["server_timing"]))
+    if "retry_after" in status:
+        response_headers.append(("Retry-After", str(status["retry_after"])))
+    if status.get("replayed"):
+        response_headers.append(("RPP-Replayed", "true"))
+    if "changes_sequence" in status:
+        response_headers.append(("RPP-Changes-Sequence", str(status["changes_sequence"])))
+    if "etag" in status:
+        response_headers.append(("ETag", status["etag"]))
+        response_headers.append(("Last-Modified", status["last_modified"]))
     sstatus = "%s %s" % (status["code"], status["message"])
-    start_response(sstatus, response_headers)
-    return [joutput.encode()]
+    return sstatus, response_headers, body
     # We should return errors in JSON as in RFC 9457
 
-def head_domain(domain):
-    cursor.execute("SELECT name FROM domains WHERE name= (%(domain)s)",
-                   {"domain": domain})
-    data = cursor.fetchone()
+def send(start_response, status, output):
+    (sstatus, response_headers, body) = encode(status, output)
+    start_response(sstatus, response_headers)
+    if isinstance(output, Stream):
+        return iterate_sync(body)
+    return [body]
+
+async def head_domain(domain):
+    data = await db.fetchone("head_domain", {"domain": domain})
     if data is None:
         return None
     else:
         return {"name": data[0]}
 
-def head_contact(contact):
-    # TODO allow search by name
-    cursor.execute("SELECT name FROM Contacts WHERE handle = (%(contact)s)",
-                   {"contact": contact})
-    data = cursor.fetchone()
+async def domain_exists(domain):
+    """ Like head_domain but, when it can, answers from the
+    availability filter, without the database. """
+    if availability_filter is None:
+        return await head_domain(domain) is not None
+    exists = availability_filter.lookup(domain)
+    if exists is not None:
+        return exists
+    generation = availability_filter.generation
+    exists = await head_domain(domain) is not None
+    availability_filter.learn(domain, exists, generation)
+    return exists
+
+async def head_contact(contact):
+    data = await db.fetchone("head_contact", {"contact": contact})
     if data is None:
         return None
     else:
         return {"name": data[0]}
 
-def info_domain(domain):
-    cursor.execute("SELECT name,holder,tech,admin,registrar,created FROM domains WHERE name= (%(domain)s)",
-                   {"domain": domain})
-    data = cursor.fetchone()
+async def cached(kind, key, args):
+    """ The row of info_domain or info_contact, from the cache when
+    possible """
+    if object_cache is None or key is None:
+        return await db.fetchone("info_%s" % kind, args)
+    data = object_cache.get(kind, key)
+    if data is not None:
+        return data
+    generation = object_cache.generation
+    data = await db.fetchone("info_%s" % kind, args)
+    if data is not None:
+        object_cache.add(kind, key, tuple(data), generation)
+    return data
+
+async def info_domain(domain):
+    data = await cached("domain", domain, {"domain": domain})
     if data is None:
         return None
     else:
         return {"name": data[0], "holder": data[1], "tech": data[2], "admin": data[3], "registrar": int(data[4]),
-                "created": data[5]} 
+                "created": data[5], "updated": data[6]} 
 
-def info_contact(contact):
-    cursor.execute("SELECT name,created FROM Contacts WHERE handle = (%(contact)s)",
-                   {"contact": contact})
-    data = cursor.fetchone()
+async def info_contact(contact):
+    data = await cached("contact", contact_key(contact), {"contact": contact})
     if data is None:
         return None
     else:
-        return {"name": data[0], "created": data[1]} 
+        return {"name": data[0], "created": data[1], "updated": data[2]} 
+
+def search_cursor(cursor, match):
+    """ The position after the last contact of the previous page: the
+    key (lower-case name, or distance for the fuzzy search) and the
+    handle. None if the cursor is invalid. """
+    if cursor is None:
+        return (-1.0 if match == "fuzzy" else ""), 0
+    try:
+        (key, handle) = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(handle, int) or \
+       not isinstance(key, (int, float) if match == "fuzzy" else str):
+        return None
+    return key, handle
+
+async def search_contacts(name, match, after, limit):
+    """ Contacts by name, ignoring case, sorted by name (by similarity
+    for the fuzzy search) then handle. A page of the exact or prefix
+    search is a range of the index of the names (see create.sql), so
+    its cost does not depend on the number of contacts; the fuzzy
+    search reads the trigram index by distance. """
+    (key, handle) = after
+    rows = await db.fetchall("search_contacts_%s" % match,
+                             {"name": name.lower(), "after": key, "handle": handle, "limit": limit})
+    output = {"contacts": [{"handle": row[0], "name": row[1], "created": row[2]} for row in rows]}
+    if len(rows) == limit:
+        output["next"] = base64.urlsafe_b64encode(json.dumps([rows[-1][3], rows[-1][0]]).encode()).decode()
+    return output
 
-def list_domains():
-    cursor.execute("SELECT name FROM domains")
+async def list_domains(after=None, limit=None):
+    """ Domains are sorted by name, and start after the name
+    'after'. Without a limit, the list is streamed. """
+    if after is None:
+        after = ""
+    if limit is None:
+        return Stream({}, "list",
+                      db.stream("list_domains", {"after": after}, LIST_BATCH))
     result = []
-    for data in cursor.fetchall():
+    for data in await db.fetchall("list_domains_page", {"after": after, "limit": limit}):
         result.append(data[0])
-    return {"list": result}
+    output = {"list": result}
+    if len(result) == limit:
+        output["next"] = result[-1]
+    return output
 
-def patch_domain(domain, data):
-    output = info_domain(domain)
-    if output is None:
-       return ({"code": 404,  "message": "Not found"},
-               {"result": "Domain %s NOT found" % domain})
-    data = data["change"]
-    if "tech" in data:
-        cursor.execute("UPDATE Domains SET tech = %(tech)s WHERE name = %(domain)s",
-                       {"domain": domain, "tech": data["tech"]})
-        if cursor.rowcount != 1:
-            connection.rollback()
-            return {"code": 500, "message": "Internal error"}, {"result": "Update of tech contact failed"}                
-    if "admin" in data:
-        cursor.execute("UPDATE Domains SET admin = %(admin)s WHERE name = %(domain)s",
-                       {"domain": domain, "admin": data["admin"]})
-        if cursor.rowcount != 1:
-            connection.rollback()
-            return {"code": 500, "message": "Internal error"}, {"result": "Update of admin contact failed"}                
-    connection.commit()
-    return {"code": 204, "message": "Updated"}, {"result": "Update done"}                
-    
-def store_domain(domain, holder, tech, admin, registrar):
-    cursor.execute("SELECT count(name) FROM domains")
-    num = int(cursor.fetchone()[0])
-    if num >= MAX_DOMAINS:
-        raise TooManyDomains
+async def export_domains(format):
+    """ All the domains, streamed by PostgreSQL. The last change
+    before the export is read first, so a consumer which then follows
+    /changes from it misses nothing (it may get again changes already
+    in the export, they have the new values so applying them again
+    does not matter). """
+    sequence = (await db.fetchone("last_change"))[0]
+    return sequence, Export(EXPORTS[format], db.copy("export_domains_%s" % format))
+
+async def changes(after, limit):
+    result = []
+    for data in await db.fetchall("changes", {"after": after, "limit": limit}):
+        change = {"sequence": data[0], "operation": data[1], "name": data[2], "at": data[7]}
+        if data[1] != "delete":
+            change.update(holder=data[3], tech=data[4], admin=data[5], registrar=data[6])
+        result.append(change)
+    return {"changes": result, "next": result[-1]["sequence"] if result else after}
+
+def domain_members(data):
+    """ The members of the JSON of a domain, from a row of info_domain """
+    return {"holder": data[1], "tech_contact": data[2], "admin_contact": data[3],
+            "registrar": int(data[4]), "created": data[5]}
+
+def contact_changes(change):
+    return {"holder": change.get("holder"), "tech": change.get("tech"), "admin": change.get("admin")}
+
+async def patch_domain(domain, data, registrar, if_match=None):
+    versions = None if if_match is None else conditional.versions(if_match)
+    # One UPDATE for all the changes, which also tells us if the
+    # domain exists, is of this registrar (and has the version the
+    # client expects), and returns the new values.
     try:
-        cursor.execute("INSERT INTO domains (name, holder, tech, admin, registrar) VALUES (%(domain)s, %(holder)s, %(tech)s, %(admin)s, %(registrar)s)",
-                       {"domain": domain, "holder": holder, "tech": tech, "admin": admin,
-                        "registrar": registrar})
-        connection.commit()
-    except psycopg2.errors.UniqueViolation:
-        connection.rollback()
+        row = await db.fetchone("patch_domain", dict(contact_changes(data["change"]), domain=domain,
+                                                     registrar=registrar, versions=versions))
+    except db.errors.ForeignKeyViolation:
+        await db.rollback()
+        return ({"code": 400, "message": "Unknown contact"},
+                {"result": "A contact of the change does not exist"})
+    except db.errors.SerializationFailure:
+        await db.rollback()
+        raise Conflict
+    if row is None:
+        await db.rollback()
+        current = await db.fetchone("info_domain", {"domain": domain})
+        if current is None:
+            return ({"code": 404,  "message": "Not found"},
+                    {"result": "Domain %s NOT found" % domain})
+        if int(current[4]) != registrar:
+            return ({"code": 403,  "message": "Forbidden"},
+                    {"result": "You (%i) are not the registrar of %s (%i)" % (registrar, domain, current[4])})
+        if versions is None:
+            raise Conflict # Changed between the two queries
+        return ({"code": 412,  "message": "Precondition failed"},
+                {"result": "Domain %s was changed since" % domain})
+    await db.commit()
+    changed("domain", domain)
+    status = {"code": 200, "message": "Updated"}
+    add_validators(status, row[6])
+    return status, dict(domain_members(row), result="Update done")
+
+async def patch_domains(names, change, registrar):
+    """ The same change on many domains of the registrar, in one
+    transaction: all of them are changed, or none. """
+    names = sorted(set(name.lower() for name in names))
+    try:
+        rows = await db.fetchall("patch_domains", dict(contact_changes(change), names=names,
+                                                       registrar=registrar))
+    except db.errors.ForeignKeyViolation:
+        await db.rollback()
+        return ({"code": 400, "message": "Unknown contact"},
+                {"result": "A contact of the change does not exist"})
+    except db.errors.SerializationFailure:
+        await db.rollback()
+        raise Conflict
+    if len(rows) != len(names):
+        await db.rollback()
+        registrars = dict(await db.fetchall("domains_registrars", {"names": names}))
+        missing = [name for name in names if name not in registrars]
+        foreign = [name for name in names if name in registrars and int(registrars[name]) != registrar]
+        if not missing and not foreign:
+            raise Conflict # Transferred meanwhile
+        status = {"code": 404, "message": "Not found"} if missing else \
+            {"code": 403, "message": "Forbidden"}
+        return status, {"result": "No domain changed", "not_found": missing, "not_yours": foreign}
+    await db.commit()
+    for row in rows:
+        changed("domain", row[0])
+    return ({"code": 200, "message": "Updated"},
+            {"result": "%i domains updated" % len(rows),
+             "domains": {row[0]: domain_members(row) for row in rows}})
+
+async def store_domain(domain, holder, tech, admin, registrar):
+    try:
+        await db.execute("store_domain", {"domain": domain, "holder": holder, "tech": tech,
+                                          "admin": admin, "registrar": registrar})
+        # The counters were incremented by triggers (see create.sql),
+        # which keep them locked until the end of the transaction, so
+        # the values we read include all the other creations.
+        data = await db.fetchone("domain_limits", {"registrar": registrar})
+        if data[0] > MAX_DOMAINS:
+            await db.rollback()
+            raise TooManyDomains
+        if data[2] is not None and data[1] > data[2]:
+            await db.rollback()
+            raise QuotaExceeded
+        await db.commit()
+        # The notification will come later, other requests of this
+        # process must see the domain now.
+        if availability_filter is not None:
+            availability_filter.added(domain)
+    except db.errors.UniqueViolation:
+        await db.rollback()
         raise AlreadyExists
-    except psycopg2.errors.SerializationFailure:
-        connection.rollback()
+    except db.errors.SerializationFailure:
+        await db.rollback()
         raise Conflict
     
-def store_contact(name):
-    cursor.execute("SELECT count(name) FROM contacts")
-    num = int(cursor.fetchone()[0])
-    if num >= MAX_CONTACTS:
-        raise TooManyContacts
+async def store_contact(name):
     try:
-        cursor.execute("INSERT INTO contacts (name) VALUES (%(name)s)",
-                   {"name": name})
-        connection.commit()
-    except psycopg2.errors.SerializationFailure:
-        connection.rollback()
+        await db.execute("store_contact", {"name": name})
+        # See store_domain
+        num = (await db.fetchone("contact_limits"))[0]
+        if num > MAX_CONTACTS:
+            await db.rollback()
+            raise TooManyContacts
+        await db.commit()
+    except db.errors.SerializationFailure:
+        await db.rollback()
         raise Conflict
     
-def delete_domain(domain):
+async def delete_domain(domain):
     if domain == "nic.%s" % TLD:
         raise Immutable
-    cursor.execute("DELETE FROM domains WHERE name=(%(domain)s)",
-                   {"domain": domain})
-    if cursor.rowcount == 0:
-        connection.rollback()
+    rowcount = await db.execute("delete_domain", {"domain": domain})
+    if rowcount == 0:
+        await db.rollback()
         raise DoesNotExist
-    connection.commit()
+    await db.commit()
+    changed("domain", domain)
+    if availability_filter is not None:
+        availability_filter.removed(domain)
 
-def delete_contact(contact):
+async def delete_contact(contact):
     if contact == 1:
         raise Immutable
-    cursor.execute("DELETE FROM Contacts WHERE handle=(%(contact)s)",
-                   {"contact": contact})
-    if cursor.rowcount == 0:
-        connection.rollback()
+    rowcount = await db.execute("delete_contact", {"contact": contact})
+    if rowcount == 0:
+        await db.rollback()
         raise DoesNotExist
-    connection.commit()
+    await db.commit()
+    changed("contact", contact_key(contact))
 
-def auth_registrar(user, password):
-     cursor.execute("SELECT password FROM Registrars WHERE handle = (%(handle)s)",
-                   {"handle": user})
-     data = cursor.fetchone()
-     if data is not None and data[0] == password:
+async def auth_registrar(user, password):
+     if credentials_cache.check(user, password):
          return True
-     return False
+     generation = credentials_cache.generation
+     data = await db.fetchone("registrar_password", {"handle": user})
+     if data is None:
+         return False
+     return await verify_registrar(user, password, data[0], generation)
+
+async def verify_registrar(user, password, stored, generation):
+     """ For the queries which read the stored password with other
+     things. generation is the one of the credentials cache before the
+     query. """
+     if stored is None or password is None:
+         return False
+     # PBKDF2 is slow on purpose, do not block the ASGI event loop. The
+     # wrong passwords, and too many of them, are refused without it.
+     return await db.run_blocking(credentials_cache.verify, user, password, stored, generation,
+                                 current_address.get())
+
+def conditional_generation():
+    """ To call before reading the column updated, see remember """
+    return None if conditional_cache is None else conditional_cache.generation
+
+def remember(kind, key, date, generation):
+    if generation is not None and key is not None:
+        conditional_cache.add(kind, key, date, generation)
+
+async def updated(kind, key):
+    """ The date of the last change of a domain or a contact, from the
+    cache when possible, None if it does not exist """
+    if conditional_cache is not None:
+        date = conditional_cache.get(kind, key)
+        if date is not None:
+            return date
+    generation = conditional_generation()
+    data = await db.fetchone("%s_updated" % kind, {kind: key})
+    if data is None:
+        return None
+    remember(kind, key, data[0], generation)
+    return data[0]
+
+async def check_modified(kind, key, conditions):
+    """ For a GET: the response 304 if the client has the current
+    version of the object, None otherwise """
+    if key is None or \
+       (conditions.get("if_none_match") is None and conditions.get("if_modified_since") is None):
+        return None
+    date = await updated(kind, key)
+    if date is None or not conditional.not_modified(conditions, date):
+        return None
+    status = {"code": 304, "message": "Not Modified"}
+    add_validators(status, date)
+    return status, {}
+
+def add_validators(status, date):
+    status["etag"] = conditional.etag(date)
+    status["last_modified"] = conditional.last_modified(date)
+
+def changed(kind, key):
+    """ The notification will come later, other requests of this
+    process must not get a 304 or the old object meanwhile. """
+    if conditional_cache is not None and key is not None:
+        conditional_cache.invalidate(kind, key)
+    if object_cache is not None and key is not None:
+        object_cache.invalidate(kind, key)
+
+def contact_key(contact):
+    """ The handle as in the notifications, None if it is not a
+    number """
+    try:
+        return str(int(contact))
+    except ValueError:
+        return None
 
 # Business rules
 def registerable(domain):
@@ -197,36 +628,72 @@ def registerable(domain):
     else:
         return (True, )
 
+def contact_name(data):
+    """ The name stored for a contact already validated with the entity
+    schema, None if it has no surname """
+    given = ""
+    surname = None
+    for component in data["name"]["components"]:
+        if component["kind"] == "given":
+            given = component["value"]
+        if component["kind"] == "surname":
+            surname = component["value"]
+    if not surname:
+        return None
+    return given + " " + surname
+
 def validate_json(input, klass="domain", method="put"):
-    data = {}
     ojson = json.loads(input)
-    if klass == "domain":
-        if method == "put":
-            jsonschema.validate(instance=ojson, schema=domain_schema)
-        elif method == "patch":
-            jsonschema.validate(instance=ojson, schema=patch_domain_schema)
-        else:
-            raise NoValidationForThisMethod(method)
-    elif klass == "contact":
-        if method == "put":
-            jsonschema.validate(instance=ojson, schema=entity_schema)
-        else:
-            raise NoValidationForThisMethod(method)
-    else:                
+    if klass not in ("domain", "contact"):
         raise NoValidationForThisClass(klass)
+    if (klass, method) not in validators:
+        raise NoValidationForThisMethod(method)
+    validators.validate(ojson, klass, method)
     return ojson
 
-def availability_domain(domain, method, extra, client, password):
-    data = head_domain(domain)
+async def check_domains(names):
+    """ Availability of many domains, with only one query to the
+    database. Returns a list of results in the same order. """
+    results = []
+    candidates = []
+    for name in names:
+        name = name.lower()
+        if not name.endswith(".%s" % TLD):
+            results.append({"name": name, "available": False,
+                            "reason": "Domain name must be under .%s" % TLD})
+            continue
+        result = {"name": name, "available": True}
+        regable = registerable(name)
+        if not regable[0]:
+            result["available"] = False
+            result["reason"] = regable[1]
+        else:
+            candidates.append(name)
+        results.append(result)
+    if availability_filter is not None:
+        candidates = [name for name in candidates \
+                      if availability_filter.lookup(name) is not False]
+    existing = set()
+    if candidates:
+        for data in await db.fetchall("check_domains", {"names": candidates}):
+            existing.add(data[0])
+    for result in results:
+        if result["name"] in existing:
+            result["available"] = False
+            result["reason"] = "Domain %s already exists" % result["name"]
+    return results
+
+async def availability_domain(domain, method, extra, client, password):
+    exists = await domain_exists(domain)
     if method == "HEAD":
-        if data is None:
+        if not exists:
             return ({"code": 404,  "message": "Not found"},
                     {"result": "Domain %s NOT found" % domain})
         else:
             return ({"code": 200,  "message": "Found"},
                {"result": "Domain %s already exists" % domain})
     elif method == "GET":
-        if data is None:
+        if not exists:
             regable = registerable(domain)
             if regable[0]:
                 info = "It can be registered"
@@ -240,83 +707,85 @@ def availability_domain(domain, method, extra, client, password):
     else:
         return {"code": 405, "message": "Method %s not supported" % method}, {}
 
-def transfer_domain(domain, method, extra, client, password):
-    authenticated = auth_registrar(client, password)
-    if not authenticated:
+def transfer_changed(domain):
+    """ The state read by transfer_state was changed by another
+    request before our statement. """
+    return ({"code": 409, "message": "Conflict"},
+            {"result": "The transfer of %s was changed meanwhile, try again" % domain})
+
+async def transfer_domain(domain, method, extra, client, password):
+    # The password, the domain and its pending transfer in one query
+    cached = credentials_cache.check(client, password)
+    generation = credentials_cache.generation
+    (registrar, stored, created, winner) = await db.fetchone("transfer_state",
+                                                             {"domain": domain, "handle": client})
+    if not cached and not await verify_registrar(client, password, stored, generation):
         status = {"code": 401,  "message": "Wrong password"}
         output = {"result": "You must authenticate properly"}
         return status,output
-    output = info_domain(domain)
-    if output is None:
+    if registrar is None:
        return ({"code": 404,  "message": "Not found"},
                {"result": "Domain %s NOT found" % domain})
     if method == "GET":
-        cursor.execute("SELECT id, created, winner FROM Transfers WHERE NOT completed and domain= (%(domain)s)",
-                   {"domain": domain})
-        data = cursor.fetchone()
-        if data is None:
+        if winner is None:
             return {"code": 200, "message": "OK"}, {"result": "No pending transfer for %s" % (domain)}
         else:
-            return {"code": 200, "message": "OK"}, {"result": "Domain %s has a transfer to registrar %s pending (since %s)" % (domain, data[2], data[1])}
+            return {"code": 200, "message": "OK"}, {"result": "Domain %s has a transfer to registrar %s pending (since %s)" % (domain, winner, created)}
     elif method == "POST":
         if extra is None:
-            data = info_domain(domain)
-            if data["registrar"] == client:
+            if registrar == client:
                 return ({"code": 200, "message": "OK"},
                         {"result": "%s is already the registrar of %s" % (client, domain)})   
-            cursor.execute("SELECT id, created, winner FROM Transfers WHERE NOT completed and domain= (%(domain)s)",
-                   {"domain": domain})
-            data = cursor.fetchone()
-            if data is not None:
-                return {"code": 200, "message": "OK"}, {"result": "Domain %s already has a transfer to registrar %s pending (since %s)" % (domain, data[2], data[1])}
-            cursor.execute("INSERT INTO Transfers (domain, winner, completed) VALUES ((%(domain)s), (%(to)s), false)", {"domain": domain, "to": client})
-            connection.commit()
+            if winner is not None:
+                return {"code": 200, "message": "OK"}, {"result": "Domain %s already has a transfer to registrar %s pending (since %s)" % (domain, winner, created)}
+            if await db.execute("start_transfer", {"domain": domain, "client": client}) != 1:
+                await db.rollback()
+                return transfer_changed(domain)
+            await db.commit()
             return ({"code": 200, "message": "OK"},
                     {"result": "Domain %s transfer to registrar %s started" % (domain, client)})
         else:
-            cursor.execute("SELECT winner FROM Transfers WHERE NOT completed and domain = (%(domain)s)",
-                   {"domain": domain})
-            data = cursor.fetchone()
-            if data is None:
+            if winner is None:
                 return {"code": 404, "message": "No transfer"}, {"result": "No pending transfer of %s to act on" % (domain)}
-            else:
-                winner = data[0]
             if extra == "cancelation":
                 if winner != client:
                     return {"code": 403, "message": "Not yours"}, {"result": "This is not your transfer"}                    
-                cursor.execute("DELETE FROM Transfers WHERE NOT completed and domain= (%(domain)s)",
-                   {"domain": domain})
-                connection.commit()
+                if await db.execute("cancel_transfer", {"domain": domain, "client": client}) != 1:
+                    await db.rollback()
+                    return transfer_changed(domain)
+                await db.commit()
                 return {"code": 200, "message": "OK"}, {"result": "Transfer of %s cancelled" % (domain)}
             elif extra == "approval":
-                data = info_domain(domain)
-                if data["registrar"] != client:
+                if registrar != client:
                     return {"code": 403, "message": "Not yours"}, {"result": "This is not your domain currently"}
-                cursor.execute("UPDATE Transfers SET completed=true WHERE NOT completed AND domain = (%(domain)s)",
-                   {"domain": domain})
-                if cursor.rowcount != 1:
-                    return {"code": 500, "message": "Internal error"}, {"result": "Update of transfer failed"}                
-                cursor.execute("UPDATE Domains SET registrar=%(winner)s WHERE name = (%(domain)s)",
-                   {"winner": winner, "domain": domain})
-                if cursor.rowcount != 1:
-                    return {"code": 500, "message": "Internal error"}, {"result": "Update of %s faled" % (domain)}
-                connection.commit()
+                try:
+                    approved = await db.execute("approve_transfer", {"domain": domain, "client": client})
+                except db.errors.CheckViolation:
+                    # The quota of the winner, see create.sql
+                    await db.rollback()
+                    return ({"code": 400, "message": "Quota exceeded"},
+                            {"result": "Registrar %s has too many domains already" % winner})
+                if approved != 1:
+                    await db.rollback()
+                    return transfer_changed(domain)
+                await db.commit()
+                changed("domain", domain)
                 return {"code": 200, "message": "OK"}, {"result": "Transfer of %s approved" % (domain)}                
             elif extra == "rejection":
-                data = info_domain(domain)
-                if data["registrar"] != client:
+                if registrar != client:
                     return {"code": 403, "message": "Not yours"}, {"result": "This is not your domain currently"}
-                cursor.execute("DELETE FROM Transfers WHERE NOT completed and domain= (%(domain)s)",
-                   {"domain": domain})
-                connection.commit()
+                if await db.execute("reject_transfer", {"domain": domain, "client": client}) != 1:
+                    await db.rollback()
+                    return transfer_changed(domain)
+                await db.commit()
                 return {"code": 200, "message": "OK"}, {"result": "Transfer of %s rejected" % (domain)}
             else:
                 return {"code": 400, "message": "Unknown transfer extra command"}, {"result": "Unnown transfer extra command %s" % extra}
     else:
-        return {"code": 405, "message": "Method %s not supported" % method}, output
+        return {"code": 405, "message": "Method %s not supported" % method}, {}
     
-def handle_domain(domain, method, operation=None, extra=None, length=0, body=None,
-                  user=None, password=None):
+async def handle_domain(domain, method, operation=None, extra=None, length=0, body=None,
+                  user=None, password=None, conditions={}):
     domain = domain.lower()
     status = {"code": 200, "message": "OK"}
     output = {}
@@ -325,30 +794,33 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
         return status, output
     # The specific operations:
     if operation == "transfer":
-        result = transfer_domain(domain, method, extra, user, password)
+        result = await transfer_domain(domain, method, extra, user, password)
         return result[0], result[1]
     elif operation == "availability":
-        result = availability_domain(domain, method, extra, user, password)
+        result = await availability_domain(domain, method, extra, user, password)
         return result[0], result[1]
     elif operation is not None:
         return {"code": 400, "message": "Unknown operation"}, {"result": "Unknown operation %s for domain %s" % (operation, domain)}
     # The general case (nothing was after the domain name):
     if method == "HEAD":
-        output = head_domain(domain)
         # Output will be typically ignored by the client when using
         # HEAD (curl --head will not display it). RFC 9110, section
         # 6.4.1.
-        if output is None:
+        if not await domain_exists(domain):
             status = {"code": 404,  "message": "Not found"}
-            output = {}
-        else:
-            output = {}
+        output = {}
     elif method == "GET":
-        output = info_domain(domain)
+        result = await check_modified("domain", domain, conditions)
+        if result is not None:
+            return result
+        generation = conditional_generation()
+        output = await info_domain(domain)
         if output is None:
             status = {"code": 404,  "message": "Not found"}
             output = {"result": "Domain %s NOT found" % domain}
         else:
+            add_validators(status, output["updated"])
+            remember("domain", domain, output["updated"], generation)
             output = {"result": "Domain %s exists" % domain,
                       "holder": output["holder"],
                       "tech_contact": output["tech"],
@@ -360,7 +832,7 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
             status = {"code": 401,  "message": "Unauthenticated"}
             output = {"result": "You must authenticate to create a domain"}
             return status,output
-        authenticated = auth_registrar(user, password)
+        authenticated = await auth_registrar(user, password)
         if not authenticated:
             status = {"code": 401,  "message": "Wrong password"}
             output = {"result": "You must authenticate properly"}
@@ -374,7 +846,7 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
         try:
             data = validate_json(jinput)
             try:
-                store_domain(domain, data["holder"], data["tech"], data["admin"], user)
+                await store_domain(domain, data["holder"], data["tech"], data["admin"], user)
                 status = {"code": 201,  "message": "Created"}
                 output = {"result": "%s created" % domain} 
             except AlreadyExists:
@@ -383,6 +855,9 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
             except TooManyDomains:
                 status = {"code": 400,  "message": "Too many"}
                 output = {"result": "Too many domains already"}
+            except QuotaExceeded:
+                status = {"code": 400,  "message": "Quota exceeded"}
+                output = {"result": "Registrar %s has too many domains already" % user}
             except Conflict:
                 status = {"code": 500,  "message": "Conflict"}
                 output = {"result": "Internal conflict"}
@@ -397,12 +872,11 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
             status = {"code": 401,  "message": "Unauthenticated"}
             output = {"result": "You must authenticate as the registrar of %s" % domain}
             return status,output
-        authenticated = auth_registrar(user, password)
+        authenticated = await auth_registrar(user, password)
         if not authenticated:
             status = {"code": 401,  "message": "Wrong password"}
             output = {"result": "You must authenticate properly"}
             return status,output
-        # TODO check this is the proper registrar
         if body is None:
              status = {"code": 400,  "message": "Empty"}
              output = {"result": "No JSON body to patch %s" % domain}
@@ -411,7 +885,7 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
         try:
             data = validate_json(jinput, "domain", "patch")
             try:
-                (status, output) = patch_domain(domain, data)
+                (status, output) = await patch_domain(domain, data, user, conditions.get("if_match"))
             except Conflict:
                 status = {"code": 500,  "message": "Conflict"}
                 output = {"result": "Internal conflict"}
@@ -427,22 +901,25 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
             status = {"code": 401,  "message": "Unauthenticated"}
             output = {"result": "You must authenticate as the registrar of %s" % domain}
             return status,output
-        info = info_domain(domain)
-        if info is None:
+        # Ownership and password in one query
+        cached = credentials_cache.check(user, password)
+        generation = credentials_cache.generation
+        (registrar, stored) = await db.fetchone("domain_and_password",
+                                                {"domain": domain, "handle": user})
+        if registrar is None:
             status = {"code": 404,  "message": "Not found"}
             output = {"result": "%s does not exist" % domain} 
             return status, output
-        if user != info["registrar"]:
+        if user != registrar:
             status = {"code": 403,  "message": "Forbidden"}
-            output = {"result": "You (%i) are not the registrar of %s (%i)" % (user, domain, info["registrar"])} 
+            output = {"result": "You (%i) are not the registrar of %s (%i)" % (user, domain, registrar)} 
             return status, output
-        authenticated = auth_registrar(user, password)
-        if not authenticated:
+        if not cached and not await verify_registrar(user, password, stored, generation):
             status = {"code": 401,  "message": "Wrong password"}
             output = {"result": "You must authenticate as the registrar of %s" % domain}
             return status,output
         try:
-            delete_domain(domain)
+            await delete_domain(domain)
             status = {"code": 202,  "message": "Accepted"}
             output = {"result": "%s deleted" % domain} 
         except DoesNotExist:
@@ -455,22 +932,110 @@ def handle_domain(domain, method, operation=None, extra=None, length=0, body=Non
         return {"code": 405, "message": "Method %s not supported" % method}, output
     return status, output
 
-def handle_contact(contact, method, length=None, body=None):
+async def handle_patch_domains(method, length, body, user, password):
+    if method != "POST":
+        return {"code": 405, "message": "Method %s not supported for /patch-domains" % method}, {}
+    if user is None:
+        return ({"code": 401,  "message": "Unauthenticated"},
+                {"result": "You must authenticate as the registrar of the domains"})
+    if not await auth_registrar(user, password):
+        return ({"code": 401,  "message": "Wrong password"},
+                {"result": "You must authenticate properly"})
+    try:
+        data = validate_json(body.read(length), "domain", "batch")
+    except jsonschema.exceptions.ValidationError as e:
+        return {"code": 400, "message": "Invalid JSON"}, {"result": "Invalid JSON body (%s)" % e}
+    except json.decoder.JSONDecodeError:
+        return {"code": 400, "message": "Invalid"}, {"result": "Invalid JSON body"}
+    if len(data["names"]) == 0 or len(data["names"]) > MAX_PATCH:
+        return ({"code": 400, "message": "Invalid number of names"},
+                {"result": "Between 1 and %i names can be changed at once" % MAX_PATCH})
+    try:
+        return await patch_domains(data["names"], data["change"], user)
+    except Conflict:
+        return {"code": 500,  "message": "Conflict"}, {"result": "Internal conflict"}
+
+async def handle_list_domains(method, query):
+    if method != "GET":
+        return {"code": 405, "message": "Method %s not supported for /list-domains" % method}, {}
+    after = query.get("after", [None])[0]
+    limit = query.get("limit", [None])[0]
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0 or limit > MAX_LIST_LIMIT:
+            return ({"code": 400, "message": "Invalid limit"},
+                    {"result": "limit must be between 1 and %i" % MAX_LIST_LIMIT})
+    return {"code": 200, "message": "OK"}, await list_domains(after, limit)
+
+async def handle_export_domains(method, query):
+    if method != "GET":
+        return {"code": 405, "message": "Method %s not supported for /export-domains" % method}, {}
+    format = query.get("format", ["ndjson"])[0]
+    if format not in EXPORTS:
+        return ({"code": 400, "message": "Invalid format"},
+                {"result": "format must be one of %s" % ", ".join(EXPORTS)})
+    (sequence, output) = await export_domains(format)
+    return {"code": 200, "message": "OK", "changes_sequence": sequence}, output
+
+async def handle_changes(method, query):
+    if method != "GET":
+        return {"code": 405, "message": "Method %s not supported for /changes" % method}, {}
+    try:
+        after = int(query.get("after", ["0"])[0])
+        limit = int(query.get("limit", [str(MAX_CHANGES)])[0])
+    except ValueError:
+        (after, limit) = (-1, 0)
+    if after < 0 or limit <= 0 or limit > MAX_CHANGES:
+        return ({"code": 400, "message": "Invalid parameters"},
+                {"result": "after must be a sequence number and limit between 1 and %i" % MAX_CHANGES})
+    return {"code": 200, "message": "OK"}, await changes(after, limit)
+
+async def handle_contact(contact, method, length=None, body=None, conditions={}, query={}):
     status = {"code": 200, "message": "OK", }
     output = {}
-    if method == "HEAD":
-        output = head_contact(contact)
+    if method == "GET" and contact == "":
+        name = query.get("name", [""])[0]
+        match = query.get("match", ["prefix"])[0]
+        if name == "" or match not in SEARCHES:
+            return ({"code": 400, "message": "Invalid search"},
+                    {"result": "name is mandatory and match must be one of %s" % ", ".join(SEARCHES)})
+        try:
+            limit = int(query.get("limit", [str(SEARCH_LIMIT)])[0])
+        except ValueError:
+            limit = 0
+        after = search_cursor(query.get("after", [None])[0], match)
+        if limit <= 0 or limit > MAX_SEARCH_LIMIT or after is None:
+            return ({"code": 400, "message": "Invalid parameters"},
+                    {"result": "limit must be between 1 and %i and after the next of a previous page" % MAX_SEARCH_LIMIT})
+        try:
+            output = await search_contacts(name, match, after, limit)
+        except db.errors.UndefinedFunction:
+            # The fuzzy search needs the extension pg_trgm
+            await db.rollback()
+            return ({"code": 501, "message": "Not implemented"},
+                    {"result": "The fuzzy search is not available on this server"})
+    elif method == "HEAD":
+        output = await head_contact(contact)
         if output is None:
             status = {"code": 404,  "message": "Not found"}
             output = {"result": "Contact %s NOT found" % contact}
         else:
             output = {"result": "Contact %s exists" % contact}
     elif method == "GET":
-        output = info_contact(contact)
+        result = await check_modified("contact", contact_key(contact), conditions)
+        if result is not None:
+            return result
+        generation = conditional_generation()
+        output = await info_contact(contact)
         if output is None:
             status = {"code": 404,  "message": "Not found"}
             output = {"result": "Contact %s NOT found" % contact}
         else:
+            add_validators(status, output["updated"])
+            remember("contact", contact_key(contact), output["updated"], generation)
             output = {"result": "Contact %s exists" % contact,
                       "name": output["name"], "created": output["created"]}
     elif method == "PUT":    
@@ -482,18 +1047,10 @@ def handle_contact(contact, method, length=None, body=None):
         try:
             data = validate_json(jinput, "contact")
             try:
-                root = data["name"]["components"]
-                given = ""
-                surname = None
-                for component in root:
-                    if component["kind"] == "given":
-                        given = component["value"]
-                    if component["kind"] == "surname":
-                        surname = component["value"]
-                if not surname:
+                fullname = contact_name(data)
+                if fullname is None:
                     raise Exception("No surname???")
-                fullname = given + " " + surname
-                handle = store_contact(fullname)
+                handle = await store_contact(fullname)
                 status = {"code": 201,  "message": "Created"}
                 output = {"result": "%s (%s) created" % (handle, data["name"])} 
             except TooManyContacts:
@@ -507,7 +1064,7 @@ def handle_contact(contact, method, length=None, body=None):
             output = {"result": "Invalid JSON body"}
     elif method == "DELETE":    
         try:
-            delete_contact(contact)
+            await delete_contact(contact)
             status = {"code": 202,  "message": "Accepted"}
             output = {"result": "%s deleted" % contact} 
         except DoesNotExist:
@@ -520,21 +1077,372 @@ def handle_contact(contact, method, length=None, body=None):
         return {"code": 405, "message": "Method %s not supported" % method}, output
     return status, output
 
+class Database:
+    """ The database of one request, for the synchronous front
+    end. The methods are coroutines so the same business logic can
+    run with the asynchronous database of the ASGI front end but they
+    never suspend. """
+    errors = psycopg2.errors
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        # Queries sent to PostgreSQL during this request, and the
+        # time (seconds) they took
+        self.round_trips = 0
+        self.db_time = 0.0
+
+    def run(self, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.round_trips += 1
+            self.db_time += time.perf_counter() - start
+
+    async def execute(self, name, args=None):
+        """ Runs the statement 'name' of the query catalog (see
+        queries.py). Returns the number of rows affected """
+        self.run(self.cursor.execute, queries.STATEMENTS[name].execute, args)
+        return self.cursor.rowcount
+
+    async def fetchone(self, name, args=None):
+        self.run(self.cursor.execute, queries.STATEMENTS[name].execute, args)
+        return self.cursor.fetchone()
+
+    async def fetchall(self, name, args=None):
+        self.run(self.cursor.execute, queries.STATEMENTS[name].execute, args)
+        return self.cursor.fetchall()
+
+    async def commit(self):
+        self.run(self.connection.commit)
+
+    async def rollback(self):
+        self.run(self.connection.rollback)
+
+    async def run_blocking(self, function, *args):
+        return function(*args)
+
+    async def explain(self, name, args=None):
+        """ The plan (EXPLAIN ANALYZE, in JSON) of the statement 'name',
+        run again in a savepoint which is rolled back, see
+        tracing.py. When it fails the second time (an INSERT, for
+        instance), the plan without ANALYZE. Not counted in
+        round_trips. """
+        with self.connection.cursor() as cursor:
+            for options in tracing.EXPLAIN:
+                cursor.execute("SAVEPOINT explain")
+                try:
+                    cursor.execute("EXPLAIN (%s) %s" % (options, queries.STATEMENTS[name].execute), args)
+                    return cursor.fetchone()[0]
+                except psycopg2.Error:
+                    if options == tracing.EXPLAIN[-1]:
+                        raise
+                finally:
+                    cursor.execute("ROLLBACK TO SAVEPOINT explain")
+
+    async def stream(self, name, args=None, size=1000):
+        """ Yields lists of rows, read from a server-side cursor. It
+        uses its own connection since it runs after the request
+        returned its connection to the pool. A cursor cannot use a
+        prepared statement, so the SQL is sent. """
+        with database.connection() as connection:
+            with connection.cursor(name="stream") as cursor:
+                cursor.execute(queries.STATEMENTS[name].sql, args)
+                while True:
+                    rows = cursor.fetchmany(size)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def copy(self, name):
+        """ Yields the output of the COPY 'name' (see queries.COPIES) in
+        pieces of about COPY_CHUNK bytes, from its own connection,
+        like stream. psycopg2 can only write it to a file, so the COPY
+        runs in a thread which hands the pieces over through a
+        queue. """
+        writer = CopyWriter()
+        def run():
+            try:
+                with database.connection() as connection:
+                    try:
+                        with connection.cursor() as cursor:
+                            cursor.copy_expert(queries.COPIES[name], writer, COPY_CHUNK)
+                        writer.flush()
+                    except Abandoned:
+                        # In the middle of the COPY, it cannot be reused
+                        connection.close()
+                        return
+                writer.hand_over(None)
+            except Abandoned:
+                pass
+            except Exception as e:
+                try:
+                    writer.hand_over(e)
+                except Abandoned:
+                    pass
+        threading.Thread(target=run, name="copy", daemon=True).start()
+        try:
+            while True:
+                piece = writer.pieces.get()
+                if piece is None:
+                    break
+                if isinstance(piece, Exception):
+                    raise piece
+                yield piece
+        finally:
+            writer.stopped.set()
+
+    def close(self):
+        self.cursor.close()
+
+class CopyWriter:
+    """ The file given to copy_expert by Database.copy. psycopg2
+    writes each row separately, they are grouped. """
+
+    def __init__(self):
+        self.pieces = queue.Queue(COPY_QUEUE)
+        self.stopped = threading.Event()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= COPY_CHUNK:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.hand_over(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def hand_over(self, item):
+        """ Waits for room in the queue, raises Abandoned if the reader
+        stopped """
+        while not self.stopped.is_set():
+            try:
+                self.pieces.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise Abandoned
+
+class CurrentDatabase:
+    """ Gives access to the database of the current request (a
+    thread for WSGI, a task for ASGI). """
+    def __getattr__(self, name):
+        return getattr(current_database.get(), name)
+
+def iterate_sync(iterator):
+    """ The synchronous version of an asynchronous iterator which
+    never suspends """
+    try:
+        while True:
+            try:
+                yield run_sync(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(iterator.aclose())
+
+def run_sync(coroutine):
+    """ Runs a coroutine which never suspends, which is the case of
+    the business logic with the synchronous Database. """
+    try:
+        coroutine.send(None)
+    except StopIteration as result:
+        return result.value
+    coroutine.close()
+    raise RuntimeError("The synchronous front end cannot wait")
+
 def dispatch(environ, start_response):
+    setup()
+    if environ["PATH_INFO"] == "/metrics":
+        body = instrumentation.render().encode()
+        start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+    start = time.monotonic()
+    request_database = None
+    try:
+        if store is not None:
+            request_database = memory.Database(store)
+            (status, output) = process(request_database, environ)
+        else:
+            # Each request gets its own connection from the pool, so
+            # several threads can run dispatch at the same time.
+            with database.connection() as connection:
+                request_database = Database(connection)
+                (status, output) = process(request_database, environ)
+    except pool.PoolExhausted:
+        logger.error("No database connection available")
+        (status, output) = SERVER_BUSY.response()
+    except psycopg2.extensions.TransactionRollbackError as e:
+        # The pool rolled back, the connection is kept
+        logger.error("Transaction failed: %s" % e)
+        (status, output) = CONFLICT.response()
+    except psycopg2.extensions.QueryCanceledError as e:
+        logger.error("Query canceled: %s" % e)
+        (status, output) = QUERY_CANCELED.response()
+    except psycopg2.OperationalError as e:
+        logger.error("Database error: %s" % e)
+        (status, output) = DATABASE_UNAVAILABLE.response()
+    record_transaction(environ, status, time.monotonic() - start, request_database)
+    return send(start_response, status, output)
+
+def process(request_database, environ):
+    """ Runs the request with request_database as the current
+    database """
+    token = current_database.set(request_database if tracer is None else \
+                                 tracer.wrap(request_database, environ))
+    address = current_address.set(environ.get("REMOTE_ADDR"))
+    try:
+        return run_sync(handle_request(environ))
+    finally:
+        current_address.reset(address)
+        current_database.reset(token)
+        request_database.close()
+
+def record_transaction(environ, status, latency, request_database=None):
+    """ Called by the front ends once the response is ready: log,
+    metrics and Server-Timing header """
+    (round_trips, db_time) = (0, 0.0)
+    if request_database is not None:
+        (round_trips, db_time) = (request_database.round_trips, request_database.db_time)
+    translog.transaction(logger, environ, status, latency,
+                         config["log_sample_rate"], round_trips=round_trips)
+    if config["metrics"]:
+        instrumentation.observe(environ["PATH_INFO"], environ["REQUEST_METHOD"],
+                                status["code"], latency, round_trips, db_time)
+        status["server_timing"] = metrics.server_timing(latency, round_trips, db_time)
+
+async def next_transaction_id():
+    """ See idempotency.TransactionIds """
+    identifier = transaction_ids.take()
+    while identifier is None:
+        transaction_ids.refill((await db.fetchone("next_transaction_ids"))[0])
+        identifier = transaction_ids.take()
+    return identifier
+
+async def find_replay(key, password):
+    """ The response to send again if the request is a retry, None
+    otherwise """
+    entry = replay_cache.get(key)
+    if entry is None and config["replay_shared"]:
+        (registrar, cltrid, method, path) = key
+        data = await db.fetchone("find_replay", {"registrar": registrar, "cltrid": cltrid,
+                                                 "method": method, "path": path,
+                                                 "window": config["replay_window"]})
+        if data is not None:
+            status = {"code": data[0], "message": data[1], "svtrid": data[2], "cltrid": cltrid}
+            if data[4] is not None:
+                (status["etag"], status["last_modified"]) = (data[4], data[5])
+            entry = (status, json.loads(data[3]))
+            replay_cache.add(key, *entry)
+    if entry is None:
+        return None
+    # Only to the client which sent the first request
+    if not await auth_registrar(key[0], password):
+        return None
+    return dict(entry[0], replayed=True), dict(entry[1])
+
+async def keep_response(key, status, output):
+    if key is None:
+        return
+    entry = idempotency.kept(status, output)
+    if entry is None:
+        return
+    replay_cache.add(key, *entry)
+    if config["replay_shared"]:
+        (registrar, cltrid, method, path) = key
+        try:
+            await db.execute("store_replay", {"registrar": registrar, "cltrid": cltrid,
+                                              "method": method, "path": path,
+                                              "code": entry[0]["code"], "message": entry[0]["message"],
+                                              "svtrid": entry[0]["svtrid"],
+                                              "output": dumps(entry[1]).decode(),
+                                              "etag": entry[0].get("etag"),
+                                              "last_modified": entry[0].get("last_modified"),
+                                              "window": config["replay_window"]})
+            if next(replays_stored) % REPLAY_CLEANUP == 0:
+                await db.execute("expire_replays", {"window": config["replay_window"]})
+            await db.commit()
+        except db.errors.Error as e:
+            # The request itself was done, the client must get its
+            # response.
+            logger.error("Cannot store the response for the retries: %s" % e)
+            await db.rollback()
+
+async def admit(user, password, method):
+    """ Returns the 429 to send, or None and a function to call when
+    the request is over. First, before any verification of the
+    password, the claimed registrar must not have failed too many
+    of them from this address (see credentials.py), even without
+    admission control.
+    Then, only the authenticated registrars are limited, so nobody can
+    use up the tokens of another one. """
+    if user is None:
+        return None, None
+    wait = credentials_cache.throttled(user, password, current_address.get())
+    if wait > 0:
+        return throttled(user, "authentication", "failures", max(1, math.ceil(wait)),
+                         "Too many failed authentications for registrar %i" % user), None
+    controller = admission_controller
+    if controller is None or not await auth_registrar(user, password):
+        return None, None
+    refused = controller.admit(user, method)
+    if refused is None:
+        return None, lambda: controller.done(user, method)
+    (operation, reason, retry_after) = refused
+    return throttled(user, operation, reason, retry_after,
+                     "Too many %s requests for registrar %i" % (operation, user)), None
+
+def throttled(user, operation, reason, retry_after, message):
+    if config["metrics"]:
+        instrumentation.count("rpp_throttled_total", (str(user), operation, reason))
+    return ({"code": 429, "message": "Too many requests", "retry_after": retry_after},
+            {"result": "%s, try again in %i s" % (message, retry_after)})
+
+def set_rate_limits(limits):
+    """ Changes the limits of this process at run time (see
+    admission.py for the syntax), None removes them. Raises
+    admission.InvalidLimits. """
+    global admission_controller
+    config["rate_limits"] = limits
+    if limits is None:
+        admission_controller = None
+    elif admission_controller is None:
+        admission_controller = admission.Controller(limits)
+    else:
+        admission_controller.configure(limits)
+
+def conditions(environ):
+    """ The headers of the conditional requests """
+    return {"if_match": environ.get("HTTP_IF_MATCH"),
+            "if_none_match": environ.get("HTTP_IF_NONE_MATCH"),
+            "if_modified_since": environ.get("HTTP_IF_MODIFIED_SINCE")}
+
+async def handle_request(environ):
+    """ Processes one request and returns the status and the output to
+    send. environ is a WSGI environment, the ASGI front end builds
+    one. """
     method = environ["REQUEST_METHOD"]
     path = environ["PATH_INFO"]
     client_transaction_id = None
     if "HTTP_RPP_CLTRID" in environ:
         client_transaction_id = environ["HTTP_RPP_CLTRID"]
-    server_transaction_id = random.randint(0, 999999)
+    server_transaction_id = await next_transaction_id()
+    # For the log, see translog.py
+    environ["rpp.svtrid"] = server_transaction_id
     # TODO check that the client accepts JSON
     # TODO create status with the control id for all commands
-    do_list_domains = False
     # TODO Test the type of the body is application/rpp+json?
     # TODO return RPP-code
-    if not path.startswith("/domains/") and  not path.startswith("/entities/") and not path.startswith("/list-domains"):
-        status = {"code": 400, "message": "Path must start with /domains, /entities or be /list-domains"}
-        return send(start_response, status, {})
+    (resource, parameters) = route(path)
+    if parameters is None or (resource == "domains" and parameters[0] == ""):
+        if resource == "domains":
+            return ({"code": 400, "message": "Invalid path syntax"},
+                    {"result": "Invalid path syntax for %s" % path.removeprefix("/domains/")})
+        return BAD_PATH.response()
     try:
         body_size = int(environ.get("CONTENT_LENGTH", 0))
     except ValueError:
@@ -549,81 +1457,288 @@ def dispatch(environ, start_response):
             if len(auth) == 2:
                 user, password = auth
                 user = int(user)
-    if path == "/list-domains":
-        do_list_domains = True
-    elif path.startswith("/domains/"):
-        domain = path.removeprefix("/domains/")
-        if domain == "":
-            raise Exception("Empty domain") # TODO return better error
-        operation = None
-        extra = None
-        if "/" in domain:
-            array = domain.split("/")
-            if len(array) > 3:
-                return send(start_response,
-                            status = {"code": 400,
-                                      "message": "Invalid path syntax"},
-                            output = {"result": "Invalid path syntax for %s" % \
-                                      (domain)});
-            if len(array) > 2:
-                extra = array[2]
-            if len(array) > 1:
-                operation = array[1]
-            domain = array[0]
-        result = handle_domain(domain, method, operation, extra,
-                               body_size, environ["wsgi.input"],
-                               user, password)
+                environ["rpp.registrar"] = user
+    replay_key = None
+    if client_transaction_id is not None and user is not None and \
+       method in idempotency.METHODS and resource in ("domains", "entities", "patch-domains"):
+        replay_key = (user, client_transaction_id, method, path)
+        replay = await find_replay(replay_key, password)
+        if replay is not None:
+            return replay
+    if resource in ("list-domains", "export-domains", "changes"):
+        query = urllib.parse.parse_qs(environ.get("QUERY_STRING", ""))
+        if resource == "list-domains":
+            result = await handle_list_domains(method, query)
+        elif resource == "export-domains":
+            result = await handle_export_domains(method, query)
+        else:
+            result = await handle_changes(method, query)
+        status = result[0]
+        if client_transaction_id is not None:
+            status["cltrid"] = client_transaction_id
+        status["svtrid"] = server_transaction_id
+        return status, result[1]
+    elif resource == "check-domains":
+        if method != "POST":
+            return {"code": 405, "message": "Method %s not supported for /check-domains" % method}, {}
+        try:
+            names = validate_json(environ["wsgi.input"].read(body_size), "domain", "check")
+        except jsonschema.exceptions.ValidationError as e:
+            return {"code": 400, "message": "Invalid JSON"}, {"result": "Invalid JSON body (%s)" % e}
+        except json.decoder.JSONDecodeError:
+            return {"code": 400, "message": "Invalid"}, {"result": "Invalid JSON body"}
+        if len(names) > MAX_CHECK:
+            return ({"code": 400, "message": "Too many names"},
+                    {"result": "At most %i names can be checked at once" % MAX_CHECK})
+        status = {"code": 200, "message": "OK"}
+        if client_transaction_id is not None:
+            status["cltrid"] = client_transaction_id
+        status["svtrid"] = server_transaction_id
+        return status, {"results": await check_domains(names)}
+    elif resource == "patch-domains":
+        (result, done) = await admit(user, password, method)
+        if result is None:
+            try:
+                result = await handle_patch_domains(method, body_size, environ["wsgi.input"],
+                                                    user, password)
+            finally:
+                if done is not None:
+                    done()
+        status = result[0]
+        if client_transaction_id is not None:
+            status["cltrid"] = client_transaction_id
+        status["svtrid"] = server_transaction_id
+        await keep_response(replay_key, status, result[1])
+        return status, result[1]
+    elif resource == "domains":
+        (domain, operation, extra) = parameters + [None]*(3 - len(parameters))
+        (result, done) = await admit(user, password, method)
+        if result is None:
+            try:
+                result = await handle_domain(domain, method, operation, extra,
+                                             body_size, environ["wsgi.input"],
+                                             user, password, conditions(environ))
+            finally:
+                if done is not None:
+                    done()
         status = result[0]
         if client_transaction_id is not None:
             status["cltrid"] = client_transaction_id
         status["svtrid"] = server_transaction_id
-        return send(start_response, status, result[1]);
-    elif path.startswith("/entities/"):
-        contact = path.removeprefix("/entities/")
-        result = handle_contact(contact, method, body_size, environ["wsgi.input"])
+        await keep_response(replay_key, status, result[1])
+        return status, result[1]
+    elif resource == "entities":
+        contact = parameters[0] if parameters else ""
+        (result, done) = await admit(user, password, method)
+        if result is None:
+            try:
+                result = await handle_contact(contact, method, body_size, environ["wsgi.input"],
+                                              conditions(environ),
+                                              urllib.parse.parse_qs(environ.get("QUERY_STRING", "")))
+            finally:
+                if done is not None:
+                    done()
         status = result[0]
         if client_transaction_id is not None:
             status["cltrid"] = client_transaction_id
         status["svtrid"] = server_transaction_id
-        return send(start_response, status, result[1]);
+        await keep_response(replay_key, status, result[1])
+        return status, result[1]
     else:
         status = {"code": 500,  "message": "Internal error, should not happen"}
-        return send(start_response, status, {})
-    if do_list_domains:
-        if method == "GET":
-            output = list_domains()
-            return send(start_response,
-                        {"code": 200, "message": "OK"}, output)
-        else:
-            return send(start_response,
-                        {"code": 405, "message": "Method %s not supported for /list-domains" % method}, {})
+        return status, {}
 
-# Logging
-logger = logging.getLogger("RPP")
-logger.setLevel(logging.DEBUG)
-loggingstr = "/home/stephane/tmp/" + LOGFILENAME
-fh = logging.FileHandler(loggingstr)
-ft = logging.Formatter(fmt = 'RPP - %(levelname)s - %(asctime)s - %(message)s',
-                       datefmt = '%Y-%m-%d %H:%M:%SZ')
-ft.converter = time.gmtime
-fh.setFormatter(ft)
-logger.addHandler(fh)
+def setup(with_pool=True):
+    """ Opens the log file and the database pool and loads the JSON
+    schemas. It is called by dispatch at the first request of each
+    process, so nothing is inherited through a fork. The ASGI front
+    end has its own pool and sets with_pool to False. With the
+    memory storage, there is no pool and no notifications. """
+    global setup_pid, database, store, validators, credentials_cache, availability_filter, \
+        conditional_cache, object_cache, replay_cache, transaction_ids, tracer
+    if setup_pid == os.getpid():
+        return
+    with setup_lock:
+        if setup_pid == os.getpid():
+            return
+        # Logging, through a queue (see translog.py)
+        logger.setLevel(logging.DEBUG)
+        log_listener = translog.start(logger, config["logfile"])
+        atexit.register(log_listener.stop)
+        if config["trace"] is not None:
+            tracer = tracing.Tracer(config["trace"], config["trace_plans"] or "%s.plans" % config["trace"],
+                                    config["trace_threshold"])
+
+        # Database
+        if config["storage"] == "memory":
+            store = memory.Store()
+        elif config["storage"] != "postgresql":
+            raise ValueError("Unknown storage %s" % config["storage"])
+        elif with_pool:
+            database = pool.Pool(config["database"], config["min_connections"],
+                                 config["max_connections"],
+                                 timeout=config["connection_timeout"],
+                                 on_connect=queries.prepare)
+
+        # JSONschema
+        validators = validation.Registry(config["schemas"],
+                                         fast=config["fast_validation"])
 
-# Database
-connection = psycopg2.connect("dbname=registry")
-connection.set_session(autocommit=False,
-                       isolation_level=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-cursor = connection.cursor()
-logger.info("Server starts")
+        # Admission control, see admission.py
+        if config["rate_limits"] is not None:
+            set_rate_limits(config["rate_limits"])
 
-# JSONschema
-INPUT = open("domain-schema.json")
-domain_schema = json.load(INPUT)
-INPUT = open("patch-domain-schema.json")
-patch_domain_schema = json.load(INPUT)
-INPUT = open("entity-schema.json")
-entity_schema = json.load(INPUT)
+        # Retries and server transaction ids, see idempotency.py
+        replay_cache = idempotency.Cache(config["replay_cache_size"], config["replay_window"])
+        transaction_ids = idempotency.TransactionIds(TRANSACTION_IDS_BLOCK)
 
+        # Caches, invalidated by the triggers of create.sql
+        credentials_cache = credentials.Cache(config["credentials_cache_size"],
+                                              config["credentials_ttl"],
+                                              config["credentials_failures"])
+        if config["listen"] and store is None:
+            listener = notifications.Listener(config["database"])
+            listener.subscribe("registrars", registrar_changed)
+            # Without notifications, a change made by another process
+            # would not be seen.
+            conditional_cache = conditional.Cache(config["conditional_cache_size"])
+            listener.subscribe("changes", conditional_cache.notified)
+            if config["object_cache_size"] > 0:
+                object_cache = objects.Cache(config["object_cache_size"])
+                listener.subscribe("changes", object_cache.notified)
+            # Without notifications, the filter would miss the domains
+            # created by the other processes. It is filled when the
+            # listener connects.
+            if config["availability_filter"]:
+                availability_filter = availability.Filter(config["database"],
+                                                          config["availability_error_rate"],
+                                                          config["availability_cache_size"])
+                listener.subscribe("domains", availability_filter.notified)
+            listener.start()
 
+        # Instrumentation, see metrics.py
+        instrumentation.gauge("rpp_pool_connections", "Database connections of the pool",
+                              pool_gauge)
+        instrumentation.gauge("rpp_cache_entries", "Entries of the caches",
+                              lambda: cache_gauges()["entries"])
+        instrumentation.gauge("rpp_cache_hit_ratio", "Lookups answered by the caches",
+                              lambda: cache_gauges()["hit_ratio"])
+        instrumentation.gauge("rpp_cache_evictions", "Entries removed from the object cache to make room",
+                              lambda: [] if object_cache is None else \
+                              [({"cache": "objects"}, object_cache.stats()["evictions"])])
+        instrumentation.gauge("rpp_log_dropped", "Records of the logs dropped because their queue was full",
+                              lambda: [({"log": log.name}, translog.dropped(log)) for log in \
+                                       [logger] + ([] if tracer is None else [tracer.logger, tracer.plans])])
+        instrumentation.gauge("rpp_availability_false_positive_ratio",
+                              "Lookups of the availability filter which went to the database for nothing",
+                              lambda: [] if availability_filter is None else \
+                              [({}, availability_filter.stats()["false_positive_rate"])])
+        if config["metrics_directory"] is not None:
+            instrumentation.start_export(config["metrics_directory"])
 
+        setup_pid = os.getpid()
+        logger.info("Server starts (process %i)" % setup_pid)
 
+def pool_gauge():
+    if database is None: # The ASGI front end registers its own, or no pool
+        return []
+    return [({"state": "in_use"}, database.in_use), ({"state": "max"}, database.maxconn)]
+
+def cache_gauges():
+    result = {"entries": [], "hit_ratio": []}
+    if credentials_cache is not None:
+        lookups = credentials_cache.hits + credentials_cache.misses
+        result["entries"].append(({"cache": "credentials"}, len(credentials_cache.entries)))
+        result["hit_ratio"].append(({"cache": "credentials"},
+                                    credentials_cache.hits/lookups if lookups else 0.0))
+    if conditional_cache is not None:
+        lookups = conditional_cache.hits + conditional_cache.misses
+        result["entries"].append(({"cache": "conditional"}, len(conditional_cache.entries)))
+        result["hit_ratio"].append(({"cache": "conditional"},
+                                    conditional_cache.hits/lookups if lookups else 0.0))
+    if object_cache is not None:
+        stats = object_cache.stats()
+        result["entries"].append(({"cache": "objects"}, stats["entries"]))
+        result["hit_ratio"].append(({"cache": "objects"}, stats["hit_rate"]))
+    if replay_cache is not None:
+        lookups = replay_cache.hits + replay_cache.misses
+        result["entries"].append(({"cache": "replay"}, len(replay_cache.entries)))
+        result["hit_ratio"].append(({"cache": "replay"},
+                                    replay_cache.hits/lookups if lookups else 0.0))
+    if availability_filter is not None:
+        stats = availability_filter.stats()
+        result["entries"].append(({"cache": "availability"}, stats["names"]))
+        result["hit_ratio"].append(({"cache": "availability"}, stats["hit_rate"]))
+    return result
+
+def registrar_changed(handle):
+    """ Notification sent by the database when a registrar was
+    modified or deleted """
+    credentials_cache.invalidate(None if handle is None else int(handle))
+
+def create_app(**kwargs):
+    """ The application factory. kwargs override the defaults in
+    config. Nothing is opened here, each worker process will set
+    itself up at its first request. """
+    for key in kwargs:
+        if key not in config:
+            raise TypeError("Unknown configuration parameter %s" % key)
+    config.update(kwargs)
+    return dispatch
+
+config = {"storage": STORAGE,
+          "database": DATABASE,
+          "min_connections": MIN_CONNECTIONS,
+          "max_connections": MAX_CONNECTIONS,
+          "connection_timeout": CONNECTION_TIMEOUT,
+          "logfile": os.environ.get("RPP_LOGFILE", os.path.join(tempfile.gettempdir(), LOGFILENAME)),
+          "log_sample_rate": LOG_SAMPLE_RATE,
+          "schemas": os.path.dirname(os.path.abspath(__file__)),
+          "fast_validation": True,
+          # orjson, if installed
+          "fast_json": True,
+          "credentials_cache_size": CREDENTIALS_CACHE_SIZE,
+          "credentials_ttl": CREDENTIALS_TTL,
+          "credentials_failures": CREDENTIALS_FAILURES,
+          "listen": True,
+          "availability_filter": True,
+          "availability_error_rate": AVAILABILITY_ERROR_RATE,
+          "availability_cache_size": AVAILABILITY_CACHE_SIZE,
+          "conditional_cache_size": CONDITIONAL_CACHE_SIZE,
+          "object_cache_size": OBJECT_CACHE_SIZE,
+          "replay_cache_size": REPLAY_CACHE_SIZE,
+          "replay_window": REPLAY_WINDOW,
+          # Responses for the retries also in PostgreSQL, for all the
+          # workers
+          "replay_shared": False,
+          "rate_limits": RATE_LIMITS,
+          # File of the tracing of the statements (see tracing.py),
+          # None for no tracing. The plans go to trace_plans, by
+          # default the same name followed by .plans.
+          "trace": None,
+          "trace_plans": None,
+          "trace_threshold": TRACE_THRESHOLD,
+          "metrics": True,
+          # Where the processes share their metrics, see metrics.py
+          "metrics_directory": None}
+logger = logging.getLogger("RPP")
+setup_lock = threading.Lock()
+setup_pid = None
+database = None
+store = None # The data, with the memory storage
+validators = None
+credentials_cache = None
+availability_filter = None
+conditional_cache = None
+object_cache = None
+replay_cache = None
+transaction_ids = None
+admission_controller = None
+tracer = None
+replays_stored = itertools.count(1)
+instrumentation = metrics.Metrics()
+# The database of the current request
+current_database = contextvars.ContextVar("database")
+# The address of its client (the budgets of credentials.py)
+current_address = contextvars.ContextVar("address", default=None)
+db = CurrentDatabase()
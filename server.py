@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+""" A production server for the RPP registry. The parent process opens
+the listening socket and forks the workers, which inherit it. Each
+worker serves requests with a pool of threads and keeps HTTP/1.1
+connections open between requests. """
+
+import argparse
+import concurrent.futures
+import http.server
+import io
+import json
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import traceback
+import urllib.parse
+
+import registry
+
+VERSION = "0.0"
+MAX_BODY = 1024*1024
+# Seconds before an idle (keep-alive) client connection is closed
+IDLE_TIMEOUT = 30
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    server_version = "RPP-Afnic/%s" % VERSION
+    timeout = IDLE_TIMEOUT
+    # The status line, the headers and the body leave in one packet
+    # (written at the flush in handle_one_request), and without
+    # waiting for the ACK of the previous one.
+    wbufsize = io.DEFAULT_BUFFER_SIZE
+    disable_nagle_algorithm = True
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)
+                return
+            if not self.raw_requestline:
+                self.close_connection = True
+                return
+            if not self.parse_request():
+                return
+            self.run_application()
+            self.wfile.flush()
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+
+    def environ(self, body):
+        (path, _, query) = self.path.partition("?")
+        (host, port) = self.server.server_address[:2]
+        environ = {"REQUEST_METHOD": self.command,
+                   "SCRIPT_NAME": "",
+                   "PATH_INFO": urllib.parse.unquote(path, "iso-8859-1"),
+                   "QUERY_STRING": query,
+                   "SERVER_NAME": host,
+                   "SERVER_PORT": str(port),
+                   "SERVER_PROTOCOL": self.request_version,
+                   "REMOTE_ADDR": self.client_address[0],
+                   "CONTENT_TYPE": self.headers.get("Content-Type", ""),
+                   "CONTENT_LENGTH": str(len(body)),
+                   "wsgi.version": (1, 0),
+                   "wsgi.url_scheme": "http",
+                   "wsgi.input": io.BytesIO(body),
+                   "wsgi.errors": sys.stderr,
+                   "wsgi.multithread": True,
+                   "wsgi.multiprocess": True,
+                   "wsgi.run_once": False}
+        for (name, value) in self.headers.items():
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+                continue
+            if key in environ:
+                environ[key] += "," + value
+            else:
+                environ[key] = value
+        return environ
+
+    def run_application(self):
+        if "Transfer-Encoding" in self.headers:
+            self.close_connection = True
+            self.send_error(411, "Chunked request bodies are not supported")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_BODY:
+            self.close_connection = True
+            self.send_error(413 if length > 0 else 400)
+            return
+        # We read the whole body now, so the connection is ready for
+        # the next request whatever the application does.
+        body = self.rfile.read(length)
+        state = {"status": None, "headers": None, "sent": False, "chunked": False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and state["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["status"] = status
+            state["headers"] = headers
+            return write
+
+        def write(data):
+            if not state["sent"]:
+                send_headers()
+            if self.command == "HEAD" or not data:
+                return
+            if state["chunked"]:
+                self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+            else:
+                self.wfile.write(data)
+
+        def send_headers():
+            (code, _, message) = state["status"].partition(" ")
+            self.send_response(int(code), message)
+            has_length = False
+            for (name, value) in state["headers"]:
+                if name.lower() == "content-length":
+                    has_length = True
+                self.send_header(name, value)
+            if not has_length and code != "304": # 304 has no body
+                if self.request_version == "HTTP/1.1":
+                    state["chunked"] = True
+                    self.send_header("Transfer-Encoding", "chunked")
+                else:
+                    self.close_connection = True
+                    self.send_header("Connection", "close")
+            self.end_headers()
+            state["sent"] = True
+
+        result = None
+        try:
+            result = self.server.application(self.environ(body), start_response)
+            for data in result:
+                write(data)
+            if not state["sent"]:
+                send_headers()
+            if state["chunked"] and self.command != "HEAD":
+                self.wfile.write(b"0\r\n\r\n")
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+        except Exception:
+            traceback.print_exc()
+            self.close_connection = True
+            if not state["sent"]:
+                self.send_error(500)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    def log_message(self, format, *args):
+        # The registry does its own logging
+        pass
+
+class WorkerServer(socketserver.TCPServer):
+    """ A TCP server on an already listening socket, handing each
+    client connection to a thread of a fixed-size pool. """
+
+    def __init__(self, listener, application, threads):
+        socketserver.TCPServer.__init__(self, listener.getsockname(), RequestHandler,
+                                        bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        self.application = application
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        traceback.print_exc()
+
+def read_rate_limits(filename):
+    with open(filename) as INPUT:
+        limits = json.load(INPUT)
+    registry.admission.check(limits)
+    return limits
+
+def worker(listener, args):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    def reload(signum, frame):
+        try:
+            registry.set_rate_limits(read_rate_limits(args.rate_limits))
+        except (OSError, ValueError, registry.admission.InvalidLimits) as e:
+            print("Worker %i: rate limits not changed: %s" % (os.getpid(), e), file=sys.stderr)
+    if args.rate_limits is not None:
+        signal.signal(signal.SIGHUP, reload)
+    application = registry.create_app(storage=args.storage,
+                                      database=args.database,
+                                      max_connections=args.threads,
+                                      logfile=args.logfile,
+                                      log_sample_rate=args.log_sample_rate,
+                                      metrics_directory=args.metrics_directory,
+                                      replay_shared=args.replay_shared,
+                                      trace=args.trace,
+                                      trace_threshold=args.trace_threshold,
+                                      rate_limits=None if args.rate_limits is None else \
+                                      read_rate_limits(args.rate_limits))
+    httpd = WorkerServer(listener, application, args.threads)
+    httpd.serve_forever()
+
+def spawn(listener, args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            worker(listener, args)
+        finally:
+            os._exit(1)
+    return pid
+
+def main():
+    parser = argparse.ArgumentParser(description="RPP server")
+    parser.add_argument("--address", default="")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes")
+    parser.add_argument("--threads", type=int, default=registry.MAX_CONNECTIONS,
+                        help="Number of threads (and database connections) per worker")
+    parser.add_argument("--storage", choices=["postgresql", "memory"], default=registry.STORAGE,
+                        help="memory keeps the data in each worker, use it with --workers 1")
+    parser.add_argument("--database", default=registry.DATABASE,
+                        help="PostgreSQL connection string")
+    parser.add_argument("--logfile", default=registry.config["logfile"])
+    parser.add_argument("--log-sample-rate", type=float, default=registry.LOG_SAMPLE_RATE,
+                        help="Fraction of the successful read requests which are logged")
+    parser.add_argument("--replay-shared", action="store_true",
+                        help="Keep the responses for the retries in PostgreSQL, for all the workers")
+    parser.add_argument("--rate-limits",
+                        help="JSON file of the limits of the registrars (see admission.py), read again on SIGHUP")
+    parser.add_argument("--trace",
+                        help="Log every statement to this file, and the plans of the slow ones to the same name followed by .plans (see tracing.py)")
+    parser.add_argument("--trace-threshold", type=float, default=registry.TRACE_THRESHOLD,
+                        help="Statements slower than this (seconds) are explained")
+    parser.add_argument("--metrics-directory",
+                        help="Where the workers share their metrics (default: a temporary directory)")
+    args = parser.parse_args()
+    if args.rate_limits is not None:
+        try:
+            read_rate_limits(args.rate_limits)
+        except (OSError, ValueError, registry.admission.InvalidLimits) as e:
+            parser.error("Invalid rate limits: %s" % e)
+    temporary = None
+    if args.metrics_directory is None:
+        temporary = args.metrics_directory = tempfile.mkdtemp(prefix="rpp-metrics-")
+
+    listener = socket.create_server((args.address, args.port), backlog=1024)
+    # Several workers wait on the same socket, the ones which lose the
+    # race must not block in accept()
+    listener.setblocking(False)
+    workers = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def reload(signum, frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGHUP)
+    if args.rate_limits is not None:
+        signal.signal(signal.SIGHUP, reload)
+
+    for i in range(args.workers):
+        workers.add(spawn(listener, args))
+    print("Serving HTTP on port %i with %i workers of %i threads..." % \
+          (args.port, args.workers, args.threads))
+    while workers:
+        try:
+            (pid, status) = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            print("Worker %i died (status %i), restarting it" % (pid, status),
+                  file=sys.stderr)
+            workers.add(spawn(listener, args))
+    if temporary is not None:
+        shutil.rmtree(temporary, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
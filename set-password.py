@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+""" Sets the password of a registrar. The running servers are told
+(through a trigger) to forget the old one. """
+
+import getpass
+import sys
+
+# https://pypi.org/project/psycopg2/
+import psycopg2
+
+import credentials
+import registry
+
+if len(sys.argv) != 2:
+    print("Usage: %s registrar-handle" % sys.argv[0], file=sys.stderr)
+    sys.exit(1)
+handle = int(sys.argv[1])
+password = getpass.getpass("New password for registrar %i: " % handle)
+if password != getpass.getpass("Again: "):
+    print("Passwords do not match", file=sys.stderr)
+    sys.exit(1)
+connection = psycopg2.connect(registry.DATABASE)
+cursor = connection.cursor()
+cursor.execute("UPDATE Registrars SET password = %(password)s WHERE handle = %(handle)s",
+               {"password": credentials.hash_password(password), "handle": handle})
+if cursor.rowcount != 1:
+    print("No registrar %i" % handle, file=sys.stderr)
+    sys.exit(1)
+connection.commit()
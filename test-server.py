@@ -8,7 +8,7 @@ import registry
 port = 8080
 VERSION = "0.0"
 
-httpd = server.make_server("", port, registry.dispatch)
+httpd = server.make_server("", port, registry.create_app())
 server.ServerHandler.server_software = "RPP-Afnic/%s CPython/%s" % (VERSION, sys.version.split()[0])
 print("Serving HTTP on port %i..." % port)
 # Respond to requests until process is killed
@@ -0,0 +1,83 @@
+""" Fixtures of the tests of the registry. They call the WSGI
+application in the test process, with the memory storage or with
+PostgreSQL: the database of registry.DATABASE (or of the environment
+variable RPP_TEST_DATABASE), created with create.sql. The tests which
+need PostgreSQL are skipped when it is not available. """
+
+import base64
+import io
+import os
+import sys
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import registry
+
+DATABASE = os.environ.get("RPP_TEST_DATABASE", registry.DATABASE)
+
+def environ(method, path, body=None, user=None, headers={}, address="192.0.2.1"):
+    """ user is "handle:password", headers the request headers, by
+    their HTTP name, address the one of the client. The query string
+    can be in path. """
+    body = b"" if body is None else body.encode()
+    (path, query) = (path.split("?", maxsplit=1) + [""])[:2]
+    result = {"REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query,
+              "wsgi.input": io.BytesIO(body), "CONTENT_LENGTH": str(len(body)),
+              "REMOTE_ADDR": address}
+    if user is not None:
+        result["HTTP_AUTHORIZATION"] = "Basic %s" % base64.b64encode(user.encode()).decode()
+    for (name, value) in headers.items():
+        result["HTTP_" + name.upper().replace("-", "_")] = value
+    return result
+
+def request(method, path, body=None, user=None, headers={}, address="192.0.2.1"):
+    """ Returns the status code, the response headers (a dictionary)
+    and the body """
+    response = {}
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+    output = b"".join(registry.dispatch(environ(method, path, body, user, headers, address),
+                                        start_response))
+    return int(response["status"].split()[0]), response["headers"], output
+
+def call(method, path, body=None, user=None, headers={}, address="192.0.2.1"):
+    """ Returns the status code and the body """
+    (code, headers, output) = request(method, path, body, user, headers, address)
+    return code, output
+
+@pytest.fixture
+def postgresql():
+    """ A connection to the database, to check the tables """
+    try:
+        connection = psycopg2.connect(DATABASE)
+    except psycopg2.OperationalError as e:
+        pytest.skip("PostgreSQL is not available (%s)" % str(e).strip())
+    yield connection
+    connection.close()
+
+@pytest.fixture
+def start(tmp_path):
+    """ start(storage, **config) sets the registry up again, as a new
+    worker would, with this configuration (by default, without
+    notifications) """
+    saved = dict(registry.config)
+    def stop():
+        if registry.database is not None:
+            registry.database.closeall()
+        registry.setup_pid = registry.database = registry.store = None
+        registry.admission_controller = None
+        # Only made when listening, a thread of a previous test may
+        # still notify the old ones
+        registry.availability_filter = registry.conditional_cache = registry.object_cache = None
+        registry.config.clear()
+        registry.config.update(saved)
+    def start(storage, **config):
+        stop()
+        registry.create_app(storage=storage, database=DATABASE,
+                            logfile=str(tmp_path / "rpp.log"), **dict({"listen": False}, **config))
+        registry.setup()
+    yield start
+    stop()
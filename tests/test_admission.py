@@ -0,0 +1,82 @@
+""" The admission control of the registrars (see admission.py), with
+the memory storage """
+
+import json
+
+import pytest
+
+import admission
+import registry
+from conftest import call, request
+
+# Almost no token given back during the test
+LIMITS = {"read": [0.001, 3], "write": [0.001, 2],
+          "registrars": {"3": {"read": [0.001, 5]}}}
+
+@pytest.fixture
+def memory(start):
+    start("memory", rate_limits=LIMITS)
+
+def reads(user, count):
+    return [call("GET", "/domains/foobar.example", user=user)[0] for i in range(count)]
+
+def throttled(user, operation, reason):
+    labels = (str(user), operation, reason)
+    return registry.instrumentation.counters["rpp_throttled_total"].get(labels, 0)
+
+def test_rate(memory):
+    before = throttled(2, "read", "rate")
+    assert reads("2:qwerty", 4) == [200, 200, 200, 429]
+    (code, headers, output) = request("GET", "/domains/foobar.example", user="2:qwerty")
+    assert code == 429, output
+    assert int(headers["Retry-After"]) >= 1
+    assert throttled(2, "read", "rate") == before + 2
+    # Its own limit
+    assert reads("3:bazinga", 6) == [200]*5 + [429]
+    # Not authenticated, not limited
+    assert reads(None, 10) == [200]*10
+
+def test_operations(memory):
+    """ The reads and the writes have their own buckets """
+    assert reads("2:qwerty", 4) == [200, 200, 200, 429]
+    codes = [call("PATCH", "/domains/foobar.example", json.dumps({"change": {"admin": 1}}), "2:qwerty")[0]
+             for i in range(3)]
+    assert codes == [200, 200, 429]
+
+def test_wrong_password(memory):
+    """ A wrong password does not use the tokens of the registrar
+    (below the budget of failures of credentials.py) """
+    for i in range(int(registry.config["credentials_failures"][1]) - 1):
+        (code, output) = call("GET", "/domains/foobar.example", user="2:wrong")
+        assert code != 429, output
+    assert reads("2:qwerty", 3) == [200, 200, 200]
+
+def test_reload(memory):
+    assert reads("2:qwerty", 4) == [200, 200, 200, 429]
+    registry.set_rate_limits(dict(LIMITS, read=[0.001, 1]))
+    assert reads("2:qwerty", 2) == [200, 429]
+    registry.set_rate_limits(None)
+    assert reads("2:qwerty", 5) == [200]*5
+
+def test_fair_share():
+    """ A registrar which took all the slots of the writes gets no
+    more once another one writes, the other one gets its share """
+    controller = admission.Controller({"write_slots": 4})
+    assert [controller.admit(2, "PUT") for i in range(4)] == [None]*4
+    assert controller.admit(2, "PUT") == ("write", "fair_share", 1)
+    assert [controller.admit(3, "PUT") for i in range(2)] == [None]*2
+    assert controller.admit(3, "PUT") == ("write", "fair_share", 1)
+    # Reads are not scheduled
+    assert controller.admit(2, "GET") is None
+    for i in range(3):
+        controller.done(2, "PUT")
+    assert controller.admit(2, "PUT") is None
+    controller.done(3, "PUT")
+    controller.done(3, "PUT")
+    assert controller.writing == {2: 2}
+
+def test_invalid():
+    for limits in ({"read": [1]}, {"read": [1, 0.5]}, {"write_slots": 0}, {"foo": 1},
+                   {"registrars": {"x": {}}}, {"registrars": {"3": {"write_slots": 1}}}):
+        with pytest.raises(admission.InvalidLimits):
+            admission.Controller(limits)
@@ -0,0 +1,110 @@
+""" The ASGI front end with PostgreSQL, called in the test process: the
+statements run on psycopg (not psycopg2), which sends its parameters
+with their types. """
+
+import asyncio
+import base64
+import json
+import uuid
+
+import psycopg
+import pytest
+
+import asgi
+
+class Recorded(asgi.AsyncDatabase):
+    """ Keeps the database errors of the statements """
+    errors_seen = []
+
+    async def run(self, name, args):
+        try:
+            return await super().run(name, args)
+        except psycopg.Error as e:
+            Recorded.errors_seen.append((name, e))
+            raise
+
+async def request(method, path, body="", user=None):
+    """ Returns the status code, the response headers (a dictionary)
+    and the body """
+    (path, query) = (path.split("?", maxsplit=1) + [""])[:2]
+    headers = []
+    if user is not None:
+        headers.append((b"authorization", b"Basic " + base64.b64encode(user.encode())))
+    async def receive():
+        return {"type": "http.request", "body": body.encode()}
+    messages = []
+    async def send(message):
+        messages.append(message)
+    await asgi.application({"type": "http", "method": method, "path": path,
+                            "query_string": query.encode(), "headers": headers,
+                            "client": ("192.0.2.1", 1234)},
+                           receive, send)
+    return (messages[0]["status"],
+            {name.decode(): value.decode() for (name, value) in messages[0]["headers"]},
+            b"".join(message.get("body", b"") for message in messages[1:]))
+
+@pytest.fixture
+def run(start, postgresql, monkeypatch):
+    """ run(coroutine) runs it with the ASGI front end, whose pool
+    belongs to the event loop of the test """
+    monkeypatch.setattr(asgi, "AsyncDatabase", Recorded)
+    Recorded.errors_seen = []
+    start("postgresql")
+    async def test(coroutine):
+        await asgi.startup()
+        try:
+            return await coroutine
+        finally:
+            await asgi.shutdown()
+    yield lambda coroutine: asyncio.run(test(coroutine))
+    assert asgi.database is None
+
+def test_domain(run, postgresql):
+    name = "asgi-%s.example" % uuid.uuid4().hex[:8]
+    async def scenario():
+        (code, headers, output) = await request("PUT", "/domains/%s" % name,
+                                                json.dumps({"holder": 1, "tech": 1, "admin": 1}),
+                                                "2:qwerty")
+        assert code == 201, output
+        (code, headers, output) = await request("GET", "/domains/%s" % name)
+        assert code == 200, output
+        assert json.loads(output)["holder"] == 1
+        assert "etag" in headers
+        (code, headers, output) = await request("DELETE", "/domains/%s" % name, user="2:qwerty")
+        assert code == 202, output
+        (code, headers, output) = await request("GET", "/domains/%s" % name)
+        assert code == 404, output
+    try:
+        run(scenario())
+    finally:
+        cursor = postgresql.cursor()
+        cursor.execute("DELETE FROM Domains WHERE name = %s", (name,))
+        postgresql.commit()
+
+def test_search(run, postgresql):
+    cursor = postgresql.cursor()
+    cursor.execute("SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'")
+    trigrams = cursor.fetchone()[0] == 1
+    name = "Zoe Asgi%s" % uuid.uuid4().hex[:8]
+    cursor.execute("INSERT INTO Contacts (name) VALUES (%s)", (name,))
+    postgresql.commit()
+    async def scenario():
+        (code, headers, output) = await request("GET", "/entities/?name=%s" % name[:-2].replace(" ", "%20"))
+        assert code == 200, output
+        assert [contact["name"] for contact in json.loads(output)["contacts"]] == [name]
+        return await request("GET", "/entities/?name=%s&match=fuzzy" % name[:-1].replace(" ", "%20"))
+    try:
+        (code, headers, output) = run(scenario())
+    finally:
+        cursor.execute("DELETE FROM Contacts WHERE name = %s", (name,))
+        postgresql.commit()
+    if trigrams:
+        assert code == 200, output
+        assert name in [contact["name"] for contact in json.loads(output)["contacts"]]
+    else:
+        # PostgreSQL found the function, the operators of pg_trgm are
+        # missing in its body
+        assert code == 501, output
+        [(statement, error)] = Recorded.errors_seen
+        assert statement == "search_contacts_fuzzy"
+        assert "function search_contacts_fuzzy(" in (error.diag.context or ""), error
@@ -0,0 +1,55 @@
+""" The availability filter (see availability.py): a change of this
+process is seen at once, and counted once, when its notification
+comes. """
+
+import json
+import time
+import uuid
+
+import availability
+import registry
+from conftest import call
+
+def test_counted_once():
+    availability_filter = availability.Filter(None)
+    availability_filter.bloom = availability.BloomFilter(100, 0.01)
+    availability_filter.added("new.example")
+    assert availability_filter.lookup("new.example") is True
+    availability_filter.notified("INSERT new.example")
+    assert availability_filter.stats()["names"] == 1
+    availability_filter.removed("new.example")
+    assert availability_filter.lookup("new.example") is False
+    availability_filter.notified("DELETE new.example")
+    assert availability_filter.deleted == 1
+
+def wait(condition):
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline, "Timeout"
+        time.sleep(0.01)
+
+def test_notifications(start, postgresql):
+    start("postgresql", listen=True)
+    call("GET", "/domains/nic.example") # Starts the listener
+    availability_filter = registry.availability_filter
+    wait(lambda: availability_filter.bloom is not None)
+    names = availability_filter.stats()["names"]
+    deleted = availability_filter.deleted
+    name = "availability-%s.example" % uuid.uuid4().hex[:8]
+    try:
+        generation = availability_filter.generation
+        (code, output) = call("PUT", "/domains/%s" % name,
+                              json.dumps({"holder": 2, "tech": 2, "admin": 2}), "2:qwerty")
+        assert code == 201, output
+        # The call of registry.store_domain, then the notification
+        wait(lambda: availability_filter.generation == generation + 2)
+        assert availability_filter.stats()["names"] == names + 1
+        generation = availability_filter.generation
+        (code, output) = call("DELETE", "/domains/%s" % name, user="2:qwerty")
+        assert code == 202, output
+        wait(lambda: availability_filter.generation == generation + 2)
+        assert availability_filter.deleted == deleted + 1
+    finally:
+        cursor = postgresql.cursor()
+        cursor.execute("DELETE FROM Domains WHERE name = %s", (name,))
+        postgresql.commit()
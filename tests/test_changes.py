@@ -0,0 +1,69 @@
+""" The export of the domains and the feed of their changes, with the
+memory storage """
+
+import json
+
+import pytest
+
+import registry
+from conftest import call, request
+
+USER = "2:qwerty"
+DOMAIN = json.dumps({"holder": 2, "tech": 2, "admin": 2})
+
+@pytest.fixture
+def memory(start):
+    start("memory")
+
+def changes(after, limit=None):
+    (code, output) = call("GET", "/changes?after=%i" % after + ("" if limit is None else "&limit=%i" % limit))
+    assert code == 200, output
+    result = json.loads(output)
+    return result["changes"], result["next"]
+
+def test_feed(memory):
+    """ A consumer starting from the export gets the changes made
+    since, in the order they were done, one page at a time """
+    (code, headers, output) = request("GET", "/export-domains")
+    assert code == 200, output
+    exported = [json.loads(line)["name"] for line in output.splitlines()]
+    assert "foobar.example" in exported
+    sequence = int(headers["RPP-Changes-Sequence"])
+    assert changes(sequence) == ([], sequence)
+    for (method, path, body) in [("PUT", "/domains/feed.example", DOMAIN),
+                                 ("PATCH", "/domains/feed.example", json.dumps({"change": {"admin": 1}})),
+                                 ("PATCH", "/domains/foobar.example", json.dumps({"change": {"tech": 1}})),
+                                 ("DELETE", "/domains/feed.example", None)]:
+        (code, output) = call(method, path, body, USER)
+        assert code in (200, 201, 202), output
+    (feed, after) = ([], sequence)
+    while True:
+        (page, after) = changes(after, 3)
+        if not page:
+            break
+        assert len(page) <= 3
+        feed += page
+    assert [(change["operation"], change["name"]) for change in feed] == \
+        [("create", "feed.example"), ("update", "feed.example"),
+         ("update", "foobar.example"), ("delete", "feed.example")]
+    sequences = [change["sequence"] for change in feed]
+    assert sequences == sorted(sequences) and len(set(sequences)) == len(sequences)
+    assert sequences[0] > sequence and after == sequences[-1]
+    assert (feed[1]["holder"], feed[1]["tech"], feed[1]["admin"], feed[1]["registrar"]) == (2, 2, 1, 2)
+    assert "holder" not in feed[3]
+    # The same in one page
+    assert changes(sequence)[0] == feed
+
+def test_failed(memory):
+    """ A write which failed leaves no change """
+    (feed, after) = changes(0)
+    (code, output) = call("PATCH", "/domains/foobar.example", json.dumps({"change": {"admin": 999}}), USER)
+    assert code == 400, output
+    (code, output) = call("PUT", "/domains/foobar.example", DOMAIN, USER)
+    assert code != 201, output
+    assert changes(after) == ([], after)
+
+@pytest.mark.parametrize("query", ["after=-1", "after=x", "limit=0", "limit=%i" % (registry.MAX_CHANGES + 1)])
+def test_invalid(memory, query):
+    (code, output) = call("GET", "/changes?" + query)
+    assert code == 400, output
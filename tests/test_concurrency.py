@@ -0,0 +1,114 @@
+""" Requests of many threads at the same time, sharing the pool (see
+registry.dispatch): each request must have its own connection, and
+registry.db must give it the database of its own request. """
+
+import json
+import threading
+import uuid
+
+import registry
+from conftest import call
+
+THREADS = 16
+REQUESTS = 10 # per thread
+CONNECTIONS = 4
+
+class Checked(registry.Database):
+    """ Checks, at each statement, that the connection is used by this
+    request only and that the current database (behind registry.db)
+    is this one """
+    lock = threading.Lock()
+    busy = set()
+    most = 0 # Connections used at the same time
+    statements = 0
+
+    def __init__(self, connection):
+        with self.lock:
+            assert connection not in self.busy, "Connection given to two requests"
+            self.busy.add(connection)
+            Checked.most = max(Checked.most, len(self.busy))
+        super().__init__(connection)
+        self.thread = threading.get_ident()
+
+    def run(self, function, *args):
+        assert threading.get_ident() == self.thread
+        assert registry.current_database.get() is self
+        with self.lock:
+            Checked.statements += 1
+        return super().run(function, *args)
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.busy.discard(self.connection)
+
+def test_threads(start, postgresql, monkeypatch):
+    monkeypatch.setattr(registry, "Database", Checked)
+    start("postgresql", min_connections=1, max_connections=CONNECTIONS, connection_timeout=60)
+    prefix = "concurrency-%s" % uuid.uuid4().hex[:8]
+    failures = []
+    def worker(number):
+        try:
+            for i in range(REQUESTS):
+                name = "%s-%i-%i.example" % (prefix, number, i)
+                contact = number % 2 + 1
+                (code, output) = call("PUT", "/domains/%s" % name,
+                                      json.dumps({"holder": contact, "tech": contact, "admin": 1}),
+                                      "2:qwerty")
+                assert code == 201, output
+                (code, output) = call("GET", "/domains/%s" % name)
+                assert code == 200, output
+                result = json.loads(output)
+                assert result["result"] == "Domain %s exists" % name
+                assert (result["holder"], result["tech_contact"]) == (contact, contact)
+        except Exception as e:
+            failures.append(e)
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(THREADS)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert failures == []
+        assert Checked.busy == set()
+        assert 1 < Checked.most <= CONNECTIONS
+        assert Checked.statements >= 2*THREADS*REQUESTS
+        cursor = postgresql.cursor()
+        cursor.execute("SELECT count(*) FROM Domains WHERE name LIKE %s", (prefix + "-%",))
+        assert cursor.fetchone()[0] == THREADS*REQUESTS
+    finally:
+        cursor = postgresql.cursor()
+        cursor.execute("DELETE FROM Domains WHERE name LIKE %s", (prefix + "-%",))
+        postgresql.commit()
+
+def test_deadlock(start, postgresql, monkeypatch):
+    """ Two requests lock the same rows in opposite orders: one of
+    them fails with a 500, not a 503, and the pool keeps both
+    connections, without checking them again """
+    start("postgresql", min_connections=2, max_connections=2)
+    barrier = threading.Barrier(2)
+    connections = []
+    async def handle_request(environ):
+        # The path is the order of the counters to lock
+        connections.append(registry.db.connection)
+        cursor = registry.db.connection.cursor()
+        for (i, name) in enumerate(environ["PATH_INFO"].split("/")[1:]):
+            cursor.execute("UPDATE Counters SET value = value WHERE name = %s", (name,))
+            if i == 0:
+                barrier.wait()
+        return {"code": 200, "message": "OK"}, {}
+    monkeypatch.setattr(registry, "handle_request", handle_request)
+    responses = []
+    threads = [threading.Thread(target=lambda path=path: responses.append(call("GET", path)))
+               for path in ("/domains/contacts", "/contacts/domains")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(code for (code, output) in responses) == [200, 500]
+    assert [json.loads(output)["status_message"] for (code, output) in responses if code == 500] == ["Conflict"]
+    assert len(set(connections)) == 2
+    assert not any(connection.closed for connection in connections)
+    # A broken connection sets them to 0, to test all the others
+    assert len(registry.database.last_used) == 2
+    assert all(registry.database.last_used.values())
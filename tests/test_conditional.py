@@ -0,0 +1,63 @@
+""" The conditional requests (ETag, Last-Modified, If-None-Match,
+If-Modified-Since and If-Match, see conditional.py), with the memory
+storage """
+
+import json
+
+import pytest
+
+from conftest import call, request
+
+USER = "2:qwerty"
+
+@pytest.fixture
+def memory(start):
+    start("memory")
+
+@pytest.mark.parametrize("path", ["/domains/foobar.example", "/entities/2"])
+def test_not_modified(memory, path):
+    (code, headers, output) = request("GET", path)
+    assert code == 200, output
+    (etag, date) = (headers["ETag"], headers["Last-Modified"])
+    for conditions in ({"If-None-Match": etag}, {"If-None-Match": '"1", %s' % etag},
+                       {"If-Modified-Since": date}):
+        (code, headers, output) = request("GET", path, headers=conditions)
+        assert code == 304, conditions
+        assert output == b""
+        assert headers["ETag"] == etag
+    (code, headers, output) = request("GET", path, headers={"If-None-Match": '"1"'})
+    assert code == 200, output
+    assert json.loads(output)["result"].endswith("exists")
+
+def test_changed(memory):
+    """ A PATCH gives a new ETag, the old one does not get a 304 """
+    (code, headers, output) = request("GET", "/domains/foobar.example")
+    etag = headers["ETag"]
+    (code, headers, output) = request("PATCH", "/domains/foobar.example",
+                                      json.dumps({"change": {"admin": 1}}), USER)
+    assert code == 200, output
+    assert headers["ETag"] != etag
+    new = headers["ETag"]
+    (code, headers, output) = request("GET", "/domains/foobar.example", headers={"If-None-Match": etag})
+    assert code == 200, output
+    assert headers["ETag"] == new
+    assert json.loads(output)["admin_contact"] == 1
+
+def test_if_match(memory):
+    """ Only the PATCH with the current ETag is done """
+    (code, headers, output) = request("GET", "/domains/foobar.example")
+    etag = headers["ETag"]
+    (code, headers, output) = request("PATCH", "/domains/foobar.example",
+                                      json.dumps({"change": {"tech": 1}}), USER,
+                                      {"If-Match": etag})
+    assert code == 200, output
+    new = headers["ETag"]
+    (code, output) = call("PATCH", "/domains/foobar.example", json.dumps({"change": {"tech": 2}}),
+                          USER, {"If-Match": etag})
+    assert code == 412, output
+    (code, headers, output) = request("GET", "/domains/foobar.example")
+    assert headers["ETag"] == new
+    assert json.loads(output)["tech_contact"] == 1
+    (code, output) = call("PATCH", "/domains/foobar.example", json.dumps({"change": {"tech": 2}}),
+                          USER, {"If-Match": "*"})
+    assert code == 200, output
@@ -0,0 +1,31 @@
+""" The verification of the passwords of the registrars (see
+credentials.py), with the memory storage """
+
+import json
+
+import pytest
+
+import registry
+from conftest import call
+
+BODY = json.dumps({"holder": 2, "tech": 2, "admin": 2})
+ATTACKER = "192.0.2.66"
+
+@pytest.fixture
+def memory(start):
+    start("memory")
+
+def put(name, user, address):
+    return call("PUT", "/domains/%s.example" % name, BODY, user, address=address)[0]
+
+def test_failures(memory):
+    """ A client sending wrong passwords gets a 429 once its budget is
+    used up, the other clients of the registrar are not locked out """
+    burst = registry.config["credentials_failures"][1]
+    codes = [put("failures-%i" % i, "2:wrong", ATTACKER) for i in range(burst + 2)]
+    assert codes == [401]*burst + [429]*2
+    # Not verified from this address, even the right password
+    assert put("failures-late", "2:qwerty", ATTACKER) == 429
+    assert put("failures-right", "2:qwerty", "192.0.2.1") == 201
+    # Once it is known, it is right from everywhere
+    assert put("failures-late", "2:qwerty", ATTACKER) == 201
@@ -0,0 +1,225 @@
+""" The limits of domains (MAX_DOMAINS, and the quotas of the
+registrars) under concurrent creations: they must never be exceeded,
+and the counters maintained for them (the tables Counters and Quotas,
+or the same in memory.Store) must stay exact. """
+
+import collections
+import datetime
+import json
+import threading
+import uuid
+
+import pytest
+
+import memory
+import queries
+import registry
+from conftest import call
+
+THREADS = 16
+REQUESTS = 5 # per thread
+LIMIT = 10 # domains which can still be created
+# Seconds after which approve_expired approves the transfers, they are
+# moved back further than that
+DELAY = 365*24*3600
+REGISTRAR = (3, "bazinga")
+USERS = {2: "2:qwerty", 3: "3:bazinga"}
+
+def create(prefix, user):
+    """ All the threads create domains at the same time, returns the
+    number of responses by status code """
+    codes = collections.Counter()
+    lock = threading.Lock()
+    def worker(number):
+        for i in range(REQUESTS):
+            (code, output) = call("PUT", "/domains/%s-%i-%i.example" % (prefix, number, i),
+                                  json.dumps({"holder": 2, "tech": 2, "admin": 2}), user)
+            with lock:
+                codes[code] += 1
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return codes
+
+class Memory:
+
+    def __init__(self, start):
+        start("memory")
+        self.store = registry.store
+
+    def domains(self, registrar=None):
+        return sum(1 for domain in self.store.domains.values()
+                   if registrar is None or domain[memory.REGISTRAR] == registrar)
+
+    def set_quota(self, registrar, maximum):
+        quota = self.store.quotas.setdefault(registrar, [0, None])
+        quota[1] = maximum
+
+    def approve_expired(self, prefix):
+        for transfer in self.store.transfers.values():
+            if transfer[0].startswith(prefix + "-"):
+                transfer[3] -= datetime.timedelta(seconds=2*DELAY)
+        database = memory.Database(self.store)
+        approved = database.statement("approve_expired_transfers", {"delay": DELAY, "batch": 100})[0]
+        database.finish()
+        return approved
+
+    def check_counters(self):
+        assert self.store.counters["domains"] == len(self.store.domains)
+        for (registrar, quota) in self.store.quotas.items():
+            assert quota[0] == self.domains(registrar)
+
+    def clean(self, prefix):
+        pass
+
+class PostgreSQL:
+
+    def __init__(self, start, connection):
+        start("postgresql")
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.quotas = None
+
+    def domains(self, registrar=None):
+        self.cursor.execute("SELECT count(*) FROM Domains WHERE %(registrar)s IS NULL OR registrar = %(registrar)s",
+                            {"registrar": registrar})
+        return self.cursor.fetchone()[0]
+
+    def set_quota(self, registrar, maximum):
+        if self.quotas is None:
+            self.cursor.execute("SELECT registrar, max_domains FROM Quotas")
+            self.quotas = self.cursor.fetchall()
+        self.cursor.execute("INSERT INTO Quotas (registrar, max_domains) VALUES (%(registrar)s, %(maximum)s) "
+                            "ON CONFLICT (registrar) DO UPDATE SET max_domains = %(maximum)s",
+                            {"registrar": registrar, "maximum": maximum})
+        self.connection.commit()
+
+    def approve_expired(self, prefix):
+        self.cursor.execute("UPDATE Transfers SET created = created - make_interval(secs => %s) "
+                            "WHERE domain LIKE %s", (2*DELAY, prefix + "-%"))
+        self.cursor.execute(queries.STATEMENTS["approve_expired_transfers"].sql,
+                            {"delay": DELAY, "batch": 100})
+        approved = self.cursor.rowcount
+        self.connection.commit()
+        return approved
+
+    def check_counters(self):
+        self.cursor.execute("SELECT value FROM Counters WHERE name = 'domains'")
+        assert self.cursor.fetchone()[0] == self.domains()
+        self.cursor.execute("SELECT Quotas.domains, count(Domains.name) FROM Quotas "
+                            "LEFT JOIN Domains ON Domains.registrar = Quotas.registrar "
+                            "GROUP BY Quotas.registrar, Quotas.domains")
+        for (counted, actual) in self.cursor.fetchall():
+            assert counted == actual
+
+    def clean(self, prefix):
+        self.connection.rollback()
+        self.cursor.execute("DELETE FROM Transfers WHERE domain LIKE %s", (prefix + "-%",))
+        self.cursor.execute("DELETE FROM Domains WHERE name LIKE %s", (prefix + "-%",))
+        if self.quotas is not None:
+            for (registrar, maximum) in self.quotas:
+                self.cursor.execute("UPDATE Quotas SET max_domains = %s WHERE registrar = %s",
+                                    (maximum, registrar))
+            # Those which had no quota before
+            self.cursor.execute("UPDATE Quotas SET max_domains = NULL WHERE registrar <> ALL(%s)",
+                                ([registrar for (registrar, maximum) in self.quotas],))
+        self.connection.commit()
+
+@pytest.fixture(params=["memory", "postgresql"])
+def storage(request, start):
+    if request.param == "memory":
+        return Memory(start)
+    return PostgreSQL(start, request.getfixturevalue("postgresql"))
+
+def test_max_domains(storage, monkeypatch):
+    prefix = "limits-%s" % uuid.uuid4().hex[:8]
+    try:
+        monkeypatch.setattr(registry, "MAX_DOMAINS", storage.domains() + LIMIT)
+        codes = create(prefix, "2:qwerty")
+        assert codes[201] == LIMIT
+        assert codes[400] == THREADS*REQUESTS - LIMIT
+        assert storage.domains() == registry.MAX_DOMAINS
+        storage.check_counters()
+    finally:
+        storage.clean(prefix)
+
+def test_quota(storage):
+    prefix = "quota-%s" % uuid.uuid4().hex[:8]
+    (registrar, password) = REGISTRAR
+    try:
+        before = storage.domains(registrar)
+        storage.set_quota(registrar, before + LIMIT)
+        codes = create(prefix, "%i:%s" % (registrar, password))
+        assert codes[201] == LIMIT
+        assert codes[400] == THREADS*REQUESTS - LIMIT
+        assert storage.domains(registrar) == before + LIMIT
+        storage.check_counters()
+    finally:
+        storage.clean(prefix)
+
+def test_transfers(storage):
+    """ Transfers in both directions between two registrars, approved
+    at the same time: they change the same two quotas and must not
+    deadlock """
+    prefix = "transfers-%s" % uuid.uuid4().hex[:8]
+    try:
+        names = []
+        for (registrar, other) in ((2, 3), (3, 2)):
+            for i in range(THREADS):
+                name = "%s-%i-%i.example" % (prefix, registrar, i)
+                (code, output) = call("PUT", "/domains/%s" % name,
+                                      json.dumps({"holder": 2, "tech": 2, "admin": 2}), USERS[registrar])
+                assert code == 201, output
+                (code, output) = call("POST", "/domains/%s/transfer" % name, None, USERS[other])
+                assert code == 200, output
+                names.append((name, registrar))
+        codes = collections.Counter()
+        lock = threading.Lock()
+        barrier = threading.Barrier(len(names))
+        def approve(name, registrar):
+            barrier.wait()
+            (code, output) = call("POST", "/domains/%s/transfer/approval" % name, None, USERS[registrar])
+            with lock:
+                codes[code] += 1
+        threads = [threading.Thread(target=approve, args=entry) for entry in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert codes == {200: len(names)}
+        storage.check_counters()
+    finally:
+        storage.clean(prefix)
+
+def test_transfer_quota(storage):
+    """ A transfer cannot take the gaining registrar beyond its quota,
+    approved by the losing registrar or by approve-transfers.py """
+    prefix = "xquota-%s" % uuid.uuid4().hex[:8]
+    (registrar, password) = REGISTRAR
+    try:
+        names = []
+        for i in range(3):
+            name = "%s-%i.example" % (prefix, i)
+            assert call("PUT", "/domains/%s" % name, json.dumps({"holder": 2, "tech": 2, "admin": 2}),
+                        USERS[2])[0] == 201
+            assert call("POST", "/domains/%s/transfer" % name, None, USERS[registrar])[0] == 200
+            names.append(name)
+        before = storage.domains(registrar)
+        storage.set_quota(registrar, before + 1)
+        assert call("POST", "/domains/%s/transfer/approval" % names[0], None, USERS[2])[0] == 200
+        (code, output) = call("POST", "/domains/%s/transfer/approval" % names[1], None, USERS[2])
+        assert (code, json.loads(output)["status_message"]) == (400, "Quota exceeded")
+        assert storage.approve_expired(prefix) == 0
+        # Room for one more: the oldest transfer
+        storage.set_quota(registrar, before + 2)
+        assert storage.approve_expired(prefix) == 1
+        assert storage.domains(registrar) == before + 2
+        (code, output) = call("GET", "/domains/%s" % names[1])
+        assert json.loads(output)["registrar"] == registrar
+        (code, output) = call("GET", "/domains/%s/transfer" % names[2], None, USERS[registrar])
+        assert "pending" in json.loads(output)["result"]
+        storage.check_counters()
+    finally:
+        storage.clean(prefix)
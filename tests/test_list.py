@@ -0,0 +1,67 @@
+""" The list of domains, streamed or one page at a time, with the
+memory storage """
+
+import json
+
+import pytest
+
+import registry
+from conftest import call
+
+@pytest.fixture
+def memory(start, monkeypatch):
+    # Several batches in the stream
+    monkeypatch.setattr(registry, "LIST_BATCH", 2)
+    start("memory")
+    for name in ("delta", "alpha", "echo", "charlie", "bravo"):
+        (code, output) = call("PUT", "/domains/%s.example" % name,
+                              json.dumps({"holder": 2, "tech": 2, "admin": 2}), "2:qwerty")
+        assert code == 201, output
+
+def page(query):
+    (code, output) = call("GET", "/list-domains?" + query)
+    assert code == 200, output
+    result = json.loads(output)
+    return result["list"], result.get("next")
+
+def test_stream(memory):
+    (code, output) = call("GET", "/list-domains")
+    assert code == 200, output
+    result = json.loads(output)
+    assert result["list"] == sorted(registry.store.domains)
+    assert result["status_code"] == 200
+    assert "next" not in result
+
+def test_stream_format(memory):
+    """ The same bytes as orjson would give for the whole list """
+    orjson = pytest.importorskip("orjson")
+    (code, output) = call("GET", "/list-domains")
+    assert output == orjson.dumps({"list": sorted(registry.store.domains),
+                                   "status_code": 200, "status_message": "OK"}) + b"\r\n"
+
+def test_pages(memory):
+    (names, after) = page("limit=3")
+    assert after == names[-1]
+    # A domain created before the position of the next page does not
+    # move it
+    (code, output) = call("PUT", "/domains/aaa.example",
+                          json.dumps({"holder": 2, "tech": 2, "admin": 2}), "2:qwerty")
+    assert code == 201, output
+    while after is not None:
+        (more, after) = page("limit=3&after=%s" % after)
+        names += more
+    expected = sorted(registry.store.domains)
+    expected.remove("aaa.example")
+    assert names == expected
+
+def test_last_page(memory):
+    """ A full last page has a next, which gives an empty page """
+    count = len(registry.store.domains)
+    (names, after) = page("limit=%i" % count)
+    assert len(names) == count
+    assert page("limit=%i&after=%s" % (count, after)) == ([], None)
+
+@pytest.mark.parametrize("limit", ["0", "-1", "x", str(registry.MAX_LIST_LIMIT + 1)])
+def test_invalid_limit(memory, limit):
+    (code, output) = call("GET", "/list-domains?limit=%s" % limit)
+    assert code == 400, output
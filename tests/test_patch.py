@@ -0,0 +1,89 @@
+""" PATCH of one domain and of many (/patch-domains), with the memory
+storage """
+
+import json
+
+import pytest
+
+import registry
+from conftest import call, request
+
+USER = "2:qwerty"
+
+@pytest.fixture
+def memory(start):
+    start("memory")
+
+def changes():
+    (code, output) = call("GET", "/changes")
+    return json.loads(output)["changes"]
+
+@pytest.mark.parametrize("change", [{}, {"foo": 1}, {"holder": 1, "foo": 1}, {"holder": "1"}])
+def test_invalid_change(memory, change):
+    """ A change without any member we know is refused, it must not
+    touch the domain """
+    (code, headers, output) = request("GET", "/domains/foobar.example")
+    etag = headers["ETag"]
+    before = changes()
+    (code, output) = call("PATCH", "/domains/foobar.example", json.dumps({"change": change}), USER)
+    assert code == 400, output
+    (code, output) = call("POST", "/patch-domains",
+                          json.dumps({"names": ["foobar.example"], "change": change}), USER)
+    assert code == 400, output
+    (code, headers, output) = request("GET", "/domains/foobar.example")
+    assert headers["ETag"] == etag
+    assert changes() == before
+
+def create(*names, user=USER):
+    for name in names:
+        (code, output) = call("PUT", "/domains/%s" % name,
+                              json.dumps({"holder": 2, "tech": 2, "admin": 2}), user)
+        assert code == 201, output
+
+def domain(name):
+    (code, output) = call("GET", "/domains/%s" % name)
+    result = json.loads(output)
+    return result["holder"], result["tech_contact"], result["admin_contact"]
+
+def test_batch(memory):
+    create("one.example", "two.example")
+    before = changes()
+    (code, output) = call("POST", "/patch-domains",
+                          json.dumps({"names": ["one.example", "TWO.example", "one.example"],
+                                      "change": {"tech": 1, "admin": 1}}), USER)
+    assert code == 200, output
+    result = json.loads(output)
+    assert sorted(result["domains"]) == ["one.example", "two.example"]
+    assert result["domains"]["two.example"]["tech_contact"] == 1
+    assert domain("one.example") == domain("two.example") == (2, 1, 1)
+    assert [(change["operation"], change["name"]) for change in changes()[len(before):]] == \
+        [("update", "one.example"), ("update", "two.example")]
+
+@pytest.mark.parametrize("names,code,member", [(["one.example", "none.example"], 404, "not_found"),
+                                               (["one.example", "three.example"], 403, "not_yours")])
+def test_batch_refused(memory, names, code, member):
+    """ One domain missing or of another registrar, and none is
+    changed """
+    create("one.example")
+    create("three.example", user="3:bazinga")
+    before = changes()
+    (status, output) = call("POST", "/patch-domains",
+                            json.dumps({"names": names, "change": {"admin": 1}}), USER)
+    assert status == code, output
+    assert json.loads(output)[member] == [names[1]]
+    assert domain("one.example") == (2, 2, 2)
+    assert changes() == before
+
+def test_batch_unknown_contact(memory):
+    create("one.example")
+    (code, output) = call("POST", "/patch-domains",
+                          json.dumps({"names": ["one.example"], "change": {"holder": 999}}), USER)
+    assert code == 400, output
+    assert domain("one.example") == (2, 2, 2)
+
+@pytest.mark.parametrize("count", [0, registry.MAX_PATCH + 1])
+def test_batch_size(memory, count):
+    names = ["d%i.example" % i for i in range(count)]
+    (code, output) = call("POST", "/patch-domains",
+                          json.dumps({"names": names, "change": {"admin": 1}}), USER)
+    assert code == 400, output
@@ -0,0 +1,89 @@
+""" The retries of the writes with the same RPP-Cltrid (see
+idempotency.py), with the memory storage """
+
+import json
+
+import pytest
+
+import registry
+from conftest import call, request
+
+DOMAIN = json.dumps({"holder": 2, "tech": 2, "admin": 2})
+
+@pytest.fixture(params=[False, True], ids=["local", "shared"])
+def memory(request, start):
+    start("memory", replay_shared=request.param)
+    return request.param
+
+def domains():
+    return len(registry.store.domains)
+
+def test_retry(memory):
+    """ The retry gets the first response, with its svtrid, and is
+    not run again """
+    headers = {"RPP-Cltrid": "replay-1"}
+    (code, first, output) = request("PUT", "/domains/replay.example", DOMAIN, "2:qwerty", headers)
+    assert code == 201, output
+    count = domains()
+    if memory:
+        # As if the retry went to another worker
+        registry.replay_cache.entries.clear()
+    (code, retry, replayed) = request("PUT", "/domains/replay.example", DOMAIN, "2:qwerty", headers)
+    assert code == 201, replayed
+    assert json.loads(replayed) == json.loads(output)
+    assert retry["RPP-Svtrid"] == first["RPP-Svtrid"]
+    assert retry["RPP-Cltrid"] == "replay-1"
+    assert retry["RPP-Replayed"] == "true"
+    assert "RPP-Replayed" not in first
+    assert domains() == count
+    # Another request, even with the same cltrid
+    (code, other, output) = request("DELETE", "/domains/replay.example", None, "2:qwerty", headers)
+    assert code == 202, output
+    assert "RPP-Replayed" not in other
+    assert int(other["RPP-Svtrid"]) > int(first["RPP-Svtrid"])
+
+def test_other_client(memory):
+    """ Only the registrar of the first request, with its password,
+    gets its response """
+    headers = {"RPP-Cltrid": "replay-2"}
+    (code, output) = call("PUT", "/domains/replay.example", DOMAIN, "2:qwerty", headers)
+    assert code == 201, output
+    (code, response, output) = request("PUT", "/domains/replay.example", DOMAIN, "3:bazinga", headers)
+    assert "RPP-Replayed" not in response
+    assert code != 201, output
+    (code, response, output) = request("PUT", "/domains/replay.example", DOMAIN, "2:wrong", headers)
+    assert "RPP-Replayed" not in response
+    assert code == 401, output
+
+def test_not_kept(memory):
+    """ The responses asking to authenticate are not replayed, the
+    retry with the right password is run """
+    headers = {"RPP-Cltrid": "replay-3"}
+    (code, output) = call("PUT", "/domains/replay.example", DOMAIN, "2:wrong", headers)
+    assert code == 401, output
+    (code, response, output) = request("PUT", "/domains/replay.example", DOMAIN, "2:qwerty", headers)
+    assert code == 201, output
+    assert "RPP-Replayed" not in response
+
+def test_headers(memory):
+    """ The retry of a PATCH gets the validators of the first
+    response """
+    headers = {"RPP-Cltrid": "replay-4"}
+    (code, first, output) = request("PATCH", "/domains/foobar.example",
+                                    json.dumps({"change": {"admin": 1}}), "2:qwerty", headers)
+    assert code == 200, output
+    if memory:
+        registry.replay_cache.entries.clear()
+    (code, retry, output) = request("PATCH", "/domains/foobar.example",
+                                    json.dumps({"change": {"admin": 1}}), "2:qwerty", headers)
+    assert code == 200, output
+    assert retry["RPP-Replayed"] == "true"
+    assert (retry["ETag"], retry["Last-Modified"]) == (first["ETag"], first["Last-Modified"])
+
+@pytest.mark.parametrize("path", ["/list-domains", "/list-domains?limit=1", "/export-domains",
+                                  "/changes", "/changes?limit=0"])
+def test_transaction_ids(memory, path):
+    """ Also the reads which are not replayed, and the streams """
+    (code, response, output) = request("GET", path, headers={"RPP-Cltrid": "feed-1"})
+    assert int(response["RPP-Svtrid"]) > 0
+    assert response["RPP-Cltrid"] == "feed-1"
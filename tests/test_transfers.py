@@ -0,0 +1,76 @@
+""" The transfers of domains (start, cancellation, rejection and
+approval), with the memory storage. The quotas and the concurrent
+approvals are in test_limits.py. """
+
+import json
+
+import pytest
+
+import registry
+from conftest import call
+
+LOSER = "2:qwerty"
+WINNER = "3:bazinga"
+DOMAIN = "/domains/foobar.example"
+
+@pytest.fixture
+def memory(start):
+    start("memory")
+
+def transfer(user, extra=None):
+    path = DOMAIN + "/transfer" + ("" if extra is None else "/" + extra)
+    (code, output) = call("POST", path, user=user)
+    return code, json.loads(output)["result"]
+
+def pending():
+    (code, output) = call("GET", DOMAIN + "/transfer", user=LOSER)
+    assert code == 200, output
+    return "has a transfer" in json.loads(output)["result"]
+
+def registrar():
+    (code, output) = call("GET", DOMAIN)
+    return json.loads(output)["registrar"]
+
+def test_approval(memory):
+    assert not pending()
+    assert transfer(LOSER) == (200, "2 is already the registrar of foobar.example")
+    assert transfer(LOSER, "approval")[0] == 404
+    assert transfer(WINNER) == (200, "Domain foobar.example transfer to registrar 3 started")
+    assert pending()
+    # Only one pending transfer
+    assert transfer(WINNER)[1].startswith("Domain foobar.example already has a transfer")
+    assert transfer(WINNER, "approval")[0] == 403
+    assert transfer(LOSER, "cancelation")[0] == 403
+    assert transfer(LOSER, "approval") == (200, "Transfer of foobar.example approved")
+    assert not pending()
+    assert registrar() == 3
+    # The new registrar can patch it, not the old one
+    (code, output) = call("PATCH", DOMAIN, json.dumps({"change": {"admin": 1}}), LOSER)
+    assert code == 403, output
+    (code, output) = call("PATCH", DOMAIN, json.dumps({"change": {"admin": 1}}), WINNER)
+    assert code == 200, output
+    (code, output) = call("GET", "/changes")
+    assert [(change["operation"], change["name"], change["registrar"])
+            for change in json.loads(output)["changes"][-2:]] == \
+        [("transfer", "foobar.example", 3), ("update", "foobar.example", 3)]
+
+@pytest.mark.parametrize("extra,user", [("cancelation", WINNER), ("rejection", LOSER)])
+def test_abandoned(memory, extra, user):
+    """ A cancelled or rejected transfer leaves the domain to its
+    registrar, and another one can start """
+    assert transfer(WINNER)[0] == 200
+    (code, result) = transfer(user, extra)
+    assert code == 200, result
+    assert not pending()
+    assert registrar() == 2
+    assert transfer(LOSER, "approval")[0] == 404
+    assert transfer(WINNER)[0] == 200
+    assert pending()
+
+def test_unknown(memory):
+    (code, output) = call("POST", "/domains/nothing.example/transfer", user=WINNER)
+    assert code == 404, output
+    (code, output) = call("POST", DOMAIN + "/transfer", user="3:wrong")
+    assert code == 401, output
+    assert not pending()
+    assert registry.store.transfers == {}
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+""" Adds up the tracing of the statements (see tracing.py): the top
+statements, by total time or number of calls, or, with --by handler,
+the statements run by each function of registry.py. With the file of
+the plans, the number of plans captured and, for the statements, the
+slowest one of the first statement which has some. """
+
+import argparse
+import json
+import statistics
+import sys
+
+SORTS = {"total": lambda entry: entry["total"],
+         "calls": lambda entry: entry["calls"],
+         "mean": lambda entry: entry["total"]/entry["calls"],
+         "max": lambda entry: entry["max"]}
+
+def records(filenames):
+    for filename in filenames:
+        with (sys.stdin if filename == "-" else open(filename)) as INPUT:
+            for line in INPUT:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "statement" in record:
+                    yield record
+
+def aggregate(records, key):
+    """ key -> calls, total time, durations, rows, errors, and the same
+    by statement """
+    result = {}
+    for record in records:
+        entry = result.setdefault(key(record), {"calls": 0, "total": 0.0, "max": 0.0, "durations": [],
+                                                "rows": 0, "errors": 0, "statements": {}})
+        for target in (entry, entry["statements"].setdefault(record["statement"],
+                                                             {"calls": 0, "total": 0.0, "max": 0.0})):
+            target["calls"] += 1
+            target["total"] += record["duration"]
+            target["max"] = max(target["max"], record["duration"])
+        entry["durations"].append(record["duration"])
+        entry["rows"] += record.get("rows") or 0
+        entry["errors"] += "error" in record
+    return result
+
+def p95(durations):
+    if len(durations) < 2:
+        return durations[0]
+    return statistics.quantiles(durations, n=20)[-1]
+
+def plans(filename, key):
+    """ key -> (number of plans, slowest record) """
+    result = {}
+    for record in records([filename]):
+        (count, slowest) = result.get(key(record), (0, None))
+        if slowest is None or record["duration"] > slowest["duration"]:
+            slowest = record
+        result[key(record)] = (count + 1, slowest)
+    return result
+
+parser = argparse.ArgumentParser(description="Report of the tracing of the statements")
+parser.add_argument("filenames", nargs="+", help="Trace files (- for the standard input)")
+parser.add_argument("--by", choices=["statement", "handler"], default="statement")
+parser.add_argument("--sort", choices=list(SORTS), default="total")
+parser.add_argument("--top", type=int, default=20)
+parser.add_argument("--plans", help="File of the plans (default: the trace file followed by .plans)")
+args = parser.parse_args()
+if args.plans is None and args.filenames[0] != "-":
+    args.plans = "%s.plans" % args.filenames[0]
+key = lambda record: record.get(args.by) or "?"
+entries = aggregate(records(args.filenames), key)
+captured = {}
+if args.plans is not None:
+    try:
+        captured = plans(args.plans, key)
+    except FileNotFoundError:
+        pass
+top = sorted(entries.items(), key=lambda item: SORTS[args.sort](item[1]), reverse=True)[:args.top]
+print("%-28s %8s %10s %9s %9s %9s %9s %6s %6s" % (args.by, "calls", "total (s)", "mean (ms)",
+                                                 "p95 (ms)", "max (ms)", "rows", "errors", "plans"))
+for (name, entry) in top:
+    print("%-28s %8i %10.3f %9.2f %9.2f %9.2f %9.1f %6i %6s" % \
+          (name, entry["calls"], entry["total"], 1000*entry["total"]/entry["calls"],
+           1000*p95(entry["durations"]), 1000*entry["max"], entry["rows"]/entry["calls"],
+           entry["errors"], captured[name][0] if name in captured else "-"))
+    if args.by == "handler":
+        for (statement, detail) in sorted(entry["statements"].items(),
+                                          key=lambda item: SORTS[args.sort](item[1]), reverse=True):
+            print("  %-26s %8i %10.3f %9.2f %9s %9.2f" % \
+                  (statement, detail["calls"], detail["total"], 1000*detail["total"]/detail["calls"],
+                   "", 1000*detail["max"]))
+explained = [name for (name, entry) in top if name in captured]
+if args.by == "statement" and explained:
+    slowest = captured[explained[0]][1]
+    print("\nSlowest plan of %s (%.2f ms, svtrid %s):" % (explained[0], 1000*slowest["duration"],
+                                                         slowest.get("svtrid")))
+    print(slowest.get("error") or json.dumps(slowest["plan"], indent=2))
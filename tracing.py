@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+""" Tracing of the statements sent to the database, to find which
+ones make the latency spikes. It is off by default (see the
+configuration "trace" of registry.py, or server.py --trace); when it
+is on, the database of each request is wrapped and every statement
+is logged (one JSON object per line, like the log of the requests)
+with its name, its SQL, its duration, the number of rows and the
+function of registry.py which ran it. trace-report.py adds them up.
+
+The statements slower than a threshold are run again with EXPLAIN
+(ANALYZE, BUFFERS), in a savepoint which is rolled back, so a write
+is not done twice, and the plan is logged to a second file (an INSERT
+fails the second time, it gets the plan without ANALYZE). This run
+adds to the latency of the request, and the sequences used by the
+statement (the handles, for instance) advance a second time. """
+
+import atexit
+import logging
+import sys
+import time
+
+import queries
+import translog
+
+# Options of EXPLAIN, the second ones when the statement fails when
+# run again
+EXPLAIN = ("ANALYZE, BUFFERS, FORMAT JSON", "FORMAT JSON")
+
+# Functions which only run the statement of their caller, the caller
+# is reported instead
+PASSTHROUGH = ("cached",)
+
+def handler(frame):
+    """ The first function outside this module and PASSTHROUGH, up
+    the stack from frame. The coroutines which await each other are
+    in the stack. """
+    while frame is not None and (frame.f_code.co_filename == __file__ or
+                                 frame.f_code.co_name in PASSTHROUGH):
+        frame = frame.f_back
+    return None if frame is None else frame.f_code.co_name
+
+class Tracer:
+
+    def __init__(self, filename, plans, threshold):
+        """ threshold is in seconds """
+        self.threshold = threshold
+        self.logger = logging.getLogger("RPP-trace")
+        self.plans = logging.getLogger("RPP-plans")
+        for (logger, name) in ((self.logger, filename), (self.plans, plans)):
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            atexit.register(translog.start(logger, name).stop)
+
+    def wrap(self, database, environ):
+        """ database is the database of the request (registry.Database,
+        asgi.AsyncDatabase or memory.Database), environ its WSGI
+        environment """
+        return Traced(self, database, environ)
+
+class Traced:
+    """ Same interface as the database it wraps """
+
+    def __init__(self, tracer, database, environ):
+        self.tracer = tracer
+        self.database = database
+        self.environ = environ
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    async def execute(self, name, args=None):
+        return await self.traced(name, args, self.database.execute(name, args), lambda rowcount: rowcount)
+
+    async def fetchone(self, name, args=None):
+        return await self.traced(name, args, self.database.fetchone(name, args),
+                                 lambda row: 0 if row is None else 1)
+
+    async def fetchall(self, name, args=None):
+        return await self.traced(name, args, self.database.fetchall(name, args), len)
+
+    async def commit(self):
+        return await self.traced("commit", None, self.database.commit(), None)
+
+    async def rollback(self):
+        return await self.traced("rollback", None, self.database.rollback(), None)
+
+    async def traced(self, name, args, awaitable, count):
+        """ count gives the number of rows from the result """
+        caller = handler(sys._getframe(1))
+        start = time.perf_counter()
+        try:
+            result = await awaitable
+        except Exception as e:
+            self.log(name, caller, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        duration = time.perf_counter() - start
+        self.log(name, caller, duration, rows=None if count is None else count(result))
+        if duration >= self.tracer.threshold and name in queries.STATEMENTS:
+            await self.explain(name, args, caller, duration)
+        return result
+
+    def log(self, name, caller, duration, **extra):
+        record = {"statement": name, "handler": caller, "duration": round(duration, 6),
+                  "svtrid": self.environ.get("rpp.svtrid"),
+                  "route": translog.route(self.environ.get("PATH_INFO", ""))}
+        if name in queries.STATEMENTS:
+            record["sql"] = queries.STATEMENTS[name].sql
+        record.update(extra)
+        self.tracer.logger.info("Statement %s" % name, extra={"transaction": record})
+
+    async def explain(self, name, args, caller, duration):
+        record = {"statement": name, "handler": caller, "duration": round(duration, 6),
+                  "svtrid": self.environ.get("rpp.svtrid"), "sql": queries.STATEMENTS[name].sql}
+        try:
+            record["plan"] = await self.database.explain(name, args)
+        except self.database.errors.Error as e:
+            record["error"] = str(e).strip()
+        if record.get("plan", True) is not None: # None: no plans (memory)
+            self.tracer.plans.info("Plan of %s" % name, extra={"transaction": record})
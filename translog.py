@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+""" The log of the registry, one JSON object per line. The requests
+only put the records in a queue, a thread of each process writes them
+to the file, so a slow disk does not delay the responses.
+
+Each request is logged with its identifiers, the client registrar,
+the route, the status and the latency. The successful read requests
+(availability checks, mostly) can be sampled, to limit the volume of
+the log during floods. """
+
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+
+# Records waiting to be written. When the queue is full, new records
+# are dropped (and counted) instead of blocking the request.
+QUEUE_SIZE = 10000
+
+# The variable parts of the paths, replaced by placeholders in the
+# route.
+ROUTES = [(re.compile(r"^/domains/[^/]+"), "/domains/{name}"),
+          (re.compile(r"^/entities/[^/]+"), "/entities/{handle}")]
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class QueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # The queue may be full at exit: wait for room instead of
+        # failing, so stop() still writes the records waiting.
+        self.queue.put(self._sentinel)
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+                 "level": record.levelname,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "transaction", {}))
+        return json.dumps(entry)
+
+def start(logger, filename):
+    """ Sends the records of logger to filename, through a queue.
+    Returns the listener, to be stopped at exit so the queue is
+    flushed. """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    records = queue.Queue(QUEUE_SIZE)
+    logger.addHandler(QueueHandler(records))
+    fh = logging.FileHandler(filename)
+    fh.setFormatter(JSONFormatter())
+    listener = QueueListener(records, fh)
+    listener.start()
+    return listener
+
+def dropped(logger):
+    """ Records of logger dropped so far because the queue was full """
+    return sum(handler.dropped for handler in logger.handlers if isinstance(handler, QueueHandler))
+
+def route(path):
+    for (regexp, template) in ROUTES:
+        if regexp.match(path):
+            return regexp.sub(template, path, count=1)
+    return path
+
+def sampled(method, path, code):
+    """ Is this request one of those which may be sampled? """
+    # 404 is the normal answer of an availability check
+    read = method in ("GET", "HEAD") or path == "/check-domains"
+    return read and (code < 400 or code == 404)
+
+def transaction(logger, environ, status, latency, sample_rate=1.0, **extra):
+    """ environ is the WSGI environment of the request, with the
+    rpp.* keys set by registry.handle_request. """
+    method = environ["REQUEST_METHOD"]
+    path = environ["PATH_INFO"]
+    sample = sample_rate < 1 and sampled(method, path, status["code"])
+    if sample and random.random() >= sample_rate:
+        return
+    record = {"svtrid": environ.get("rpp.svtrid"),
+              "cltrid": environ.get("HTTP_RPP_CLTRID"),
+              "registrar": environ.get("rpp.registrar"),
+              "method": method,
+              "route": route(path),
+              "status": status["code"],
+              "latency": round(latency, 6)}
+    if sample:
+        record["sample_rate"] = sample_rate
+    record.update(extra)
+    logger.info("Completing transaction %s" % record["svtrid"],
+                extra={"transaction": record})
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+""" The JSON schemas of the requests, loaded and compiled once. For
+the simple schemas, we also generate a Python function which only
+says if an instance is valid. When it does not accept the instance,
+the complete jsonschema validator runs, so the errors reported are
+always the ones of jsonschema. """
+
+import json
+import os
+
+# https://python-jsonschema.readthedocs.io https://pypi.org/project/jsonschema/
+import jsonschema
+
+# (class, method) -> file
+SCHEMAS = {("domain", "put"): "domain-schema.json",
+           ("domain", "patch"): "patch-domain-schema.json",
+           ("domain", "check"): "check-domains-schema.json",
+           ("domain", "batch"): "patch-domains-schema.json",
+           ("contact", "put"): "entity-schema.json"}
+
+# Keywords which do not change validation
+ANNOTATIONS = ("$schema", "$id", "title", "description", "$comment")
+TYPES = {"object": "dict", "array": "list", "string": "str",
+         "integer": "int", "boolean": "bool"}
+
+class Unsupported(Exception):
+    pass
+
+class Registry:
+
+    def __init__(self, directory, fast=True):
+        self.validators = {}
+        self.fast = {}
+        for (key, filename) in SCHEMAS.items():
+            with open(os.path.join(directory, filename)) as INPUT:
+                schema = json.load(INPUT)
+            klass = jsonschema.validators.validator_for(schema)
+            klass.check_schema(schema)
+            self.validators[key] = klass(schema)
+            if fast:
+                self.fast[key] = compile_fast(schema, filename)
+
+    def __contains__(self, key):
+        return key in self.validators
+
+    def validate(self, instance, klass, method):
+        """ Raises jsonschema.exceptions.ValidationError, like
+        jsonschema.validate """
+        fast = self.fast.get((klass, method))
+        if fast is not None and fast(instance):
+            return
+        error = jsonschema.exceptions.best_match(self.validators[(klass, method)].iter_errors(instance))
+        if error is not None:
+            raise error
+
+def expression(schema, var, depth=0):
+    """ Python expression which is true only if var is valid. It may
+    be false for some valid instances (for instance 2.0 for an
+    integer), it does not matter since the real validator will then
+    decide. """
+    if not isinstance(schema, dict):
+        raise Unsupported
+    tests = []
+    for keyword in schema:
+        if keyword in ANNOTATIONS or keyword in ("type", "properties", "required", "minProperties",
+                                                 "items", "const", "enum"):
+            continue
+        # Only the members in properties
+        if keyword == "additionalProperties" and schema[keyword] is False:
+            continue
+        raise Unsupported
+    stype = schema.get("type")
+    if stype is not None:
+        if stype not in TYPES:
+            raise Unsupported
+        tests.append("type(%s) is %s" % (var, TYPES[stype]))
+    if "const" in schema or "enum" in schema:
+        values = [schema["const"]] if "const" in schema else schema["enum"]
+        # 1 == True in Python, not in JSON Schema, so only strings
+        if not all(isinstance(v, str) for v in values):
+            raise Unsupported
+        tests.append("type(%s) is str and %s in %r" % (var, var, tuple(values)))
+    object_tests = []
+    for name in schema.get("required", []):
+        object_tests.append("%r in %s" % (name, var))
+    if "minProperties" in schema:
+        object_tests.append("len(%s) >= %i" % (var, schema["minProperties"]))
+    if "additionalProperties" in schema:
+        object_tests.append("%s.keys() <= %r" % (var, set(schema.get("properties", {}))))
+    for (name, subschema) in schema.get("properties", {}).items():
+        object_tests.append("(%r not in %s or %s)" % \
+                            (name, var, expression(subschema, "%s[%r]" % (var, name), depth)))
+    if object_tests:
+        if stype == "object":
+            tests.extend(object_tests)
+        else:
+            tests.append("(type(%s) is not dict or (%s))" % (var, " and ".join(object_tests)))
+    if "items" in schema:
+        item = "item%i" % depth
+        test = "all(%s for %s in %s)" % (expression(schema["items"], item, depth + 1), item, var)
+        if stype == "array":
+            tests.append(test)
+        else:
+            tests.append("(type(%s) is not list or %s)" % (var, test))
+    if not tests:
+        return "True"
+    return "(%s)" % " and ".join(tests)
+
+def compile_fast(schema, name="schema"):
+    """ Returns a function instance -> boolean, or None if the schema
+    uses keywords we do not handle. """
+    try:
+        source = "def valid(instance):\n    return %s\n" % expression(schema, "instance")
+    except Unsupported:
+        return None
+    namespace = {}
+    exec(compile(source, "<fast validator for %s>" % name, "exec"), namespace)
+    return namespace["valid"]